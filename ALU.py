@@ -0,0 +1,83 @@
+from array import array
+from State import FLAG_S, FLAG_Z, FLAG_A, FLAG_P, FLAG_C
+
+# Precomputed ALU results.
+# Built once at import from the same rules as CPU._add, _inc, _logic and
+# _daa (the reference engine), so an arithmetic or logic instruction is a
+# single lookup. tests/test_cpu.py checks every entry against those methods.
+#
+# ADD/SUB entries are (flags << 8) | result, indexed by
+# (carry in << 16) | (A << 8) | operand. CMP uses SUB and drops the result.
+
+# flags the arithmetic tables produce - other PSW bits are left alone
+ALU_FLAGS = FLAG_S | FLAG_Z | FLAG_A | FLAG_P | FLAG_C
+INC_FLAGS = FLAG_S | FLAG_Z | FLAG_A | FLAG_P  # INR/DCR leave carry alone
+LOGIC_FLAGS = ALU_FLAGS                        # ANA/XRA/ORA clear AC and carry
+
+
+def _szp(byte):
+    flags = byte & FLAG_S # sign is bit 7
+    if not byte:
+        flags |= FLAG_Z
+    if not bin(byte).count('1') % 2:
+        flags |= FLAG_P
+    return flags
+
+# sign, zero and parity flags of every byte
+SZP = array('B', [_szp(byte) for byte in range(256)])
+
+
+def _add_entry(acc_value, operand, carry, use_negative):
+    source = operand + carry
+    source = -source if use_negative else source
+    byte_result = (source + acc_value) & 0xff
+    flags = SZP[byte_result]
+    if (source & 0xf) + (acc_value & 0xf) > 0xf:
+        flags |= FLAG_A
+    if (-source > acc_value) if use_negative else ((source + acc_value) > 0xff):
+        flags |= FLAG_C
+    return (flags << 8) | byte_result
+
+def _add_table(use_negative):
+    return array('H', [_add_entry(acc_value, operand, carry, use_negative)
+                       for carry in (0, 1)
+                       for acc_value in range(256)
+                       for operand in range(256)])
+
+ADD = _add_table(use_negative=False)
+SUB = _add_table(use_negative=True)
+
+
+def _inc_entry(initial_value, inc_by):
+    byte_result = (initial_value + inc_by) & 0xff
+    flags = SZP[byte_result]
+    if (initial_value & 0xf) + inc_by > 0xf:
+        flags |= FLAG_A
+    return (flags << 8) | byte_result
+
+INC = array('H', [_inc_entry(value, 1) for value in range(256)])
+DEC = array('H', [_inc_entry(value, -1) for value in range(256)])
+
+
+def _daa_entry(acc_value, aux_carry, carry):
+    # Entries are (changed flags << 16) | (flags << 8) | result. When no
+    # correction is needed DAA leaves every flag as it was.
+    changed = 0
+    flags = (FLAG_A if aux_carry else 0) | (FLAG_C if carry else 0)
+    if (acc_value & 0xf) > 9 or aux_carry:
+        entry = ADD[(acc_value << 8) | 6]
+        acc_value = entry & 0xff
+        flags = (entry >> 8) & ~FLAG_C | (flags & FLAG_C) # carry restored
+        changed = ALU_FLAGS
+    if (acc_value >> 4) > 9 or flags & FLAG_C:
+        entry = ADD[(acc_value << 8) | 0x60]
+        acc_value = entry & 0xff
+        flags = (entry >> 8) & ~FLAG_A | (flags & FLAG_A) # aux carry restored
+        changed = ALU_FLAGS
+    return (changed << 16) | ((flags & changed) << 8) | acc_value
+
+# indexed by (carry << 9) | (aux carry << 8) | A
+DAA = array('L', [_daa_entry(acc_value, aux_carry, carry)
+                  for carry in (0, 1)
+                  for aux_carry in (0, 1)
+                  for acc_value in range(256)])
@@ -0,0 +1,538 @@
+import numpy as np
+from State import State, REG_H, REG_L, REG_A, PAIR_SP, FLAG_A, FLAG_C
+from CPU import CPU, register_code_indices, condition_flags
+from Machine import Machine
+import ALU
+
+# Many 8080s run in lockstep, one instruction across all lanes per step.
+# Machine state is kept as numpy arrays with one entry (or row) per lane -
+# registers[7, lanes], ram[lanes, 16384] and so on - and a step groups the
+# lanes by the opcode at their PC and runs each group's handler once, on
+# arrays of lane indices. Handlers follow the dispatch table handlers in CPU
+# (and so CPU._run) instruction for instruction, including the Space
+# Invaders ports: input on the read bus, the shift register on ports 2-4.
+# There is no soundboard.
+#
+# A single lane is slower than CPU, but hundreds of lanes running the same
+# program mostly share opcodes, so the work per instruction is spread over
+# all of them.
+#
+# Differences from CPU: addresses past the end of memory wrap instead of
+# raising, and a lane that executes HLT stays halted.
+
+MEMORY_SIZE = State.MEMORY_SIZE
+
+# ALU tables as arrays, for indexing with lane arrays
+ADD = np.array(ALU.ADD, dtype=np.int64)
+SUB = np.array(ALU.SUB, dtype=np.int64)
+INC = np.array(ALU.INC, dtype=np.int64)
+DEC = np.array(ALU.DEC, dtype=np.int64)
+DAA = np.array(ALU.DAA, dtype=np.int64)
+SZP = np.array(ALU.SZP, dtype=np.int64)
+
+KEEP_ALU = 0xff & ~ALU.ALU_FLAGS
+KEEP_INC = 0xff & ~ALU.INC_FLAGS
+KEEP_LOGIC = 0xff & ~ALU.LOGIC_FLAGS
+KEEP_CARRY = 0xff & ~FLAG_C
+
+
+class BatchCPU():
+
+    def __init__(self, lanes:int):
+        self.lanes = lanes
+        self.registers = np.zeros((7, lanes), dtype=np.uint8)
+        self.flags = np.full(lanes, 0b00000010, dtype=np.uint8)
+        self.pc = np.zeros(lanes, dtype=np.int64)
+        self.sp = np.full(lanes, State.STACKSTART, dtype=np.int64)
+        self.ram = np.zeros((lanes, MEMORY_SIZE), dtype=np.uint8)
+        self.readbus = np.zeros((4, lanes), dtype=np.uint8)
+        self.writebus = np.zeros((7, lanes), dtype=np.uint8)
+        self.shift_register = np.zeros(lanes, dtype=np.int64)
+        self.halted = np.zeros(lanes, dtype=np.bool_)
+        self.rom_end = 0
+        self.all_lanes = np.arange(lanes)
+        self.handlers = [self._decode(op) for op in range(256)]
+
+
+    def load_rom_image(self, image:bytes, start=Machine.ROMSTART):
+        # the same image in every lane; 0x0000 up to its end is read only, as
+        # after Machine.load_rom_image
+        self.ram[:, start:start + len(image)] = np.frombuffer(image, dtype=np.uint8)
+        self.rom_end = start + len(image)
+
+    def set_input(self, port1):
+        # port 1 bitmask for every lane, or one per lane
+        self.readbus[1] = port1
+
+    def from_state(self, lane:int, state:State):
+        self.registers[:, lane] = np.frombuffer(state.registers, dtype=np.uint8)
+        self.flags[lane] = state.flags
+        self.pc[lane] = state.pc
+        self.sp[lane] = state.sp
+        self.ram[lane] = np.frombuffer(state.ram, dtype=np.uint8)
+        self.readbus[:, lane] = state.readbus
+        self.writebus[:, lane] = state.writebus
+        self.shift_register[lane] = state.shift_register
+        self.halted[lane] = False
+
+    def to_state(self, lane:int, state:State):
+        state.registers[:] = self.registers[:, lane].tobytes()
+        state.flags = int(self.flags[lane])
+        state.pc = int(self.pc[lane])
+        state.sp = int(self.sp[lane])
+        state.set_ram(0, self.ram[lane].tobytes()) # marks VRAM rows for the display
+        state.readbus = [int(value) for value in self.readbus[:, lane]]
+        state.writebus = [int(value) for value in self.writebus[:, lane]]
+        state.shift_register = int(self.shift_register[lane])
+
+    def vram(self, lane:int) -> bytes:
+        return self.ram[lane, Machine.VRAM_START:Machine.VRAM_END].tobytes()
+
+
+    def step(self, lanes=None) -> np.ndarray:
+        # One instruction in each of lanes (default all but the halted ones).
+        # Returns the cycles each took, 0 for a lane that halted.
+        if lanes is None:
+            lanes = self.all_lanes[~self.halted]
+        cycles = np.empty(len(lanes), dtype=np.int64)
+        if not len(lanes):
+            return cycles
+        pc = self.pc[lanes]
+        ops = self.ram[lanes, pc]
+        self.pc[lanes] = (pc + 1) % MEMORY_SIZE
+        if (ops == ops[0]).all(): # lanes in lockstep
+            cycles[:] = self.handlers[ops[0]](lanes)
+            return cycles
+
+        order = np.argsort(ops, kind='stable')
+        starts = np.flatnonzero(np.diff(ops[order])) + 1
+        for group in np.split(order, starts):
+            cycles[group] = self.handlers[ops[group[0]]](lanes[group])
+        return cycles
+
+
+    def run_until(self, target_cycles:int, events=()) -> np.ndarray:
+        # As CPU.run_until in every lane that is not halted: events are
+        # (cycle, opcode) interrupts. Returns the cycles each lane used.
+        events = sorted(events)
+        event_cycles = np.array([cycle for cycle, _ in events] + [np.iinfo(np.int64).max])
+        cycles = np.zeros(self.lanes, dtype=np.int64)
+        next_event = np.zeros(self.lanes, dtype=np.int64) # index into events
+        lanes = self.all_lanes[~self.halted]
+        # lanes only need looking at once one reaches an event or the end
+        check_at = min(event_cycles[0], target_cycles)
+
+        while len(lanes):
+            used = self.step(lanes)
+            if len(lanes) == self.lanes:
+                cycles += used
+                lane_cycles = cycles
+            else:
+                lane_cycles = cycles[lanes] + used
+                cycles[lanes] = lane_cycles
+            if lane_cycles.max() < check_at and used.min(): # no HLT either
+                continue
+
+            lanes = lanes[~self.halted[lanes]]
+            # Interrupts here - in event order, so a lane can take several
+            for index, (cycle, op) in enumerate(events):
+                group = lanes[(next_event[lanes] == index) & (cycles[lanes] >= cycle)]
+                if len(group):
+                    cycles[group] += self.handlers[op](group)
+                    next_event[group] += 1
+            lanes = lanes[cycles[lanes] < target_cycles]
+            if len(lanes):
+                check_at = min(event_cycles[next_event[lanes]].min(), target_cycles)
+        return cycles
+
+    def run_frame(self, cycles_per_frame=Machine.CPF) -> np.ndarray:
+        # One video frame in every lane: RST 1 at mid-screen, RST 2 at vblank
+        return self.run_until(cycles_per_frame, [
+            (cycles_per_frame // 2, CPU.RST_MIDSCREEN),
+            (cycles_per_frame, CPU.RST_VBLANK),
+        ])
+
+
+    # memory and registers, for arrays of lanes
+
+    def _fetch_byte(self, lanes):
+        pc = self.pc[lanes]
+        self.pc[lanes] = (pc + 1) % MEMORY_SIZE
+        return self.ram[lanes, pc].astype(np.int64)
+
+    def _fetch_word(self, lanes):
+        low = self._fetch_byte(lanes)
+        return low | (self._fetch_byte(lanes) << 8)
+
+    def _read(self, lanes, address):
+        return self.ram[lanes, address % MEMORY_SIZE].astype(np.int64)
+
+    def _write(self, lanes, address, value):
+        # as State.set_ram: the RAM mirror, and no writes to ROM
+        address = np.where(address > MEMORY_SIZE, address - 0x2000, address) % MEMORY_SIZE
+        writable = address >= self.rom_end
+        if not writable.all():
+            lanes, address, value = lanes[writable], address[writable], np.broadcast_to(value, len(writable))[writable]
+        self.ram[lanes, address] = np.asarray(value) & 0xff
+
+    def _reg(self, index, lanes):
+        return self.registers[index, lanes].astype(np.int64)
+
+    def _get_pair(self, pair, lanes):
+        if pair == PAIR_SP:
+            return self.sp[lanes]
+        return (self._reg(pair << 1, lanes) << 8) | self._reg((pair << 1) + 1, lanes)
+
+    def _set_pair(self, pair, lanes, value):
+        if pair == PAIR_SP:
+            self.sp[lanes] = value & 0xffff
+        else:
+            self.registers[pair << 1, lanes] = (value >> 8) & 0xff
+            self.registers[(pair << 1) + 1, lanes] = value & 0xff
+
+    def _push(self, lanes, value):
+        sp = self.sp[lanes]
+        self._write(lanes, sp - 1, value >> 8)
+        self._write(lanes, sp - 2, value & 0xff)
+        self.sp[lanes] = (sp - 2) % MEMORY_SIZE
+
+    def _pop(self, lanes):
+        sp = self.sp[lanes]
+        value = self._read(lanes, sp) | (self._read(lanes, sp + 1) << 8)
+        self.sp[lanes] = (sp + 2) % MEMORY_SIZE
+        return value
+
+    def _call(self, lanes, address):
+        self._push(lanes, self.pc[lanes])
+        self.pc[lanes] = address % MEMORY_SIZE
+
+    def _taken(self, lanes, mask, value):
+        return (self.flags[lanes] & mask) == value
+
+
+    def _decode(self, op:int):
+        # mirrors CPU._decode, in the same order. Handlers take an array of
+        # lanes, their PCs already past the opcode, and return the cycles used
+        ddd = (op >> 3) & 0b111
+        sss = op & 0b111
+        rp = (op >> 4) & 0b11
+
+        if op == 0x00: return lambda lanes: 4
+        if op == 0x76: return self._op_hlt
+        if op == 0x3a: return self._op_lda
+        if op == 0x32: return self._op_sta
+        if op == 0x2a: return self._op_lhld
+        if op == 0x22: return self._op_shld
+        if op & 0b11111000 == 0b01110000:
+            return lambda lanes: self._op_mov_m_r(lanes, register_code_indices[sss])
+        if op & 0b11000111 == 0b01000110:
+            return lambda lanes: self._op_mov_r_m(lanes, register_code_indices[ddd])
+        if op & 0b11000000 == 0b01000000:
+            return lambda lanes: self._op_mov_r_r(lanes, register_code_indices[sss],
+                                                  register_code_indices[ddd])
+        if op == 0x36: return self._op_mvi_m
+        if op == 0xeb: return self._op_xchg
+        if op & 0b11001111 == 0b00000001: return lambda lanes: self._op_lxi(lanes, rp)
+        if op & 0b11001111 == 0b00001010: return lambda lanes: self._op_ldax(lanes, rp)
+        if op & 0b11001111 == 0b00000010: return lambda lanes: self._op_stax(lanes, rp)
+        if op & 0b11000111 == 0b00000110:
+            return lambda lanes: self._op_mvi_r(lanes, register_code_indices[ddd])
+
+        if op == 0x27: return self._op_daa
+        if op & 0b11000111 == 0b10000110: return lambda lanes: self._op_alu_m(lanes, ddd)
+        if op & 0b11000000 == 0b10000000:
+            return lambda lanes: self._op_alu_r(lanes, ddd, register_code_indices[sss])
+        if op & 0b11000111 == 0b11000110: return lambda lanes: self._op_alu_data(lanes, ddd)
+        if op == 0x34: return lambda lanes: self._op_inr_m(lanes, INC)
+        if op & 0b11000111 == 0b00000100:
+            return lambda lanes: self._op_inr_r(lanes, register_code_indices[ddd], INC)
+        if op == 0x35: return lambda lanes: self._op_inr_m(lanes, DEC)
+        if op & 0b11000111 == 0b00000101:
+            return lambda lanes: self._op_inr_r(lanes, register_code_indices[ddd], DEC)
+        if op & 0b11001111 == 0b00000011: return lambda lanes: self._op_inx(lanes, rp, 1)
+        if op & 0b11001111 == 0b00001011: return lambda lanes: self._op_inx(lanes, rp, -1)
+        if op & 0b11001111 == 0b00001001: return lambda lanes: self._op_dad(lanes, rp)
+
+        if op == 0x07: return self._op_rlc
+        if op == 0x0f: return self._op_rrc
+        if op == 0x17: return self._op_ral
+        if op == 0x1f: return self._op_rar
+        if op == 0x2f: return self._op_cma
+        if op == 0x3f: return self._op_cmc
+        if op == 0x37: return self._op_stc
+
+        if op == 0xc3: return self._op_jmp
+        if op & 0b11000111 == 0b11000010:
+            return lambda lanes: self._op_jcond(lanes, *condition_flags[ddd])
+        if op == 0xcd: return self._op_call
+        if op & 0b11000111 == 0b11000100:
+            return lambda lanes: self._op_ccond(lanes, *condition_flags[ddd])
+        if op == 0xc9: return self._op_ret
+        if op & 0b11000111 == 0b11000000:
+            return lambda lanes: self._op_rcond(lanes, *condition_flags[ddd])
+        if op & 0b11000111 == 0b11000111:
+            return lambda lanes: self._op_rst(lanes, ddd * 8)
+        if op == 0xe9: return self._op_pchl
+
+        if op == 0xf5: return self._op_pushpsw
+        if op & 0b11001111 == 0b11000101: return lambda lanes: self._op_push(lanes, rp)
+        if op == 0xf1: return self._op_poppsw
+        if op & 0b11001111 == 0b11000001: return lambda lanes: self._op_pop(lanes, rp)
+        if op == 0xe3: return self._op_xthl
+        if op == 0xf9: return self._op_sphl
+
+        if op in (0xfb, 0xf3): return lambda lanes: 4 # EI, DI
+        if op == 0xdb: return self._op_in
+        if op == 0xd3: return self._op_out
+
+        def not_implemented(lanes):
+            raise NotImplementedError(f"Instruction not implemented: {op:X} in lanes {list(lanes)}")
+        return not_implemented
+
+
+    def _op_hlt(self, lanes):
+        self.halted[lanes] = True
+        return 0
+
+    def _op_lda(self, lanes):
+        self.registers[REG_A, lanes] = self._read(lanes, self._fetch_word(lanes))
+        return 13
+
+    def _op_sta(self, lanes):
+        self._write(lanes, self._fetch_word(lanes), self._reg(REG_A, lanes))
+        return 13
+
+    def _op_lhld(self, lanes):
+        address = self._fetch_word(lanes)
+        self.registers[REG_L, lanes] = self._read(lanes, address)
+        self.registers[REG_H, lanes] = self._read(lanes, address + 1)
+        return 16
+
+    def _op_shld(self, lanes):
+        address = self._fetch_word(lanes)
+        self._write(lanes, address, self._reg(REG_L, lanes))
+        self._write(lanes, address + 1, self._reg(REG_H, lanes))
+        return 16
+
+    def _op_mov_m_r(self, lanes, source):
+        self._write(lanes, self._get_pair(2, lanes), self._reg(source, lanes))
+        return 7
+
+    def _op_mov_r_m(self, lanes, dest):
+        self.registers[dest, lanes] = self._read(lanes, self._get_pair(2, lanes))
+        return 7
+
+    def _op_mov_r_r(self, lanes, source, dest):
+        self.registers[dest, lanes] = self.registers[source, lanes]
+        return 5
+
+    def _op_mvi_m(self, lanes):
+        value = self._fetch_byte(lanes)
+        self._write(lanes, self._get_pair(2, lanes), value)
+        return 10
+
+    def _op_xchg(self, lanes):
+        de = self._get_pair(1, lanes)
+        self._set_pair(1, lanes, self._get_pair(2, lanes))
+        self._set_pair(2, lanes, de)
+        return 4
+
+    def _op_lxi(self, lanes, pair):
+        self._set_pair(pair, lanes, self._fetch_word(lanes))
+        return 10
+
+    def _op_ldax(self, lanes, pair):
+        self.registers[REG_A, lanes] = self._read(lanes, self._get_pair(pair, lanes))
+        return 7
+
+    def _op_stax(self, lanes, pair):
+        self._write(lanes, self._get_pair(pair, lanes), self._reg(REG_A, lanes))
+        return 7
+
+    def _op_mvi_r(self, lanes, dest):
+        self.registers[dest, lanes] = self._fetch_byte(lanes)
+        return 7
+
+    def _op_daa(self, lanes):
+        flags = self.flags[lanes].astype(np.int64)
+        entry = DAA[((flags & FLAG_C) << 9) | ((flags & FLAG_A) << 4) | self._reg(REG_A, lanes)]
+        self.registers[REG_A, lanes] = entry & 0xff
+        self.flags[lanes] = (flags & ~(entry >> 16)) | ((entry >> 8) & 0xff)
+        return 4
+
+    def _alu(self, lanes, operation, value):
+        # the 8 operations of the arithmetic and logical groups, in ddd order
+        a = self._reg(REG_A, lanes)
+        flags = self.flags[lanes].astype(np.int64)
+        if operation < 4 or operation == 7: # ADD ADC SUB SBB, CMP
+            table = ADD if operation < 2 else SUB
+            carry_in = (flags & FLAG_C) << 16 if operation in (1, 3) else 0
+            entry = table[carry_in | (a << 8) | value]
+            if operation != 7:
+                self.registers[REG_A, lanes] = entry & 0xff
+            self.flags[lanes] = (flags & KEEP_ALU) | (entry >> 8)
+        else:
+            result = (a & value, a ^ value, a | value)[operation - 4]
+            self.registers[REG_A, lanes] = result
+            self.flags[lanes] = (flags & KEEP_LOGIC) | SZP[result]
+
+    def _op_alu_r(self, lanes, operation, source):
+        self._alu(lanes, operation, self._reg(source, lanes))
+        return 4
+
+    def _op_alu_m(self, lanes, operation):
+        self._alu(lanes, operation, self._read(lanes, self._get_pair(2, lanes)))
+        return 7
+
+    def _op_alu_data(self, lanes, operation):
+        self._alu(lanes, operation, self._fetch_byte(lanes))
+        return 7
+
+    def _op_inr_r(self, lanes, register, table):
+        entry = table[self._reg(register, lanes)]
+        self.registers[register, lanes] = entry & 0xff
+        self.flags[lanes] = (self.flags[lanes] & KEEP_INC) | (entry >> 8)
+        return 5
+
+    def _op_inr_m(self, lanes, table):
+        address = self._get_pair(2, lanes)
+        entry = table[self._read(lanes, address)]
+        self._write(lanes, address, entry & 0xff)
+        self.flags[lanes] = (self.flags[lanes] & KEEP_INC) | (entry >> 8)
+        return 10
+
+    def _op_inx(self, lanes, pair, inc_by):
+        self._set_pair(pair, lanes, self._get_pair(pair, lanes) + inc_by)
+        return 5
+
+    def _op_dad(self, lanes, pair):
+        result = self._get_pair(pair, lanes) + self._get_pair(2, lanes)
+        self._set_pair(2, lanes, result)
+        self.flags[lanes] = (self.flags[lanes] & KEEP_CARRY) | (result > 0xffff)
+        return 10
+
+    def _op_rlc(self, lanes):
+        a = self._reg(REG_A, lanes)
+        high_bit = a >> 7
+        self.registers[REG_A, lanes] = ((a << 1) | high_bit) & 0xff
+        self.flags[lanes] = (self.flags[lanes] & KEEP_CARRY) | high_bit
+        return 4
+
+    def _op_rrc(self, lanes):
+        a = self._reg(REG_A, lanes)
+        low_bit = a & 0x01
+        self.registers[REG_A, lanes] = (a >> 1) | (low_bit << 7)
+        self.flags[lanes] = (self.flags[lanes] & KEEP_CARRY) | low_bit
+        return 4
+
+    def _op_ral(self, lanes):
+        a = self._reg(REG_A, lanes)
+        flags = self.flags[lanes]
+        self.registers[REG_A, lanes] = ((a << 1) | (flags & FLAG_C)) & 0xff
+        self.flags[lanes] = (flags & KEEP_CARRY) | (a >> 7)
+        return 4
+
+    def _op_rar(self, lanes):
+        a = self._reg(REG_A, lanes)
+        flags = self.flags[lanes]
+        self.registers[REG_A, lanes] = (a >> 1) | ((flags & FLAG_C).astype(np.int64) << 7)
+        self.flags[lanes] = (flags & KEEP_CARRY) | (a & 0x01)
+        return 4
+
+    def _op_cma(self, lanes):
+        self.registers[REG_A, lanes] = ~self.registers[REG_A, lanes]
+        return 4
+
+    def _op_cmc(self, lanes):
+        self.flags[lanes] ^= FLAG_C
+        return 4
+
+    def _op_stc(self, lanes):
+        self.flags[lanes] |= FLAG_C
+        return 4
+
+    def _op_jmp(self, lanes):
+        self.pc[lanes] = self._fetch_word(lanes) % MEMORY_SIZE
+        return 10
+
+    def _op_jcond(self, lanes, mask, value):
+        address = self._fetch_word(lanes)
+        taken = self._taken(lanes, mask, value)
+        self.pc[lanes[taken]] = address[taken] % MEMORY_SIZE
+        return 10
+
+    def _op_call(self, lanes):
+        self._call(lanes, self._fetch_word(lanes))
+        return 17
+
+    def _op_ccond(self, lanes, mask, value):
+        address = self._fetch_word(lanes)
+        taken = self._taken(lanes, mask, value)
+        self._call(lanes[taken], address[taken])
+        return np.where(taken, 17, 11)
+
+    def _op_ret(self, lanes):
+        self.pc[lanes] = self._pop(lanes) % MEMORY_SIZE
+        return 10
+
+    def _op_rcond(self, lanes, mask, value):
+        taken = self._taken(lanes, mask, value)
+        self._op_ret(lanes[taken])
+        return np.where(taken, 11, 5)
+
+    def _op_rst(self, lanes, address):
+        self._call(lanes, address)
+        return 11
+
+    def _op_pchl(self, lanes):
+        self.pc[lanes] = self._get_pair(2, lanes) % MEMORY_SIZE
+        return 5
+
+    def _op_pushpsw(self, lanes):
+        self._push(lanes, (self._reg(REG_A, lanes) << 8) | self.flags[lanes])
+        return 11
+
+    def _op_push(self, lanes, pair):
+        self._push(lanes, self._get_pair(pair, lanes))
+        return 11
+
+    def _op_poppsw(self, lanes):
+        value = self._pop(lanes)
+        self.registers[REG_A, lanes] = (value >> 8) & 0xff
+        self.flags[lanes] = value & 0xff
+        return 10
+
+    def _op_pop(self, lanes, pair):
+        self._set_pair(pair, lanes, self._pop(lanes))
+        return 10
+
+    def _op_xthl(self, lanes):
+        hl = self._get_pair(2, lanes)
+        stack = self._pop(lanes)
+        self._push(lanes, hl)
+        self._set_pair(2, lanes, stack)
+        return 18
+
+    def _op_sphl(self, lanes):
+        self.sp[lanes] = self._get_pair(2, lanes) % MEMORY_SIZE
+        return 5
+
+    def _op_in(self, lanes):
+        # as Bus.read: port 3 is the shift register, the others the read bus
+        port = self._fetch_byte(lanes)
+        offset = self.writebus[2, lanes] & 0b00000111
+        shifted = (self.shift_register[lanes] >> (8 - offset)) % 256
+        value = np.where(port < 4, self.readbus[port % 4, lanes], 0) # no such port reads 0
+        self.registers[REG_A, lanes] = np.where(port == 3, shifted, value)
+        return 10
+
+    def _op_out(self, lanes):
+        # as Bus.write, without sound: port 4 runs the shift register
+        port = self._fetch_byte(lanes)
+        known = port < 7
+        lanes, port = lanes[known], port[known]
+        self.writebus[port, lanes] = self.registers[REG_A, lanes]
+        shifting = lanes[port == 4]
+        self.shift_register[shifting] = ((self.shift_register[shifting] >> 8)
+                                         | (self.writebus[4, shifting].astype(np.int64) << 8)) % 65_535
+        return 10
@@ -24,7 +24,7 @@ class Bus():
         if not isinstance(value, int):
             raise TypeError("Bus value must be int.")
         self.state.set_writebus(port, value % 256)
-        if port in [3, 5]: # discrete sounds
+        if port in [3, 5] and self.soundboard: # discrete sounds
             self._sound_signal(port, value)
         if port == 4:  # run bit shift
             self._shift()
@@ -1,6 +1,9 @@
-from State import State
+from State import (State, reg_indices, REG_A, REG_H, REG_L, PAIR_DE, PAIR_HL, PAIR_SP,
+                   FLAG_S, FLAG_Z, FLAG_A, FLAG_P, FLAG_C)
 from Bus import Bus
+import ALU
 from utils import bits_to_int, byte_to_bits
+from functools import partial
 import time
 
 register_codes = {
@@ -20,13 +23,105 @@ register_codes_16b = {
     0b11: 'sp'
 }
 
+# register code -> index into State.registers
+register_code_indices = {code: reg_indices[name] for code, name in register_codes.items()}
+
+# condition code -> (flag mask, flag value that satisfies it)
+condition_flags = [
+    (FLAG_Z, 0),      # NZ
+    (FLAG_Z, FLAG_Z), # Z
+    (FLAG_C, 0),      # NC
+    (FLAG_C, FLAG_C), # C
+    (FLAG_P, 0),      # PO
+    (FLAG_P, FLAG_P), # PE
+    (FLAG_S, 0),      # P
+    (FLAG_S, FLAG_S), # M
+]
+
+
+def _instruction_length(op):
+    # bytes taken by an instruction, opcode included
+    if op in (0x3a, 0x32, 0x2a, 0x22, 0xc3, 0xcd): return 3
+    if op & 0b11001111 == 0b00000001: return 3               # LXI
+    if op & 0b11000111 in (0b11000010, 0b11000100): return 3 # Jcc, Ccc
+    if op & 0b11000111 in (0b00000110, 0b11000110): return 2 # MVI, immediate ALU
+    if op in (0xdb, 0xd3): return 2                          # IN, OUT
+    return 1
+
+fixed_cycles = {
+    0x00: 4, 0x76: 7, 0x3a: 13, 0x32: 13, 0x2a: 16, 0x22: 16, 0x36: 10, 0xeb: 4,
+    0x27: 4, 0x34: 10, 0x35: 10, 0x07: 4, 0x0f: 4, 0x17: 4, 0x1f: 4, 0x2f: 4,
+    0x3f: 4, 0x37: 4, 0xc3: 10, 0xcd: 17, 0xc9: 10, 0xe9: 5, 0xf5: 11, 0xf1: 10,
+    0xe3: 18, 0xf9: 5, 0xfb: 4, 0xf3: 4, 0xdb: 10, 0xd3: 10,
+}
+
+# (mask, pattern, cycles), checked in order after fixed_cycles
+pattern_cycles = [
+    (0b11111000, 0b01110000, 7),  # MOV M,r
+    (0b11000111, 0b01000110, 7),  # MOV r,M
+    (0b11000000, 0b01000000, 5),  # MOV r,r
+    (0b11001111, 0b00000001, 10), # LXI
+    (0b11001111, 0b00001010, 7),  # LDAX
+    (0b11001111, 0b00000010, 7),  # STAX
+    (0b11000111, 0b00000110, 7),  # MVI r
+    (0b11000111, 0b10000110, 7),  # ALU M
+    (0b11000000, 0b10000000, 4),  # ALU r
+    (0b11000111, 0b11000110, 7),  # ALU immediate
+    (0b11000110, 0b00000100, 5),  # INR/DCR r
+    (0b11000111, 0b00000011, 5),  # INX/DCX
+    (0b11001111, 0b00001001, 10), # DAD
+    (0b11000111, 0b11000010, 10), # Jcc
+    (0b11000111, 0b11000100, 11), # Ccc, 17 when taken
+    (0b11000111, 0b11000000, 5),  # Rcc, 11 when taken
+    (0b11000111, 0b11000111, 11), # RST
+    (0b11001111, 0b11000101, 11), # PUSH
+    (0b11001111, 0b11000001, 10), # POP
+]
+
+def _instruction_cycles(op):
+    if op in fixed_cycles:
+        return fixed_cycles[op]
+    for mask, pattern, cycles in pattern_cycles:
+        if op & mask == pattern:
+            return cycles
+    return 0 # not implemented
+
+instruction_lengths = [_instruction_length(op) for op in range(256)]
+instruction_cycles = [_instruction_cycles(op) for op in range(256)]
+
 class CPU():
 
+    # run_until stop reasons
+    STOP_CYCLES = 'cycles'          # cycle budget used up
+    STOP_HALT = 'halt'              # HLT executed
+    STOP_BREAKPOINT = 'breakpoint'  # PC reached a breakpoint, or a handler asked to break
+
+    # Space Invaders video interrupts
+    RST_MIDSCREEN = 0xcf # RST 1, beam at the middle of the screen
+    RST_VBLANK = 0xd7    # RST 2, beam at the bottom of the screen
+
     def __init__(self, state:State, bus:Bus, config={}):
-        self.config = {'debug':False}
+        # engine: 'table' (decoded dispatch table), 'recompiler' (translated
+        # blocks, see Recompiler) or 'reference' (bit pattern matcher)
+        # max_block: instructions per translated block, None for the recompiler's default
+        self.config = {'debug':False, 'engine':'table', 'max_block':None}
         self.config |= config # in-place update
         self.state = state
         self.bus = bus
+        self.dispatch_table = self._build_dispatch_table()
+        self.recompiler = None
+        self.rom = []     # predecoded ROM, see predecode_rom
+        self.rom_end = 0
+        self.instrument = None # see _instrument
+        self._interrupt = self._execute # runs injected RSTs
+        if self.config['engine'] == 'recompiler':
+            from Recompiler import Recompiler # Recompiler imports this module's tables
+            self.recompiler = Recompiler(self, self.config['max_block'])
+            self._step = self.recompiler.run_block
+        elif self.config['engine'] == 'table':
+            self._step = self._step_table
+        else:
+            self._step = self._step_reference
     
 
     def _get_r_from_bits(self, bits):
@@ -40,9 +135,10 @@ class CPU():
 
     def _fetch_next_byte(self):
         # get next byte that PC points to, then step the PC
-        value = self.state.get_byte_at_pc()
-        self.state.increment_pc()
-        return value
+        state = self.state
+        pc = state.pc
+        state.pc = (pc + 1) % state.MEMORY_SIZE
+        return state.ram[pc]
 
 
     def _fetch_next_two_bytes(self):
@@ -54,11 +150,14 @@ class CPU():
 
 
     def _set_nc_flags(self, byte_result): # set non-carry flags
-        self.state.set_flags({
-            's': bool(byte_result >> 7), # s
-            'z': bool(not byte_result),  # z
-            'p': not bool(sum(byte_to_bits(byte_result)) % 2), # p
-        })
+        flags = self.state.flags & ~(FLAG_S | FLAG_Z | FLAG_P)
+        if byte_result >> 7:
+            flags |= FLAG_S
+        if not byte_result:
+            flags |= FLAG_Z
+        if not sum(byte_to_bits(byte_result)) % 2:
+            flags |= FLAG_P
+        self.state.flags = flags
 
 
     def _run(self, instruction:list):
@@ -372,40 +471,48 @@ class CPU():
 
 
     def _add(self, source, add_carry=False, use_negative=False):
-        acc_value = self.state.get_reg('a')
+        state = self.state
+        acc_value = state.get_reg8(REG_A)
         if isinstance(source, str):
-            source = self.state.get_reg(source)
+            source = state.get_reg(source)
         
         # add carry bit if add_carry is True
-        source = source + self.state.get_flag('c') if add_carry else source
+        source = source + (state.flags & FLAG_C) if add_carry else source
 
         # negate if this is a subtract operation
         source = -source if use_negative else source
         
         byte_result = (source + acc_value) & 0xff
-        self.state.set_reg('a', byte_result)
+        state.set_reg8(REG_A, byte_result)
         # condition flag checks
         self._set_nc_flags(byte_result)
-        self.state.set_flags({
-            'a': ((source & 0xf) + (acc_value & 0xf) > 0xf), # ac
-            'c': ((-source > acc_value) if use_negative else 
-             ((source + acc_value) > 0xff)) # c
-        })
+        aux_carry = (source & 0xf) + (acc_value & 0xf) > 0xf
+        carry = (-source > acc_value) if use_negative else ((source + acc_value) > 0xff)
+        state.flags = ((state.flags & ~(FLAG_A | FLAG_C))
+                       | (FLAG_A if aux_carry else 0) | (FLAG_C if carry else 0))
 
 
     def _inc(self, register=None, use_hl_address=False, negative=False):
+        # register: name or index into State.registers
         inc_by = -1 if negative else 1
-        if register:
-            initial_value = self.state.get_reg(register)
-            byte_result = (initial_value + inc_by) & 0xff
-            self.state.set_reg(register, byte_result)
+        if register is not None:
+            index = reg_indices[register] if isinstance(register, str) else register
+            byte_result = self._inc_value(self.state.get_reg8(index), inc_by)
+            self.state.set_reg8(index, byte_result)
         elif use_hl_address:
-            address = self.state.get_reg('hl')
-            initial_value = self.state.get_ram(address)
-            byte_result = (initial_value + inc_by) & 0xff
+            address = self.state.get_pair(PAIR_HL)
+            byte_result = self._inc_value(self.state.get_ram(address), inc_by)
             self.state.set_ram(address, byte_result)
+
+
+    def _inc_value(self, initial_value, inc_by):
+        byte_result = (initial_value + inc_by) & 0xff
         self._set_nc_flags(byte_result)
-        self.state.set_flag('a',((initial_value & 0xf) + inc_by > 0xf))
+        if (initial_value & 0xf) + inc_by > 0xf:
+            self.state.flags |= FLAG_A
+        else:
+            self.state.flags &= ~FLAG_A
+        return byte_result
 
 
     def _sub(self, source, sub_carry=False):
@@ -416,23 +523,34 @@ class CPU():
         self._inc(register, use_hl_address, negative=True)
 
 
+    def _get_pair(self, register):
+        # register: pair name or pair index
+        if isinstance(register, str):
+            return self.state.get_reg(register)
+        return self.state.get_pair(register)
+
+
     def _dad(self, register):
         # add register pair to hl, set carry flag if needed
-        hl_value = self.state.get_reg('hl')
-        result = self.state.get_reg(register) + hl_value
-        self.state.set_reg('hl', result & 0xffff)
-        self.state.set_flag('c', result > 0xffff)
+        hl_value = self.state.get_pair(PAIR_HL)
+        result = self._get_pair(register) + hl_value
+        self.state.set_pair(PAIR_HL, result)
+        if result > 0xffff:
+            self.state.flags |= FLAG_C
+        else:
+            self.state.flags &= ~FLAG_C
 
 
     def _daa(self):
-        saved_carry = self.state.get_flag('c') # save carry value in case of overwrite
-        if ((self.state.get_reg('a') & 0xf) > 9) or self.state.get_flag('a'):
+        state = self.state
+        saved_carry = state.flags & FLAG_C # save carry value in case of overwrite
+        if ((state.get_reg8(REG_A) & 0xf) > 9) or state.flags & FLAG_A:
             self._add(6)
-            self.state.set_flag('c', saved_carry)
-        saved_aux_carry = self.state.get_flag('a') # save aux carry value in case of overwrite
-        if ((self.state.get_reg('a') >> 4) > 9) or self.state.get_flag('c'):
+            state.flags = (state.flags & ~FLAG_C) | saved_carry
+        saved_aux_carry = state.flags & FLAG_A # save aux carry value in case of overwrite
+        if ((state.get_reg8(REG_A) >> 4) > 9) or state.flags & FLAG_C:
             self._add(6 << 4)
-            self.state.set_flag('a', saved_aux_carry)
+            state.flags = (state.flags & ~FLAG_A) | saved_aux_carry
 
 
     def _logic(self, register_or_data, operation):
@@ -442,17 +560,16 @@ class CPU():
             source = register_or_data
         match operation:
             case 'and':
-                byte_result = self.state.get_reg('a') & source
+                byte_result = self.state.get_reg8(REG_A) & source
             case 'or':
-                byte_result = self.state.get_reg('a') | source
+                byte_result = self.state.get_reg8(REG_A) | source
             case 'xor':
-                byte_result = self.state.get_reg('a') ^ source
+                byte_result = self.state.get_reg8(REG_A) ^ source
 
-        self.state.set_reg('a', byte_result)
+        self.state.set_reg8(REG_A, byte_result)
 
         self._set_nc_flags(byte_result)
-        self.state.set_flag('c', False)  
-        self.state.set_flag('a', False)
+        self.state.flags &= ~(FLAG_C | FLAG_A)
 
 
     def _ana(self, register_or_data):
@@ -468,59 +585,48 @@ class CPU():
 
 
     def _cmp(self, register_or_data):
-        saved_acc_value = self.state.get_reg('a')
+        saved_acc_value = self.state.get_reg8(REG_A)
         self._sub(register_or_data)
-        self.state.set_reg('a', saved_acc_value)
+        self.state.set_reg8(REG_A, saved_acc_value)
+
+
+    def _set_carry(self, bit):
+        self.state.flags = (self.state.flags & ~FLAG_C) | bit
 
 
     def _rlc(self):
-        acc_value = self.state.get_reg('a')
+        acc_value = self.state.get_reg8(REG_A)
         high_bit = acc_value >> 7
-        self.state.set_reg('a', (acc_value << 1) | high_bit)
-        self.state.set_flag('c', high_bit)
+        self.state.set_reg8(REG_A, (acc_value << 1) | high_bit)
+        self._set_carry(high_bit)
 
 
     def _rrc(self):
-        acc_value = self.state.get_reg('a')
+        acc_value = self.state.get_reg8(REG_A)
         low_bit = acc_value & 0x01
-        self.state.set_reg('a', (acc_value >> 1) | (low_bit << 7))
-        self.state.set_flag('c', low_bit)
+        self.state.set_reg8(REG_A, (acc_value >> 1) | (low_bit << 7))
+        self._set_carry(low_bit)
 
 
     def _ral(self):
-        acc_value = self.state.get_reg('a')
-        carry = int(self.state.get_flag('c'))
+        acc_value = self.state.get_reg8(REG_A)
+        carry = self.state.flags & FLAG_C
         high_bit = acc_value >> 7
-        self.state.set_reg('a', (acc_value << 1) | carry)
-        self.state.set_flag('c', high_bit)
+        self.state.set_reg8(REG_A, (acc_value << 1) | carry)
+        self._set_carry(high_bit)
 
 
     def _rar(self):
-        acc_value = self.state.get_reg('a')
-        carry = int(self.state.get_flag('c'))
-        low_bit = bool(acc_value & 0x01)
-        self.state.set_reg('a', (acc_value >> 1) | (carry << 7))
-        self.state.set_flag('c', low_bit)
+        acc_value = self.state.get_reg8(REG_A)
+        carry = self.state.flags & FLAG_C
+        low_bit = acc_value & 0x01
+        self.state.set_reg8(REG_A, (acc_value >> 1) | (carry << 7))
+        self._set_carry(low_bit)
 
 
     def _check_conditions(self, operation:int) -> bool:
-        match operation:
-            case 0b000:
-                return self.state.get_flag('z') == False
-            case 0b001:
-                return self.state.get_flag('z') == True
-            case 0b010:
-                return self.state.get_flag('c') == False
-            case 0b011:
-                return self.state.get_flag('c') == True
-            case 0b100:
-                return self.state.get_flag('p') == False
-            case 0b101:
-                return self.state.get_flag('p') == True
-            case 0b110:
-                return self.state.get_flag('s') == False
-            case 0b111:
-                return self.state.get_flag('s') == True
+        mask, value = condition_flags[operation]
+        return (self.state.flags & mask) == value
 
 
     def _push_to_stack(self, value):
@@ -550,48 +656,452 @@ class CPU():
 
 
     def _push(self, register):
-        if register == 'sp':
+        if register in ('sp', PAIR_SP):
             raise ValueError("SP may not be pushed in PUSH operation.")
-        value = self.state.get_reg(register)
-        self._push_to_stack(value)
+        self._push_to_stack(self._get_pair(register))
 
 
     def _pop(self, register):
-        if register == 'sp':
+        if register in ('sp', PAIR_SP):
             raise ValueError("SP may not be pushed in PUSH operation.")
         value = self._pop_from_stack()
-        self.state.set_reg(register, value)
+        if isinstance(register, str):
+            self.state.set_reg(register, value)
+        else:
+            self.state.set_pair(register, value)
 
 
     def _pushpsw(self):
-        psw = self.state.get_psw()
-        a = self.state.get_reg('a')
-        self._push_to_stack((a << 8) | psw)
+        # PSW is already packed - A is the high byte, flags the low
+        self._push_to_stack((self.state.get_reg8(REG_A) << 8) | self.state.flags)
 
 
     def _poppsw(self):
         value = self._pop_from_stack()
-        a = value >> 8
-        psw = value & 0xff
-        self.state.set_reg('a', a)
-        self.state.set_psw(psw)
+        self.state.set_reg8(REG_A, value >> 8)
+        self.state.set_psw(value & 0xff)
 
 
     def _xthl(self):
-        hl = self.state.get_reg('hl')
+        hl = self.state.get_pair(PAIR_HL)
         stack = self._pop_from_stack()
         self._push_to_stack(hl)
-        self.state.set_reg('hl', stack)
+        self.state.set_pair(PAIR_HL, stack)
         
 
-    def run_cycle(self, rst=None):
-        # interrupt
-        if rst:
-            op = rst
+    ### Dispatch table engine
+    # Every opcode is decoded once into a handler with its register/condition
+    # operands already bound, so run_cycle only has to index the table.
+
+    def _build_dispatch_table(self):
+        # Arithmetic and logical groups share one layout: 10 ooo sss / 11 ooo 110
+        self._alu_operations = [
+            self._alu_add, self._alu_adc, self._alu_sub, self._alu_sbb,
+            self._alu_ana, self._alu_xra, self._alu_ora, self._alu_cmp,
+        ]
+        self.handlers = [self._decode(op) for op in range(256)]
+        return [self._with_operand(handler, instruction_lengths[op])
+                for op, handler in enumerate(self.handlers)]
+
+    def _with_operand(self, handler, length):
+        # handlers of instructions with immediate data take it as an argument,
+        # dispatch table entries fetch it first
+        if length == 2:
+            return partial(self._fetch_byte_operand, handler)
+        if length == 3:
+            return partial(self._fetch_word_operand, handler)
+        return handler
+
+    def _fetch_byte_operand(self, handler):
+        return handler(self._fetch_next_byte())
+
+    def _fetch_word_operand(self, handler):
+        return handler(self._fetch_next_two_bytes())
+
+
+    def _decode(self, op:int):
+        # mirrors the arms of _run, in the same order
+        ddd = (op >> 3) & 0b111
+        sss = op & 0b111
+        rp = (op >> 4) & 0b11 # pair index
+
+        # Machine control group
+        if op == 0x00: return self._op_nop
+        if op == 0x76: return self._op_hlt
+
+        # Data transfer group
+        if op == 0x3a: return self._op_lda
+        if op == 0x32: return self._op_sta
+        if op == 0x2a: return self._op_lhld
+        if op == 0x22: return self._op_shld
+        if op & 0b11111000 == 0b01110000:
+            return partial(self._op_mov_m_r, register_code_indices[sss])
+        if op & 0b11000111 == 0b01000110:
+            return partial(self._op_mov_r_m, register_code_indices[ddd])
+        if op & 0b11000000 == 0b01000000:
+            return partial(self._op_mov_r_r, register_code_indices[sss],
+                           register_code_indices[ddd])
+        if op == 0x36: return self._op_mvi_m
+        if op == 0xeb: return self._op_xchg
+        if op & 0b11001111 == 0b00000001: return partial(self._op_lxi, rp)
+        # LDAX/STAX with HL and SP are LHLD/LDA and SHLD/STA, matched above
+        if op & 0b11001111 == 0b00001010: return partial(self._op_ldax, rp)
+        if op & 0b11001111 == 0b00000010: return partial(self._op_stax, rp)
+        if op & 0b11000111 == 0b00000110:
+            return partial(self._op_mvi_r, register_code_indices[ddd])
+
+        # Arithmetic group
+        alu_operations = self._alu_operations
+        if op == 0x27: return self._op_daa
+        if op & 0b11000111 == 0b10000110:
+            return partial(self._op_alu_m, alu_operations[ddd])
+        if op & 0b11000000 == 0b10000000:
+            return partial(self._op_alu_r, alu_operations[ddd], register_code_indices[sss])
+        if op & 0b11000111 == 0b11000110:
+            return partial(self._op_alu_data, alu_operations[ddd])
+        if op == 0x34: return partial(self._op_inr_m, ALU.INC)
+        if op & 0b11000111 == 0b00000100:
+            return partial(self._op_inr_r, register_code_indices[ddd], ALU.INC)
+        if op == 0x35: return partial(self._op_inr_m, ALU.DEC)
+        if op & 0b11000111 == 0b00000101:
+            return partial(self._op_inr_r, register_code_indices[ddd], ALU.DEC)
+        if op & 0b11001111 == 0b00000011: return partial(self._op_inx, rp, 1)
+        if op & 0b11001111 == 0b00001011: return partial(self._op_inx, rp, -1)
+        if op & 0b11001111 == 0b00001001: return partial(self._op_dad, rp)
+
+        # logical group
+        if op == 0x07: return partial(self._op_rotate, self._rlc)
+        if op == 0x0f: return partial(self._op_rotate, self._rrc)
+        if op == 0x17: return partial(self._op_rotate, self._ral)
+        if op == 0x1f: return partial(self._op_rotate, self._rar)
+        if op == 0x2f: return self._op_cma
+        if op == 0x3f: return self._op_cmc
+        if op == 0x37: return self._op_stc
+
+        # branch instructions
+        if op == 0xc3: return self._op_jmp
+        if op & 0b11000111 == 0b11000010: return partial(self._op_jcond, *condition_flags[ddd])
+
+        # call instructions
+        if op == 0xcd: return self._op_call
+        if op & 0b11000111 == 0b11000100: return partial(self._op_ccond, *condition_flags[ddd])
+        if op == 0xc9: return self._op_ret
+        if op & 0b11000111 == 0b11000000: return partial(self._op_rcond, *condition_flags[ddd])
+        if op & 0b11000111 == 0b11000111: return partial(self._op_rst, ddd * 8)
+        if op == 0xe9: return self._op_pchl
+
+        # push pop
+        if op == 0xf5: return self._op_pushpsw
+        if op & 0b11001111 == 0b11000101: return partial(self._op_push, rp)
+        if op == 0xf1: return self._op_poppsw
+        if op & 0b11001111 == 0b11000001: return partial(self._op_pop, rp)
+        if op == 0xe3: return self._op_xthl
+        if op == 0xf9: return self._op_sphl
+
+        # interrupts and I/O
+        if op == 0xfb: return self._op_ei
+        if op == 0xf3: return self._op_di
+        if op == 0xdb: return self._op_in
+        if op == 0xd3: return self._op_out
+
+        return partial(self._op_not_implemented, op)
+
+
+    # handlers take registers as indices into State.registers and register
+    # pairs as pair indices (see State.reg_indices and State.pair_indices)
+
+    def _op_not_implemented(self, op):
+        raise NotImplementedError(f"Instruction not implemented: {op:X} ({byte_to_bits(op)})")
+
+    def _op_nop(self):
+        return 4
+
+    def _op_hlt(self):
+        return None
+
+    def _op_lda(self, address):
+        self.state.set_reg8(REG_A, self.state.get_ram(address))
+        return 13
+
+    def _op_sta(self, address):
+        self.state.set_ram(address, self.state.get_reg8(REG_A))
+        return 13
+
+    def _op_lhld(self, address):
+        self.state.set_reg8(REG_L, self.state.get_ram(address))
+        self.state.set_reg8(REG_H, self.state.get_ram(address+1))
+        return 16
+
+    def _op_shld(self, address):
+        self.state.set_ram(address, self.state.get_reg8(REG_L))
+        self.state.set_ram(address+1, self.state.get_reg8(REG_H))
+        return 16
+
+    def _op_mov_m_r(self, source):
+        self.state.set_ram(self.state.get_pair(PAIR_HL), self.state.get_reg8(source))
+        return 7
+
+    def _op_mov_r_m(self, dest):
+        self.state.set_reg8(dest, self.state.get_ram(self.state.get_pair(PAIR_HL)))
+        return 7
+
+    def _op_mov_r_r(self, source, dest):
+        self.state.set_reg8(dest, self.state.get_reg8(source))
+        return 5
+
+    def _op_mvi_m(self, value):
+        self.state.set_ram(self.state.get_pair(PAIR_HL), value)
+        return 10
+
+    def _op_xchg(self):
+        temp = self.state.get_pair(PAIR_DE)
+        self.state.set_pair(PAIR_DE, self.state.get_pair(PAIR_HL))
+        self.state.set_pair(PAIR_HL, temp)
+        return 4
+
+    def _op_lxi(self, pair, value):
+        self.state.set_pair(pair, value)
+        return 10
+
+    def _op_ldax(self, pair):
+        self.state.set_reg8(REG_A, self.state.get_ram(self.state.get_pair(pair)))
+        return 7
+
+    def _op_stax(self, pair):
+        self.state.set_ram(self.state.get_pair(pair), self.state.get_reg8(REG_A))
+        return 7
+
+    def _op_mvi_r(self, dest, value):
+        self.state.set_reg8(dest, value)
+        return 7
+
+    def _op_daa(self):
+        state = self.state
+        flags = state.flags
+        entry = ALU.DAA[((flags & FLAG_C) << 9) | ((flags & FLAG_A) << 4) | state.get_reg8(REG_A)]
+        state.set_reg8(REG_A, entry)
+        state.flags = (flags & ~(entry >> 16)) | ((entry >> 8) & 0xff)
+        return 4
+
+    # ALU operations - one table lookup each, see ALU
+
+    def _alu_arithmetic(self, table, index):
+        entry = table[index]
+        self.state.set_reg8(REG_A, entry)
+        self.state.flags = (self.state.flags & ~ALU.ALU_FLAGS) | (entry >> 8)
+
+    def _alu_add(self, value):
+        self._alu_arithmetic(ALU.ADD, (self.state.get_reg8(REG_A) << 8) | value)
+
+    def _alu_adc(self, value):
+        carry = self.state.flags & FLAG_C
+        self._alu_arithmetic(ALU.ADD, (carry << 16) | (self.state.get_reg8(REG_A) << 8) | value)
+
+    def _alu_sub(self, value):
+        self._alu_arithmetic(ALU.SUB, (self.state.get_reg8(REG_A) << 8) | value)
+
+    def _alu_sbb(self, value):
+        carry = self.state.flags & FLAG_C
+        self._alu_arithmetic(ALU.SUB, (carry << 16) | (self.state.get_reg8(REG_A) << 8) | value)
+
+    def _alu_cmp(self, value):
+        entry = ALU.SUB[(self.state.get_reg8(REG_A) << 8) | value]
+        self.state.flags = (self.state.flags & ~ALU.ALU_FLAGS) | (entry >> 8)
+
+    def _alu_logic(self, byte_result):
+        self.state.set_reg8(REG_A, byte_result)
+        self.state.flags = (self.state.flags & ~ALU.LOGIC_FLAGS) | ALU.SZP[byte_result]
+
+    def _alu_ana(self, value):
+        self._alu_logic(self.state.get_reg8(REG_A) & value)
+
+    def _alu_xra(self, value):
+        self._alu_logic(self.state.get_reg8(REG_A) ^ value)
+
+    def _alu_ora(self, value):
+        self._alu_logic(self.state.get_reg8(REG_A) | value)
+
+    def _op_alu_r(self, operation, source):
+        operation(self.state.get_reg8(source))
+        return 4
+
+    def _op_alu_m(self, operation):
+        operation(self.state.get_ram(self.state.get_pair(PAIR_HL)))
+        return 7
+
+    def _op_alu_data(self, operation, value):
+        operation(value)
+        return 7
+
+    def _op_inr_r(self, register, table):
+        entry = table[self.state.get_reg8(register)]
+        self.state.set_reg8(register, entry)
+        self.state.flags = (self.state.flags & ~ALU.INC_FLAGS) | (entry >> 8)
+        return 5
+
+    def _op_inr_m(self, table):
+        address = self.state.get_pair(PAIR_HL)
+        entry = table[self.state.get_ram(address)]
+        self.state.set_ram(address, entry & 0xff)
+        self.state.flags = (self.state.flags & ~ALU.INC_FLAGS) | (entry >> 8)
+        return 10
+
+    def _op_inx(self, pair, inc_by):
+        self.state.set_pair(pair, self.state.get_pair(pair) + inc_by)
+        return 5
+
+    def _op_dad(self, pair):
+        self._dad(pair)
+        return 10
+
+    def _op_rotate(self, operation):
+        operation()
+        return 4
+
+    def _op_cma(self):
+        self.state.set_reg8(REG_A, ~self.state.get_reg8(REG_A))
+        return 4
+
+    def _op_cmc(self):
+        self.state.flags ^= FLAG_C
+        return 4
+
+    def _op_stc(self):
+        self.state.flags |= FLAG_C
+        return 4
+
+    def _op_jmp(self, address):
+        self.state.set_pc(address)
+        return 10
+
+    def _op_jcond(self, mask, value, address):
+        if (self.state.flags & mask) == value:
+            self.state.set_pc(address)
+        return 10
+
+    def _op_call(self, address):
+        self._call(address)
+        return 17
+
+    def _op_ccond(self, mask, value, address):
+        if (self.state.flags & mask) == value:
+            self._call(address)
+            return 17
+        return 11
+
+    def _op_ret(self):
+        self._ret()
+        return 10
+
+    def _op_rcond(self, mask, value):
+        if (self.state.flags & mask) == value:
+            self._ret()
+            return 11
+        return 5
+
+    def _op_rst(self, address):
+        self._call(address)
+        return 11
+
+    def _op_pchl(self):
+        self.state.set_pc(self.state.get_pair(PAIR_HL))
+        return 5
+
+    def _op_pushpsw(self):
+        self._pushpsw()
+        return 11
+
+    def _op_push(self, pair):
+        self._push(pair)
+        return 11
+
+    def _op_poppsw(self):
+        self._poppsw()
+        return 10
+
+    def _op_pop(self, pair):
+        self._pop(pair)
+        return 10
+
+    def _op_xthl(self):
+        self._xthl()
+        return 18
+
+    def _op_sphl(self):
+        self.state.set_sp(self.state.get_pair(PAIR_HL))
+        return 5
+
+    def _op_ei(self):
+        return 4
+
+    def _op_di(self):
+        return 4
+
+    def _op_in(self, port):
+        self.state.set_reg8(REG_A, self.bus.read(port))
+        return 10
+
+    def _op_out(self, port):
+        self.bus.write(port, self.state.get_reg8(REG_A))
+        return 10
+
+
+    def _step_table(self, limit=None):
         # 1. Fetch instruction opcode, advance PC
-        else:
-            op = self._fetch_next_byte()
-        # 2. Decode, into list of bits
+        op = self._fetch_next_byte()
+        # 2. Decoded once at construction - dispatch straight to the handler
+        return self.dispatch_table[op]()
+
+
+    def predecode_rom(self, end:int):
+        # Decode 0x0000 up to end once, after the ROMs are loaded. Entries are
+        # (handler with its operand bound, length, operand, cycles); cycles
+        # are those of instruction_cycles. The range is write protected from
+        # now on (State.protect_rom), so the entries never go stale.
+        state = self.state
+        ram = state.ram
+        state.protect_rom(end)
+        self.rom = []
+        for pc in range(end):
+            op = ram[pc]
+            length = instruction_lengths[op]
+            if pc + length > end: # operand outside ROM, fetch it when run
+                self.rom.append((self.dispatch_table[op], 1, None, instruction_cycles[op]))
+                continue
+            handler = self.handlers[op]
+            operand = None
+            if length == 2:
+                operand = ram[pc + 1]
+            elif length == 3:
+                operand = ram[pc + 1] | (ram[pc + 2] << 8)
+            if operand is not None:
+                handler = partial(handler, operand)
+            self.rom.append((handler, length, operand, instruction_cycles[op]))
+        self.rom_end = end
+        if self.config['engine'] == 'table':
+            self._step = self._step_predecoded
+
+
+    def _step_predecoded(self, limit=None):
+        # ROM runs from the predecoded entries, RAM is fetched and decoded
+        state = self.state
+        pc = state.pc
+        if pc < self.rom_end:
+            handler, length, _, _ = self.rom[pc]
+            state.pc = pc + length
+            return handler()
+        return self._step_table()
+
+
+    def _step_reference(self, limit=None):
+        # 1. Fetch instruction opcode, advance PC
+        return self._execute(self._fetch_next_byte())
+
+
+    def _execute(self, op):
+        if self.config['engine'] != 'reference':
+            return self.dispatch_table[op]()
+        # 2. Decode, into list of bits (reference engine)
         instruction_bits = byte_to_bits(op)
         try:
             used_cycles = self._run(instruction_bits)
@@ -599,3 +1109,94 @@ class CPU():
             raise NotImplementedError(f"Instruction not implemented: {op:X} ({instruction_bits})")
         return used_cycles
 
+
+    def run_cycle(self, rst=None):
+        # interrupt
+        if rst:
+            return self._interrupt(rst)
+        # one instruction, or one translated block with the recompiler
+        return self._step()
+
+
+    def start_trace(self, tracer):
+        # Records every instruction run from now on, see Trace.Tracer
+        self._instrument(tracer)
+
+    def stop_trace(self):
+        # the tracer is left open, for the caller to close
+        self._uninstrument()
+
+    def start_profile(self, profiler):
+        # Counts and times every instruction run from now on, see Profiler
+        self._instrument(profiler)
+
+    def stop_profile(self):
+        profiler = self.instrument
+        self._uninstrument()
+        if profiler:
+            profiler.stop()
+
+    def _instrument(self, instrument):
+        # Swaps in the instrument's step and interrupt functions, so the plain
+        # ones carry no checks. One instrument at a time; translated blocks
+        # are not used while instrumented.
+        self._uninstrument()
+        self.instrument = instrument
+        self.plain_step = self._step
+        step = self._step_table if self.recompiler else self._step
+        self._step, self._interrupt = instrument.wrap(self, step)
+
+    def _uninstrument(self):
+        if self.instrument:
+            self._step = self.plain_step
+            self._interrupt = self._execute
+            self.instrument = None
+
+
+    def run_until(self, target_cycles, events=(), breakpoints=None):
+        # Run until target_cycles have been used, in one loop.
+        # events: (cycle, opcode) pairs - each opcode (an RST) is injected as an
+        #         interrupt once the cycle count reaches its cycle.
+        # breakpoints: PCs to stop in front of. The instruction at the starting
+        #              PC always runs, so a stopped run can simply be resumed.
+        # Returns (cycles used, stop reason). Events not yet delivered when the
+        # run stops early are dropped.
+        step = self._step
+        if breakpoints and self.recompiler:
+            # a translated block would run straight past a breakpoint inside it
+            step = self._step_table
+        execute = self._interrupt
+        state = self.state
+        events = sorted(events)
+        event_index = 0
+        next_event = events[0][0] if events else None
+        cycles = 0
+
+        while cycles < target_cycles:
+            # the recompiler needs to know how far it may run in one block
+            boundary = target_cycles if next_event is None else min(next_event, target_cycles)
+            used = step(boundary - cycles)
+            if used is None:
+                return cycles, self.STOP_HALT
+            if used < 0: # handler asked for a break
+                return cycles - used, self.STOP_BREAKPOINT
+            cycles += used
+
+            # Interrupts here
+            while next_event is not None and cycles >= next_event:
+                cycles += execute(events[event_index][1])
+                event_index += 1
+                next_event = events[event_index][0] if event_index < len(events) else None
+
+            if breakpoints and state.pc in breakpoints:
+                return cycles, self.STOP_BREAKPOINT
+
+        return cycles, self.STOP_CYCLES
+
+
+    def run_frame(self, cycles_per_frame):
+        # One video frame: RST 1 at mid-screen, RST 2 at vblank
+        return self.run_until(cycles_per_frame, [
+            (cycles_per_frame // 2, self.RST_MIDSCREEN),
+            (cycles_per_frame, self.RST_VBLANK),
+        ])
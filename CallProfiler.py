@@ -0,0 +1,154 @@
+from opcodebytes import Opcodebytes
+
+# Emulated call stack profile (CPU.start_profile): follows CALL, RST and RET,
+# and interrupts, to keep a shadow stack of the ROM routines running, and
+# adds up the emulated cycles spent under each stack. Written as collapsed
+# stacks - one "outer;inner;innermost cycles" line per stack - for
+# flamegraph.pl, speedscope, inferno and the like:
+#
+#   profiler = CallProfiler(load_labels('invaders.labels'))
+#   cpu.start_profile(profiler)
+#   ...run...
+#   cpu.stop_profile()
+#   profiler.write_collapsed('invaders.folded')
+#
+# Routines are named from the labels, {address: name}, or by address.
+# Interrupt handlers are marked with " (interrupt)".
+#
+# A routine is left when a return moves SP past where its return address
+# was pushed, so code that drops a return address or resets SP unwinds on
+# the next return further out.
+
+CALL, RETURN = 1, 2
+branch_kinds = [0] * 256
+for _op in [Opcodebytes.CALL] + [0xc4 | condition << 3 for condition in range(8)]:
+    branch_kinds[_op] = CALL
+for _op in [0xc7 | vector << 3 for vector in range(8)]: # RST
+    branch_kinds[_op] = CALL
+for _op in [Opcodebytes.RET] + [0xc0 | condition << 3 for condition in range(8)]:
+    branch_kinds[_op] = RETURN
+
+ROOT = (None, False) # the code running at reset
+
+
+def load_labels(filename) -> dict[int, str]:
+    # Text file of "address name" lines, the address in hex, e.g.
+    # "01e4 DrawSprite". Blank lines and # comments are ignored.
+    labels = {}
+    with open(filename) as file:
+        for line in file:
+            line = line.split('#')[0].strip()
+            if line:
+                address, name = line.split(maxsplit=1)
+                labels[int(address, 16)] = name
+    return labels
+
+
+class CallProfiler():
+
+    def __init__(self, labels:dict[int, str]=None, max_depth=64):
+        self.labels = labels or {}
+        self.max_depth = max_depth
+        self.stacks = {(ROOT,): 0} # stack of (address, interrupt) frames -> index
+        self.cycles = [0]          # by stack index
+        self.frames = [(ROOT, 0x10000)] # shadow stack: (frame, SP at its return address)
+
+    def wrap(self, cpu, step):
+        # the CPU's step function and one for interrupts, following calls
+        state = cpu.state
+        ram = state.ram
+        execute = cpu._execute
+        cycles = self.cycles
+        kinds = branch_kinds
+        current = self.stacks[self._key()]
+
+        def profiled_step(limit=None):
+            nonlocal current
+            kind = kinds[ram[state.pc]]
+            sp = state.sp
+            used = step()
+            if used:
+                cycles[current] += abs(used)
+            if kind and state.sp != sp:
+                if kind == CALL:
+                    current = self._enter((state.pc, False), state.sp)
+                else:
+                    current = self._leave(state.sp)
+            return used
+
+        def profiled_interrupt(op):
+            nonlocal current
+            used = execute(op)
+            current = self._enter((state.pc, True), state.sp)
+            cycles[current] += used
+            return used
+
+        return profiled_step, profiled_interrupt
+
+    def stop(self):
+        pass
+
+
+    def _key(self):
+        return tuple(frame for frame, _ in self.frames)
+
+    def _index(self):
+        key = self._key()
+        index = self.stacks.get(key)
+        if index is None:
+            index = self.stacks[key] = len(self.cycles)
+            self.cycles.append(0)
+        return index
+
+    def _enter(self, frame, sp):
+        self.frames.append((frame, sp))
+        if len(self.frames) > self.max_depth:
+            del self.frames[1] # keep the root
+        return self._index()
+
+    def _leave(self, sp):
+        # pops the frames whose return address is now off the stack
+        frames = self.frames
+        while len(frames) > 1 and frames[-1][1] < sp:
+            frames.pop()
+        return self._index()
+
+
+    def frame_name(self, frame) -> str:
+        address, interrupt = frame
+        if address is None:
+            return 'reset'
+        name = self.labels.get(address, f"{address:04X}")
+        return name + " (interrupt)" if interrupt else name
+
+    def collapsed(self) -> list[tuple[str, int]]:
+        # ("outer;inner", cycles) for every stack that used cycles
+        return [(';'.join(self.frame_name(frame) for frame in key), self.cycles[index])
+                for key, index in self.stacks.items() if self.cycles[index]]
+
+    def write_collapsed(self, filename):
+        with open(filename, 'w') as file:
+            for stack, cycles in sorted(self.collapsed()):
+                file.write(f"{stack} {cycles}\n")
+
+    def routines(self) -> list[dict]:
+        # per routine: cycles in it (self) and in it or what it called
+        # (total), most total first; a recursive routine counts once a stack
+        routines = {}
+        for key, index in self.stacks.items():
+            cycles = self.cycles[index]
+            if not cycles:
+                continue
+            names = [self.frame_name(frame) for frame in key]
+            for name in set(names):
+                routines.setdefault(name, {'name': name, 'self': 0, 'total': 0})['total'] += cycles
+            routines[names[-1]]['self'] += cycles
+        return sorted(routines.values(), key=lambda routine: routine['total'], reverse=True)
+
+    def report(self, top=20) -> str:
+        total = sum(self.cycles) or 1
+        lines = [f"{'routine':<24} {'total %':>8} {'self %':>7}"]
+        for routine in self.routines()[:top]:
+            lines.append(f"{routine['name']:<24} {100 * routine['total'] / total:>8.1f} "
+                         f"{100 * routine['self'] / total:>7.1f}")
+        return '\n'.join(lines)
@@ -0,0 +1,185 @@
+import multiprocessing
+import struct
+import time
+from multiprocessing import shared_memory
+from State import State
+from Machine import Machine
+from CPU import CPU
+
+# Runs the Machine in a worker process, so emulation and the UI (events,
+# rendering, sound) do not share one interpreter.
+#
+# core process                           UI process
+#   run_core: frame, publish VRAM  --->  Framebuffer (shared memory)
+#             port 1 bitmask       <---  CoreProcess.set_input  (pipe)
+#             sounds played        --->  CoreProcess.poll_sounds (pipe)
+
+VRAM_SIZE = Machine.VRAM_END - Machine.VRAM_START
+
+# The UI has pygame running by the time the core starts, and forking a process
+# with SDL's threads can hang the child, so start it fresh
+context = multiprocessing.get_context('spawn')
+
+# shared memory: header, then two VRAM buffers
+# header: frame number of the newest buffer (uint64), which buffer that is (byte)
+FRAME_FORMAT = '<Q'
+FRONT_OFFSET = 8
+HEADER_SIZE = 16
+
+
+class Framebuffer():
+    # VRAM double buffer in shared memory. The core writes a frame into the
+    # back buffer, then flips the front index and bumps the frame number.
+
+    def __init__(self, name=None):
+        # no name: create the block, otherwise attach to an existing one
+        self.owner = name is None
+        self.memory = shared_memory.SharedMemory(
+            name=name, create=self.owner, size=HEADER_SIZE + 2*VRAM_SIZE if self.owner else 0)
+        self.name = self.memory.name
+        self.buffer = self.memory.buf
+
+    def frame(self) -> int:
+        return struct.unpack_from(FRAME_FORMAT, self.buffer, 0)[0]
+
+    def publish(self, vram, frame:int):
+        back = 1 - self.buffer[FRONT_OFFSET]
+        start = HEADER_SIZE + back*VRAM_SIZE
+        self.buffer[start:start + VRAM_SIZE] = vram
+        self.buffer[FRONT_OFFSET] = back
+        struct.pack_into(FRAME_FORMAT, self.buffer, 0, frame)
+
+    def read(self, into) -> int:
+        # Copy the newest frame into the writable buffer into, and return its
+        # frame number. If the core published twice during the copy it may
+        # have overwritten the buffer being read, so copy again.
+        while True:
+            frame = self.frame()
+            start = HEADER_SIZE + self.buffer[FRONT_OFFSET]*VRAM_SIZE
+            into[:] = self.buffer[start:start + VRAM_SIZE]
+            if self.frame() <= frame + 1:
+                return frame
+
+    def close(self):
+        self.buffer = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class SoundLatch():
+    # Stands in for the Soundboard in the core: collects the sounds a frame
+    # played as a bitmask, for the UI process to play
+    def __init__(self):
+        self.played = 0
+
+    def play(self, sound_index):
+        self.played |= 1 << sound_index
+
+    def take(self) -> int:
+        played, self.played = self.played, 0
+        return played
+
+
+def run_core(rom_image:bytes, config:dict, framebuffer_name:str, connection, throttle=True):
+    # Worker process body. Messages from the UI: a port 1 bitmask (int) or
+    # None to stop. Messages to the UI: a bitmask of sounds played.
+    framebuffer = Framebuffer(framebuffer_name)
+    sounds = SoundLatch()
+    machine = Machine(sounds, config)
+    machine.load_rom_image(rom_image)
+    vram = memoryview(machine.state.ram)[Machine.VRAM_START:Machine.VRAM_END]
+    frame_time = 1 / Machine.FPS
+    next_frame = time.perf_counter()
+
+    try:
+        while True:
+            while connection.poll():
+                message = connection.recv()
+                if message is None:
+                    return
+                machine.set_input(message)
+
+            stop_reason = machine.run_frame()
+            framebuffer.publish(vram, machine.frames)
+            played = sounds.take()
+            if played:
+                connection.send(played)
+            if stop_reason == CPU.STOP_HALT:
+                return
+
+            if throttle:
+                next_frame += frame_time
+                delay = next_frame - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -frame_time * 4:
+                    next_frame = time.perf_counter() # too far behind to catch up
+    finally:
+        vram.release()
+        framebuffer.close()
+        connection.close()
+
+
+class CoreProcess():
+    # UI side of a core running in a worker process
+
+    def __init__(self, rom_image:bytes, config={}, throttle=True):
+        self.framebuffer = Framebuffer()
+        self.connection, core_connection = context.Pipe()
+        self.process = context.Process(
+            target=run_core, daemon=True,
+            args=(rom_image, config, self.framebuffer.name, core_connection, throttle))
+        self.port1 = None
+        self.frame = 0
+        self.vram = bytearray(VRAM_SIZE)
+
+    def start(self):
+        self.process.start()
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    def set_input(self, port1:int):
+        # only changes go down the pipe
+        if port1 != self.port1 and self.is_alive():
+            self.connection.send(port1)
+            self.port1 = port1
+
+    def poll_sounds(self) -> list[int]:
+        # sound indices played since the last call
+        played = 0
+        while self.connection.poll():
+            try:
+                played |= self.connection.recv()
+            except EOFError:
+                break
+        return [index for index in range(played.bit_length()) if played >> index & 1]
+
+    def read_frame(self, state:State) -> bool:
+        # Copy the newest published frame into state's VRAM, writing only the
+        # rows that changed so the display redraws only those. False if no
+        # new frame was published since the last call.
+        if self.framebuffer.frame() == self.frame:
+            return False
+        self.frame = self.framebuffer.read(self.vram)
+        row_bytes = State.VRAM_ROW_BYTES
+        for offset in range(0, VRAM_SIZE, row_bytes):
+            row = self.vram[offset:offset + row_bytes]
+            address = Machine.VRAM_START + offset
+            if state.ram[address:address + row_bytes] != row:
+                state.set_ram(address, row)
+        return True
+
+    def stop(self):
+        if self.is_alive():
+            try:
+                self.connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.join(timeout=2)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+        self.framebuffer.close()
@@ -0,0 +1,178 @@
+import struct
+import zlib
+from array import array
+from CPU import instruction_lengths
+from opcodebytes import Opcodebytes
+from State import State
+
+# Execution coverage and memory traffic (CPU.start_profile): counts per
+# address, over all 16K, of instructions executed there and of bytes read
+# and written there. Executions are counted in the CPU's step, reads and
+# writes by State as the handlers make them (State.start_counting).
+#
+#   coverage = Coverage()
+#   cpu.start_profile(coverage)
+#   ...run, calling coverage.end_frame() after each frame...
+#   cpu.stop_profile()
+#   coverage.write_disassembly('rom.asm')   # dead code shows as "-"
+#   coverage.write_heatmap('traffic.png')   # needs numpy
+#   coverage.summary()                      # VRAM vs work RAM
+#
+# Instruction fetches count as executions, not reads. The heatmap keeps at
+# most max_rows rows: when they fill, pairs are merged, so a row covers
+# twice the frames, and a whole session fits in the same memory.
+
+MEMORY_SIZE = State.MEMORY_SIZE
+REGIONS = {
+    'rom': (0x0000, 0x2000),
+    'work_ram': (0x2000, State.VRAM_START),
+    'vram': (State.VRAM_START, MEMORY_SIZE),
+}
+BLOCK = 64 # bytes per heatmap column
+
+opcode_names = {value: name for name, value in vars(Opcodebytes).items() if name.isupper()}
+
+
+class Coverage():
+
+    def __init__(self, max_rows=512):
+        self.executed = array('Q', bytes(8 * MEMORY_SIZE))
+        self.reads = array('Q', bytes(8 * MEMORY_SIZE))
+        self.writes = array('Q', bytes(8 * MEMORY_SIZE))
+        self.max_rows = max_rows # even
+        self.traffic = None  # (max_rows, 2, blocks) reads and writes per row (numpy)
+        self.rows = 0        # complete rows in traffic
+        self.frames_per_row = 1
+        self.row_frames = 0  # frames in the row being filled
+        self.frames = 0
+        self.last_totals = None
+        self.state = None   # the CPU's, while counting
+        self.ram = None     # the CPU's, for the disassembly
+        self.rom_end = 0x2000
+
+    def wrap(self, cpu, step):
+        # the CPU's step function and its interrupt function, counting
+        # executions; State counts the reads and writes
+        state = cpu.state
+        ram = state.ram
+        executed = self.executed
+        self.state = state
+        self.ram = ram
+        self.rom_end = cpu.rom_end or self.rom_end
+        state.start_counting(self.reads, self.writes)
+
+        def counted_step(limit=None):
+            executed[state.pc] += 1
+            return step()
+
+        return counted_step, cpu._execute
+
+    def stop(self):
+        if self.state:
+            self.state.stop_counting()
+            self.state = None
+
+    def end_frame(self):
+        # Adds the frame's reads and writes per block to the heatmap.
+        import numpy as np
+        blocks = MEMORY_SIZE // BLOCK
+        if self.traffic is None:
+            self.traffic = np.zeros((self.max_rows, 2, blocks), dtype=np.uint64)
+        totals = np.stack([np.frombuffer(self.reads, np.uint64),
+                           np.frombuffer(self.writes, np.uint64)]).reshape(
+                               2, blocks, BLOCK).sum(axis=2)
+        previous = self.last_totals if self.last_totals is not None else 0
+        self.traffic[self.rows] += totals - previous
+        self.last_totals = totals
+        self.frames += 1
+        self.row_frames += 1
+        if self.row_frames == self.frames_per_row:
+            self.rows += 1
+            self.row_frames = 0
+            if self.rows == self.max_rows:
+                half = self.max_rows // 2
+                self.traffic[:half] = self.traffic[0::2] + self.traffic[1::2]
+                self.traffic[half:] = 0
+                self.rows = half
+                self.frames_per_row *= 2
+
+    def summary(self) -> dict:
+        # per region: bytes executed, reads, writes, and share of all accesses
+        total = sum(self.reads) + sum(self.writes) or 1
+        summary = {}
+        for name, (start, end) in REGIONS.items():
+            reads = sum(self.reads[start:end])
+            writes = sum(self.writes[start:end])
+            summary[name] = {
+                'executed_addresses': sum(1 for count in self.executed[start:end] if count),
+                'reads': reads,
+                'writes': writes,
+                'access_percent': 100 * (reads + writes) / total,
+            }
+        return summary
+
+    def disassembly(self, ram=None, start=0, end=None) -> list[str]:
+        # Annotated listing of start to end, by default the CPU's ROM:
+        # executions, reads, address, bytes and instruction. A linear sweep,
+        # resynchronised where an operand byte turns out to have been executed.
+        ram = ram if ram is not None else self.ram
+        end = end if end is not None else self.rom_end
+        lines = []
+        address = start
+        while address < end:
+            op = ram[address]
+            length = min(instruction_lengths[op], end - address)
+            if any(self.executed[address + offset] for offset in range(1, length)):
+                length = 1 # data, or code run from part way in
+            if length == instruction_lengths[op] and op in opcode_names:
+                operand = ram[address + 1:address + length][::-1].hex()
+                instruction = f"{opcode_names[op]} {operand}".rstrip()
+            else:
+                instruction = f"DB {op:02X}"
+            executed = self.executed[address]
+            lines.append(f"{executed if executed else '-':>10} {self.reads[address] or '':>8}  "
+                         f"{address:04X}  {ram[address:address + length].hex(' '):<8}  "
+                         f"{instruction}")
+            address += length
+        return lines
+
+    def write_disassembly(self, filename, ram=None, start=0, end=None):
+        with open(filename, 'w') as file:
+            file.write(f"{'executed':>10} {'reads':>8}  addr  bytes     instruction\n")
+            for line in self.disassembly(ram, start, end):
+                file.write(line + '\n')
+
+    def heatmap(self):
+        # (rows, 16384 / BLOCK, 3) uint8 image: a row per frames_per_row
+        # frames, one column per BLOCK bytes; red is writes, green reads,
+        # per frame and log scaled
+        import numpy as np
+        rows = self.rows + (1 if self.row_frames else 0)
+        if not rows:
+            return np.zeros((0, MEMORY_SIZE // BLOCK, 3), dtype=np.uint8)
+        frames = np.full(rows, self.frames_per_row, dtype=np.float64)
+        if self.row_frames:
+            frames[-1] = self.row_frames
+        traffic = np.log1p(self.traffic[:rows] / frames[:, None, None]) # rows, 2, blocks
+        scale = traffic.max() or 1.0
+        image = np.zeros((rows, MEMORY_SIZE // BLOCK, 3), dtype=np.uint8)
+        image[:, :, 0] = traffic[:, 1] / scale * 255
+        image[:, :, 1] = traffic[:, 0] / scale * 255
+        return image
+
+    def write_heatmap(self, filename):
+        write_png(filename, self.heatmap())
+
+
+def write_png(filename, image):
+    # image: (height, width, 3) uint8; an 8-bit RGB PNG, no filtering
+    height, width, _ = image.shape
+    rows = b''.join(b'\x00' + image[row].tobytes() for row in range(height))
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data)))
+    with open(filename, 'wb') as file:
+        file.write(b'\x89PNG\r\n\x1a\n')
+        file.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        file.write(chunk(b'IDAT', zlib.compress(rows)))
+        file.write(chunk(b'IEND', b''))
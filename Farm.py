@@ -0,0 +1,149 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from CPU import CPU
+from Machine import Machine, load_input_script
+
+# Runs many headless games at once in a process pool, one worker per core,
+# for play-testing and score checks. The ROM image is read once here and
+# handed to each worker when it starts, not with every job.
+#
+# A job is a dict:
+#   name       - label for the results (default the job's index)
+#   frames     - frame budget
+#   script     - {frame: port 1 bitmask}, as Machine.load_input_script reads
+#   config     - Machine config, e.g. {'engine': 'recompiler'}
+#   hash_every - VRAM hash every this many frames (default 1, 0 for none)
+
+rom_image = None # per worker, set by init_worker
+
+# spawned rather than forked: callers may have pygame running, and a forked
+# child can hang on SDL's threads
+context = multiprocessing.get_context('spawn')
+
+
+def init_worker(image:bytes):
+    global rom_image
+    rom_image = image
+
+
+def run_instance(job:dict) -> dict:
+    machine = Machine(config=job.get('config', {}))
+    machine.load_rom_image(rom_image)
+    script = job.get('script') or {}
+    hash_every = job.get('hash_every', 1)
+    frame_hashes = []
+    halted = False
+
+    start = time.perf_counter()
+    for frame in range(job['frames']):
+        if frame in script:
+            machine.set_input(script[frame])
+        if machine.run_frame() == CPU.STOP_HALT:
+            halted = True
+            break
+        if hash_every and machine.frames % hash_every == 0:
+            frame_hashes.append(machine.vram_hash())
+    seconds = time.perf_counter() - start
+
+    return {
+        'frames': machine.frames,
+        'cycles': machine.cycles,
+        'seconds': seconds,
+        'fps': machine.frames / seconds,
+        'mhz': machine.cycles / seconds / 1_000_000,
+        'halted': halted,
+        'scores': machine.scores(),
+        'vram_hash': machine.vram_hash(),
+        'frame_hashes': frame_hashes,
+    }
+
+
+def run_job(indexed_job) -> dict:
+    # a failing job is reported in its result and does not stop the others
+    index, job = indexed_job
+    result = {'job': index, 'name': job.get('name', str(index))}
+    try:
+        result.update(run_instance(job))
+    except Exception:
+        result['error'] = traceback.format_exc()
+    return result
+
+
+def run_farm(jobs:list[dict], rom_image:bytes, workers:int=None):
+    # Yields each job's result as soon as it finishes, so in no fixed order -
+    # result['job'] is the job's index in jobs.
+    workers = min(workers or os.cpu_count() or 1, len(jobs)) or 1
+    with context.Pool(workers, initializer=init_worker, initargs=(rom_image,)) as pool:
+        yield from pool.imap_unordered(run_job, enumerate(jobs))
+
+
+def format_result(result:dict) -> str:
+    if 'error' in result:
+        return f"{result['name']}: failed\n{result['error']}"
+    scores = result['scores']
+    return (f"{result['name']}: {result['frames']} frames in {result['seconds']:.2f}s "
+            f"({result['fps']:.1f} frames/sec, {result['mhz']:.3f} MHz), "
+            f"scores {scores['player1']}/{scores['player2']} high {scores['high']}, "
+            f"VRAM {result['vram_hash'][:12]}"
+            + (" (halted)" if result['halted'] else ""))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python Farm.py',
+                                     description="Run many headless games in parallel.")
+    parser.add_argument('--frames', type=int, default=3600, help="frames per game (default 3600)")
+    parser.add_argument('--input', metavar='SCRIPT', action='append', default=[],
+                        help="input script of 'frame port1' lines; one game per script, "
+                             "repeat the option for more")
+    parser.add_argument('--instances', type=int,
+                        help="number of games, cycling through the scripts "
+                             "(default one per script)")
+    parser.add_argument('--workers', type=int, help="processes (default one per core)")
+    parser.add_argument('--roms', default=Machine.ROM_DIR,
+                        help="directory holding invaders.h/g/f/e")
+    parser.add_argument('--engine', default='table', choices=['table', 'recompiler', 'reference'])
+    parser.add_argument('--hash-every', type=int, default=1,
+                        help="VRAM hash every N frames, 0 for the final one only")
+    parser.add_argument('--output', metavar='FILE',
+                        help="write each result as a JSON line when it finishes")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    scripts = [(os.path.basename(filename), load_input_script(filename)) for filename in args.input]
+    scripts = scripts or [('no-input', {})]
+    instances = args.instances or len(scripts)
+    jobs = []
+    for index in range(instances):
+        script_name, script = scripts[index % len(scripts)]
+        jobs.append({
+            'name': f"{index}:{script_name}",
+            'frames': args.frames,
+            'script': script,
+            'config': {'engine': args.engine},
+            'hash_every': args.hash_every,
+        })
+
+    failed = 0
+    output = open(args.output, 'w') if args.output else None
+    try:
+        for result in run_farm(jobs, Machine.read_roms(args.roms), args.workers):
+            print(format_result(result), flush=True)
+            failed += 'error' in result
+            if output:
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+    finally:
+        if output:
+            output.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -28,6 +28,8 @@ class Keyboard():
         pygame.K_s:     4,
         }
 
+    rewind_key = pygame.K_BACKSPACE
+
     bustable = {
         # key: (port, bit)
         0: (1, 5),
@@ -47,7 +49,18 @@ class Keyboard():
         self.current_state = [False] * 16
         self.request_quit = False
         self.request_pause = False
+        self.rewinding = False # rewind key held, see Rewind
+        self.recording = None # port 1 once a frame, see start_recording
     
+    def start_recording(self):
+        # from now on record_frame keeps port 1, for Recording.save_recording
+        self.recording = bytearray()
+
+    def record_frame(self):
+        # call once for every frame the machine runs
+        if self.recording is not None:
+            self.recording.append(self.bus.state.get_readbus(1))
+
     def clear_pause_request(self):
         self.request_pause = False
 
@@ -60,6 +73,8 @@ class Keyboard():
                 self.request_quit = True
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
                 self.request_pause = True
+            elif event.type in (pygame.KEYDOWN, pygame.KEYUP) and event.key == self.rewind_key:
+                self.rewinding = event.type == pygame.KEYDOWN
             elif event.type == pygame.KEYDOWN and event.key in self.keytable:
                 self.current_state[self.keytable[event.key]] = True
                 update = True
@@ -0,0 +1,103 @@
+import hashlib
+import os
+from State import State
+from Bus import Bus
+from CPU import CPU
+from Soundboard import Soundboard
+
+
+class Machine():
+    # The Space Invaders board without any pygame front end: CPU, memory,
+    # shift register and ports. Used for the windowed game as well as for
+    # headless runs.
+
+    FPS = 60 # Frames per second
+    CPF = 2_000_000 // FPS # cycles per frame on a 2MHz 8080
+    ROMSTART = 0x0000
+    VRAM_START = 0x2400
+    VRAM_END = 0x4000
+
+    ROM_DIR = 'roms'
+    ROM_FILES = [
+        'invaders.h', # 0000-07FF
+        'invaders.g', # 0800-0FFF
+        'invaders.f', # 1000-17FF
+        'invaders.e', # 1800-1FFF
+    ]
+    ROM_SIZE = 0x800 * len(ROM_FILES)
+
+    # scores the game keeps in RAM, 4 BCD digits stored low byte first
+    SCORE_ADDRESSES = {
+        'player1': 0x20F8,
+        'player2': 0x20FC,
+        'high': 0x20F4,
+    }
+    LIVES_ADDRESS = 0x21FF # player 1 ships left
+
+    def __init__(self, soundboard:Soundboard=None, config={}):
+        self.state = State(romstart=self.ROMSTART)
+        self.bus = Bus(self.state, soundboard)
+        self.cpu = CPU(self.state, self.bus, config)
+        self.frames = 0
+        self.cycles = 0
+
+
+    @classmethod
+    def read_roms(cls, rom_dir=ROM_DIR) -> bytes:
+        # the four program ROMs as one 8K image
+        image = b''
+        for filename in cls.ROM_FILES:
+            with open(os.path.join(rom_dir, filename), 'rb') as file:
+                image += file.read()
+        return image
+
+    def load_roms(self, rom_dir=ROM_DIR):
+        self.load_rom_image(self.read_roms(rom_dir))
+
+    def load_rom_image(self, image:bytes):
+        self.state.set_ram(self.ROMSTART, image)
+        self.cpu.predecode_rom(self.ROMSTART + len(image))
+
+
+    def set_input(self, port1:int):
+        # port 1 bitmask, as Keyboard would set it
+        self.state.set_readbus(1, port1 & 0xff)
+
+    def run_frame(self):
+        # returns the CPU stop reason
+        cycles, stop_reason = self.cpu.run_frame(self.CPF)
+        self.frames += 1
+        self.cycles += cycles
+        return stop_reason
+
+
+    def scores(self) -> dict[str, int]:
+        scores = {}
+        for name, address in self.SCORE_ADDRESSES.items():
+            score = 0
+            for byte in reversed(self.state.get_ram(address, address + 2)):
+                score = score*100 + (byte >> 4)*10 + (byte & 0x0f)
+            scores[name] = score
+        return scores
+
+    def lives(self) -> int:
+        return self.state.ram[self.LIVES_ADDRESS]
+
+    def vram(self) -> bytes:
+        return self.state.get_ram(self.VRAM_START, self.VRAM_END)
+
+    def vram_hash(self) -> str:
+        return hashlib.sha1(self.vram()).hexdigest()
+
+
+def load_input_script(filename) -> dict[int, int]:
+    # Text file of "frame port1" lines, e.g. "120 0x01" - from frame 120 on,
+    # port 1 reads 0x01. Blank lines and # comments are ignored.
+    script = {}
+    with open(filename) as file:
+        for line in file:
+            line = line.split('#')[0].strip()
+            if line:
+                frame, port1 = line.split()
+                script[int(frame, 0)] = int(port1, 0)
+    return script
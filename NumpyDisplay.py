@@ -19,8 +19,35 @@ class Display():
     GREEN_CELLO = (20, 204, 96, 150)
     RED_CELLO = (255, 31, 31, 150)
 
-
-    def __init__(self, state: State):
+    # Cellophane gels stuck on the monitor, as (x, y, width, height) of the
+    # unrotated screen and an RGBA color. Other boards pass their own layout.
+    OVERLAY = [
+        ((0, 0, 20, 70), GREEN_CELLO),   # lives and credits
+        ((20, 0, 20, 224), GREEN_CELLO), # player and shields
+        ((200, 0, 20, 224), RED_CELLO),  # flying saucer
+    ]
+
+    PIXEL_ON = (255, 255, 255)
+    PIXEL_OFF = (0, 0, 0)
+
+    # CRT glow, cheapest first:
+    #  off   - none
+    #  cheap - a 2x2 box blur of the native screen, blended in before scaling
+    #  full  - a blur of the scaled screen, blended at window resolution
+    GLOW_LEVELS = ['off', 'cheap', 'full']
+    GLOW_ALPHA = 100
+    GLOW_MARGINS = {'off': 0, 'cheap': 4, 'full': 4} # window pixels a changed row spreads by
+
+    # adaptive glow: drop a level after DEGRADE_AFTER frames over budget, go
+    # back up after RECOVER_AFTER frames under RECOVER_HEADROOM of the budget
+    FRAME_BUDGET = 1000 / 60 # ms
+    DEGRADE_AFTER = 10
+    RECOVER_AFTER = 120
+    RECOVER_HEADROOM = 0.6
+
+
+    def __init__(self, state: State, overlay=None, glow='full', adaptive=True,
+                 frame_budget=FRAME_BUDGET):
         pygame.init()
 
         self.fps = None
@@ -33,14 +60,69 @@ class Display():
         pygame.display.set_caption("Space Invaders")
         pygame.display.flip()
 
-        self.pixel_surface = pygame.Surface((self.WIDTH, self.HEIGHT), pygame.SRCALPHA)
-
-        # Create cellophane overlay
-        self.overlay_surface = pygame.Surface((self.WIDTH, self.HEIGHT), pygame.SRCALPHA)
-        self.overlay_surface.fill(self.WHITE)
-        draw_rect_alpha(self.overlay_surface, self.GREEN_CELLO, (0, 0, 20, 70))
-        draw_rect_alpha(self.overlay_surface, self.GREEN_CELLO, (20, 0, 20, 224))
-        draw_rect_alpha(self.overlay_surface, self.RED_CELLO, (200, 0, 20, 224))
+        # Everything a frame needs is allocated here, once.
+        # The screen is kept rotated to the cabinet's portrait orientation:
+        # VRAM row y is column y, with the bytes of the row running bottom to top.
+        self.screen_size = (self.HEIGHT*2, self.WIDTH*3)
+        self.native_surface = pygame.Surface((self.HEIGHT, self.WIDTH), depth=32)
+        # last scaled and glowing screen, for redrawing parts of the window
+        self.screen_surface = pygame.Surface(self.screen_size, depth=32)
+        self.screen_surface.fill(self.BLACK)
+        self.glow_small = pygame.Surface((self.HEIGHT, self.WIDTH), depth=32)
+        self.glow_surface = pygame.Surface(self.screen_size, depth=32)
+        self.glow_surface.set_alpha(self.GLOW_ALPHA)
+        # cheap glow, all at native resolution
+        self.composite_surface = pygame.Surface((self.HEIGHT, self.WIDTH), depth=32)
+        self.native_small = pygame.Surface((self.HEIGHT // 2, self.WIDTH // 2), depth=32)
+        self.native_glow = pygame.Surface((self.HEIGHT, self.WIDTH), depth=32)
+        self.native_glow.set_alpha(self.GLOW_ALPHA)
+
+        if glow not in self.GLOW_LEVELS:
+            raise ValueError(f"Unknown glow level: {glow}")
+        self.glow = glow
+        self.max_glow = glow # adaptive glow never goes above the chosen level
+        self.adaptive = adaptive
+        self.frame_budget = frame_budget
+        self.slow_frames = 0
+        self.fast_frames = 0
+        self.fps_rect = pygame.Rect(10, 10, 0, 0)
+        self.fps_text = None
+        self.fps_text_surface = None
+
+        # (row band, byte position, byte) -> its 8 pixels as surface colors,
+        # highest bit first. Byte positions count from the end of the row, so
+        # reading a row's bytes backwards gives the column top to bottom, and
+        # each pixel takes the color of the gel over it. Rows under the same
+        # gels share a band.
+        gels = self._gel_colors(self.OVERLAY if overlay is None else overlay)
+        bands, row_bands = np.unique(gels, axis=0, return_inverse=True)
+        bands = bands.reshape(len(bands), self.WIDTH // 8, 1, 8, 3)
+        bits = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1) # MSB first
+        colors = np.where(bits[None, None, :, :, None], bands, np.array(self.PIXEL_OFF))
+        self.byte_pixels = self._map_colors(colors).reshape(-1, 8)
+        # index of each row's byte 0 (counting backwards) in byte_pixels
+        band_starts = row_bands.reshape(-1, 1) * (self.WIDTH // 8) * 256
+        self.row_starts = band_starts + np.arange(self.WIDTH // 8) * 256
+        self.row_pixels = np.empty((self.HEIGHT, self.WIDTH // 8, 8), dtype=np.uint32)
+        self.row_bytes = np.empty((self.HEIGHT, self.WIDTH // 8), dtype=np.intp) # take() indices
+        self.clean_rows = bytes(State.VRAM_ROWS)
+        self.ram = None
+        self.vram = None
+
+    def _gel_colors(self, overlay):
+        # the lit pixel color at every point of the portrait screen, [column, row]
+        overlay_surface = pygame.Surface((self.WIDTH, self.HEIGHT), pygame.SRCALPHA)
+        overlay_surface.fill(self.PIXEL_ON)
+        for rect, color in overlay:
+            draw_rect_alpha(overlay_surface, color, rect)
+        return pygame.surfarray.array3d(pygame.transform.rotate(overlay_surface, 90))
+
+    def _map_colors(self, colors):
+        # RGB array -> surface pixel values
+        shift = self.native_surface.get_shifts()
+        return ((colors[..., 0].astype(np.uint32) << shift[0]) |
+                (colors[..., 1].astype(np.uint32) << shift[1]) |
+                (colors[..., 2].astype(np.uint32) << shift[2]))
 
 
     def clear_screen(self):
@@ -50,34 +132,107 @@ class Display():
     def add_fps(self, fps):
         self.fps = fps
 
-
-    def render_screen(self):
-        vram = self.state.get_ram(0x2400, 0x4000) # 7K VRAM
-
-        # # Convert 7KB VRAM bytearray to numpy array, unpack bytes to individual bits
-        vram_np = np.frombuffer(vram, dtype=np.uint8)
-        pixels = np.unpackbits(vram_np, bitorder='little') # bit 0 = leftmost pixel
-
-        pixels_2d = pixels.reshape((self.HEIGHT, self.WIDTH))
-        mono = (pixels_2d * 255).astype(np.uint8)
-        rgb = np.stack((mono,)*3, axis=-1)
-        pygame.surfarray.blit_array(self.pixel_surface, rgb.transpose((1, 0, 2)))
-
-        # Rotate 90° for vertical arcade orientation and display
-        # self.pixel_surface.blit(self.overlay_surface, (0, 0))
-        self.pixel_surface.blit(self.overlay_surface, (0, 0), special_flags=pygame.BLEND_RGBA_MULT)
-        rotated_surface = pygame.transform.rotate(self.pixel_surface, 90)
-        scaled_surface = pygame.transform.scale(rotated_surface, (self.HEIGHT*2, self.WIDTH*3))
+    def set_glow(self, glow):
+        if glow not in self.GLOW_LEVELS:
+            raise ValueError(f"Unknown glow level: {glow}")
+        if glow != self.glow:
+            self.glow = glow
+            self.state.vram_dirty[:] = b'\x01' * State.VRAM_ROWS # redraw everything
+
+    def add_frame_time(self, milliseconds):
+        # Work time of the last frame, without the wait for the next one
+        # (pygame.time.Clock.get_rawtime). Steps the glow down when frames run
+        # over budget and back up when there is headroom again.
+        if not self.adaptive:
+            return
+        if milliseconds > self.frame_budget:
+            self.slow_frames += 1
+            self.fast_frames = 0
+        elif milliseconds < self.frame_budget * self.RECOVER_HEADROOM:
+            self.fast_frames += 1
+            self.slow_frames = 0
+        else:
+            self.slow_frames = self.fast_frames = 0
+
+        level = self.GLOW_LEVELS.index(self.glow)
+        if self.slow_frames >= self.DEGRADE_AFTER and level > 0:
+            self.set_glow(self.GLOW_LEVELS[level - 1])
+            self.slow_frames = 0
+        elif (self.fast_frames >= self.RECOVER_AFTER
+              and level < self.GLOW_LEVELS.index(self.max_glow)):
+            self.set_glow(self.GLOW_LEVELS[level + 1])
+            self.fast_frames = 0
+
+
+    def _vram_rows(self):
+        # VRAM as a (row, byte) view of State.ram, remade if the ram was replaced
+        if self.state.ram is not self.ram:
+            self.ram = self.state.ram
+            self.vram = np.frombuffer(self.ram, dtype=np.uint8, count=State.VRAM_ROWS * State.VRAM_ROW_BYTES,
+                                      offset=State.VRAM_START).reshape(State.VRAM_ROWS, State.VRAM_ROW_BYTES)
+        return self.vram
+
+
+    def _post_process(self):
+        # glow, and scaling to the window size, into screen_surface
+        if self.glow == 'cheap':
+            native_size = (self.HEIGHT, self.WIDTH)
+            self.composite_surface.blit(self.native_surface, (0, 0))
+            pygame.transform.smoothscale(self.native_surface, self.native_small.get_size(), self.native_small)
+            pygame.transform.smoothscale(self.native_small, native_size, self.native_glow)
+            self.composite_surface.blit(self.native_glow, (0, 0))
+            pygame.transform.scale(self.composite_surface, self.screen_size, self.screen_surface)
+            return
+
+        pygame.transform.scale(self.native_surface, self.screen_size, self.screen_surface)
+        if self.glow == 'full':
+            pygame.transform.smoothscale(self.screen_surface, (self.HEIGHT, self.WIDTH), self.glow_small)
+            pygame.transform.smoothscale(self.glow_small, self.screen_size, self.glow_surface)
+            self.screen_surface.blit(self.glow_surface, (0, 0))
+
+
+    def render_screen(self) -> list[pygame.Rect]:
+        # Redraws only the VRAM rows written since the last call and returns
+        # the window rects that were updated - none when nothing changed.
+        spans = self.state.vram_dirty_spans()
+        self.state.vram_dirty[:] = self.clean_rows
+        rects = []
+
+        if spans:
+            vram = self._vram_rows()
+            pixels = pygame.surfarray.pixels2d(self.native_surface) # [column, row]
+            for first, end in spans:
+                # rows become columns: bytes backwards, each expanded to 8 colored pixels
+                row_bytes = self.row_bytes[first:end]
+                row_pixels = self.row_pixels[first:end]
+                np.add(self.row_starts[first:end], vram[first:end, ::-1], out=row_bytes)
+                np.take(self.byte_pixels, row_bytes, axis=0, out=row_pixels, mode='wrap')
+                pixels[first:end] = row_pixels.reshape(end - first, self.WIDTH)
+            del pixels # unlock the surface
+
+            margin = self.GLOW_MARGINS[self.glow]
+            for first, end in spans:
+                # column x is window columns 2x, 2x+1, and the glow bleeds a
+                # few pixels either side
+                rects.append(pygame.Rect(first*2 - margin, 0,
+                                         (end - first)*2 + margin*2, self.WIDTH*3))
+            self._post_process()
+
+            for rect in rects:
+                self.window.blit(self.screen_surface, rect, rect)
 
         if self.fps:
-            fps_text_surface = self.font.render(f"FPS: {self.fps:.2f}", True, self.WHITE) # Format to 2 decimal places
-            scaled_surface.blit(fps_text_surface, (10, 10))
-
-        glow_surf = pygame.transform.smoothscale(scaled_surface, (self.HEIGHT, self.WIDTH))
-        glow_surf = pygame.transform.smoothscale(glow_surf, (self.HEIGHT*2, self.WIDTH*3))
-        glow_surf.set_alpha(100)
-        scaled_surface.blit(glow_surf, (0, 0))
-
-        self.window.blit(scaled_surface, (0, 0))
-        pygame.display.flip()
-
+            # the counter is drawn on the window, over the last screen
+            fps_text = f"FPS: {self.fps:.2f}" # Format to 2 decimal places
+            if fps_text != self.fps_text:
+                self.fps_text = fps_text
+                self.fps_text_surface = self.font.render(fps_text, True, self.WHITE)
+            fps_rect = self.fps_text_surface.get_rect(topleft=(10, 10)).union(self.fps_rect)
+            self.window.blit(self.screen_surface, fps_rect, fps_rect)
+            self.window.blit(self.fps_text_surface, (10, 10))
+            self.fps_rect = fps_rect
+            rects.append(fps_rect)
+
+        if rects:
+            pygame.display.update(rects)
+        return rects
@@ -0,0 +1,155 @@
+import csv
+import json
+import random
+import time
+from functools import partial
+from opcodebytes import Opcodebytes
+
+# Per-opcode profile of the CPU core (CPU.start_profile): executions and
+# emulated cycles of every opcode, and host time from a sample of them.
+# Timing every instruction would cost more than many instructions take, so
+# one in sample_every (on average - the gaps vary, so they cannot fall in
+# step with a loop) is timed and the rest estimated from those.
+#
+#   profiler = Profiler()
+#   cpu.start_profile(profiler)
+#   ...run...
+#   cpu.stop_profile()
+#   print(profiler.report())
+#   profiler.save('profile.csv')   # or .json
+#
+# Rows are opcodes, or with by='handler' the CPU handler methods (_op_mov,
+# _op_jmp, ...) that opcodes share.
+
+opcode_names = {value: name for name, value in vars(Opcodebytes).items() if name.isupper()}
+
+COLUMNS = ['name', 'count', 'cycles', 'host_ms', 'time_percent', 'ns_per_exec', 'ns_per_cycle']
+
+
+def handler_name(handler) -> str:
+    while isinstance(handler, partial):
+        handler = handler.func
+    return getattr(handler, '__name__', repr(handler))
+
+
+class Profiler():
+
+    def __init__(self, sample_every=16):
+        self.sample_every = sample_every
+        self.counts = [0] * 256
+        self.cycles = [0] * 256
+        self.sampled_ns = [0] * 256 # host time of the timed executions
+        self.samples = [0] * 256
+        self.handler_names = [f"{op:02X}" for op in range(256)]
+        self.wall_ns = 0 # host time between start and stop, with profiling overhead
+        self.started = None
+
+    def wrap(self, cpu, step):
+        # the CPU's step function and one for interrupts, counting as they run
+        state = cpu.state
+        ram = state.ram
+        execute = cpu._execute
+        self.handler_names = [handler_name(handler) for handler in cpu.handlers]
+        counts, cycles = self.counts, self.cycles
+        sampled_ns, samples = self.sampled_ns, self.samples
+        clock = time.perf_counter_ns
+        gap = partial(random.Random(0).randrange, 1, 2 * self.sample_every)
+        countdown = gap()
+
+        def profiled(op, run, argument=None):
+            nonlocal countdown
+            counts[op] += 1
+            countdown -= 1
+            if countdown:
+                used = run() if argument is None else run(argument)
+            else:
+                countdown = gap()
+                start = clock()
+                used = run() if argument is None else run(argument)
+                sampled_ns[op] += clock() - start
+                samples[op] += 1
+            if used:
+                cycles[op] += abs(used)
+            return used
+
+        def profiled_step(limit=None):
+            return profiled(ram[state.pc], step)
+        def profiled_execute(op):
+            return profiled(op, execute, op)
+
+        self.started = clock()
+        return profiled_step, profiled_execute
+
+    def stop(self):
+        # stops the wall clock, see wall_ns
+        if self.started is not None:
+            self.wall_ns += time.perf_counter_ns() - self.started
+            self.started = None
+
+
+    def estimated_ns(self, op:int) -> float:
+        # host time of all executions of op, from the timed ones
+        if not self.samples[op]:
+            return 0.0
+        return self.sampled_ns[op] / self.samples[op] * self.counts[op]
+
+    def rows(self, by='opcode') -> list[dict]:
+        # hottest first, by estimated host time
+        groups = {}
+        for op in range(256):
+            if not self.counts[op]:
+                continue
+            name = (opcode_names.get(op, f"{op:02X}") if by == 'opcode'
+                    else self.handler_names[op])
+            group = groups.setdefault(name, [0, 0, 0.0])
+            group[0] += self.counts[op]
+            group[1] += self.cycles[op]
+            group[2] += self.estimated_ns(op)
+        total_ns = sum(group[2] for group in groups.values()) or 1.0
+        rows = [{
+            'name': name,
+            'count': count,
+            'cycles': cycles,
+            'host_ms': ns / 1_000_000,
+            'time_percent': 100 * ns / total_ns,
+            'ns_per_exec': ns / count,
+            'ns_per_cycle': ns / cycles if cycles else 0.0,
+        } for name, (count, cycles, ns) in groups.items()]
+        rows.sort(key=lambda row: row['host_ms'], reverse=True)
+        return rows
+
+    def totals(self) -> dict:
+        cycles = sum(self.cycles)
+        estimated_ns = sum(self.estimated_ns(op) for op in range(256))
+        return {
+            'instructions': sum(self.counts),
+            'cycles': cycles,
+            'host_ms': estimated_ns / 1_000_000,
+            'ns_per_cycle': estimated_ns / cycles if cycles else 0.0,
+            'wall_ms': self.wall_ns / 1_000_000,
+            'sample_every': self.sample_every,
+        }
+
+    def report(self, by='opcode', top=20) -> str:
+        totals = self.totals()
+        lines = [f"{totals['instructions']:,} instructions, {totals['cycles']:,} cycles, "
+                 f"{totals['ns_per_cycle']:.1f} host ns per emulated cycle "
+                 f"(1 in {self.sample_every} timed)",
+                 f"{by:<10} {'count':>12} {'cycles':>12} {'host ms':>9} {'time %':>7} "
+                 f"{'ns/exec':>8} {'ns/cycle':>8}"]
+        for row in self.rows(by)[:top]:
+            lines.append(f"{row['name']:<10} {row['count']:>12,} {row['cycles']:>12,} "
+                         f"{row['host_ms']:>9.2f} {row['time_percent']:>7.1f} "
+                         f"{row['ns_per_exec']:>8.0f} {row['ns_per_cycle']:>8.1f}")
+        return '\n'.join(lines)
+
+    def save(self, filename, by='opcode'):
+        # CSV when the name ends in .csv, otherwise JSON with the totals too
+        rows = self.rows(by)
+        with open(filename, 'w', newline='') as file:
+            if str(filename).endswith('.csv'):
+                writer = csv.DictWriter(file, COLUMNS)
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                json.dump({'totals': self.totals(), 'by': by, 'rows': rows}, file, indent=1)
@@ -1,6 +1,8 @@
 import pygame
 from State import State
-from utils import byte_to_bits
+
+# Display for machines without numpy. Same interface as NumpyDisplay, no
+# cellophane or glow.
 
 class Display():
 
@@ -13,42 +15,86 @@ class Display():
     WHITE = (255, 255, 255)
     BLACK = (0, 0, 0)
 
-    def __init__(self, state:State):
+    PIXEL_ON = (255, 255, 255)
+    PIXEL_OFF = (0, 0, 0)
+
+    GLOW_LEVELS = ['off']
+
+    def __init__(self, state:State, glow='off', **unused):
+        # glow and the other NumpyDisplay options are accepted and ignored
         pygame.init()
 
+        self.fps = None
+        self.font = pygame.font.SysFont("Verdana", 10)
+
         self.state = state
-        self.window = pygame.display.set_mode((self.HEIGHT, self.WIDTH))
+        self.screen_size = (self.HEIGHT*2, self.WIDTH*3)
+        self.window = pygame.display.set_mode(self.screen_size)
         self.window.fill(self.BLACK)
 
         pygame.display.set_caption("Space Invaders")
         pygame.display.flip()
 
-        self.pixel_surface = pygame.Surface((self.WIDTH, self.HEIGHT))
-    
+        # The landscape screen is a surface over a bytearray of RGBX pixels,
+        # so rows are drawn by writing bytes into it.
+        self.pixels = bytearray(self.WIDTH * self.HEIGHT * 4)
+        self.pixel_surface = pygame.image.frombuffer(self.pixels, (self.WIDTH, self.HEIGHT), 'RGBX')
+        self.screen_surface = pygame.Surface(self.screen_size)
+        self.screen_surface.fill(self.BLACK)
+        self.fps_rect = pygame.Rect(10, 10, 0, 0)
+
+        # byte -> its 8 pixels as RGBX bytes, bit 0 (the leftmost pixel) first
+        on, off = (bytes(color) + b'\xff' for color in (self.PIXEL_ON, self.PIXEL_OFF))
+        self.byte_pixels = [b''.join(on if value >> bit & 1 else off for bit in range(8))
+                            for value in range(256)]
+        self.clean_rows = bytes(State.VRAM_ROWS)
+
 
     def clear_screen(self):
         self.window.fill(self.BLACK)
         pygame.display.flip()
 
+    def add_fps(self, fps):
+        self.fps = fps
 
-    def render_screen(self):
-        # self.window.fill(self.BLACK)
-        pixel_array = pygame.PixelArray(self.pixel_surface)
-        vram = self.state.get_ram(0x2400, 0x4000) # 7K VRAM
+    def add_frame_time(self, milliseconds):
+        pass # nothing to adapt
 
-        for y in range(self.HEIGHT):
-            for x in range(self.WIDTH):
-                bit_index = y*self.WIDTH + x
-                byte_index = bit_index // 8
-                offset = bit_index % 8 # bits are backwards visually, so bit 0 is at the left
-                vram_pixel_set = vram[byte_index] & (1 << offset)
-                pixel_array[x, y] = self.WHITE if vram_pixel_set else self.BLACK
-        pixel_array.close()
+    def set_glow(self, glow):
+        pass
 
-        rotated_surface = pygame.transform.rotate(self.pixel_surface, 90)
-        self.window.blit(rotated_surface, (0,0))
 
-        pygame.display.flip()
-                    
+    def render_screen(self) -> list[pygame.Rect]:
+        # Redraws only the VRAM rows written since the last call and returns
+        # the window rects that were updated - none when nothing changed.
+        spans = self.state.vram_dirty_spans()
+        self.state.vram_dirty[:] = self.clean_rows
+        rects = []
+
+        if spans:
+            ram = self.state.ram
+            byte_pixels = self.byte_pixels
+            row_size = self.WIDTH * 4
+            for first, end in spans:
+                start = State.VRAM_START + first * self.BYTEWIDTH
+                vram = ram[start:start + (end - first) * self.BYTEWIDTH]
+                self.pixels[first*row_size:end*row_size] = b''.join(map(byte_pixels.__getitem__, vram))
+                # row y ends up as window columns 2y, 2y+1
+                rects.append(pygame.Rect(first*2, 0, (end - first)*2, self.WIDTH*3))
+
+            rotated_surface = pygame.transform.rotate(self.pixel_surface, 90)
+            pygame.transform.scale(rotated_surface, self.screen_size, self.screen_surface)
+            for rect in rects:
+                self.window.blit(self.screen_surface, rect, rect)
+
+        if self.fps:
+            fps_text_surface = self.font.render(f"FPS: {self.fps:.2f}", True, self.WHITE)
+            fps_rect = fps_text_surface.get_rect(topleft=(10, 10)).union(self.fps_rect)
+            self.window.blit(self.screen_surface, fps_rect, fps_rect)
+            self.window.blit(fps_text_surface, (10, 10))
+            self.fps_rect = fps_rect
+            rects.append(fps_rect)
 
-    
\ No newline at end of file
+        if rects:
+            pygame.display.update(rects)
+        return rects
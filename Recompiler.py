@@ -0,0 +1,355 @@
+from State import reg_indices, FLAG_A, FLAG_C
+from CPU import register_codes, condition_flags
+import ALU
+
+# Block-level dynamic recompiler.
+# Straight-line runs of 8080 code are translated into Python functions, up to
+# and including the next branch, CALL, RET, RST, IN or OUT. Translations are
+# cached by start PC and a whole block runs per dispatch. Every page a block
+# was read from is marked in State.code_pages, so a write into it (self-modifying
+# code, CP/M programs loading overlays) drops the affected blocks.
+
+PAGE_BITS = 8
+
+# register pair -> (high register index, low register index)
+register_pairs = {
+    0b00: (reg_indices['b'], reg_indices['c']),
+    0b01: (reg_indices['d'], reg_indices['e']),
+    0b10: (reg_indices['h'], reg_indices['l']),
+}
+
+HL = f"((regs[{reg_indices['h']}] << 8) | regs[{reg_indices['l']}])"
+A = reg_indices['a']
+
+# flags kept by each kind of ALU instruction
+KEEP_ALU = 0xff & ~ALU.ALU_FLAGS
+KEEP_INC = 0xff & ~ALU.INC_FLAGS
+KEEP_LOGIC = 0xff & ~ALU.LOGIC_FLAGS
+
+# ALU operations as table lookups (see ALU), {} is the operand
+CARRY_IN = f"((state.flags & {FLAG_C}) << 16)"
+alu_templates = [
+    [f"entry = ADD[(regs[{A}] << 8) | {{}}]",
+     f"regs[{A}] = entry & 0xff", f"state.flags = (state.flags & {KEEP_ALU}) | (entry >> 8)"],
+    [f"entry = ADD[{CARRY_IN} | (regs[{A}] << 8) | {{}}]",
+     f"regs[{A}] = entry & 0xff", f"state.flags = (state.flags & {KEEP_ALU}) | (entry >> 8)"],
+    [f"entry = SUB[(regs[{A}] << 8) | {{}}]",
+     f"regs[{A}] = entry & 0xff", f"state.flags = (state.flags & {KEEP_ALU}) | (entry >> 8)"],
+    [f"entry = SUB[{CARRY_IN} | (regs[{A}] << 8) | {{}}]",
+     f"regs[{A}] = entry & 0xff", f"state.flags = (state.flags & {KEEP_ALU}) | (entry >> 8)"],
+    [f"value = regs[{A}] & {{}}",
+     f"regs[{A}] = value", f"state.flags = (state.flags & {KEEP_LOGIC}) | SZP[value]"],
+    [f"value = regs[{A}] ^ {{}}",
+     f"regs[{A}] = value", f"state.flags = (state.flags & {KEEP_LOGIC}) | SZP[value]"],
+    [f"value = regs[{A}] | {{}}",
+     f"regs[{A}] = value", f"state.flags = (state.flags & {KEEP_LOGIC}) | SZP[value]"],
+    [f"entry = SUB[(regs[{A}] << 8) | {{}}]",
+     f"state.flags = (state.flags & {KEEP_ALU}) | (entry >> 8)"],
+]
+
+def alu_lines(operation, operand):
+    return [line.format(operand) for line in alu_templates[operation]]
+
+
+class Recompiler():
+
+    MAX_BLOCK_INSTRUCTIONS = 64
+
+    def __init__(self, cpu, max_block_instructions=None):
+        self.cpu = cpu
+        self.state = cpu.state
+        self.max_block_instructions = max_block_instructions or self.MAX_BLOCK_INSTRUCTIONS
+        self.blocks = {} # start pc: block function
+        self.page_blocks = [set() for _ in range(len(self.state.code_pages))]
+        self.state.on_code_write = self.invalidate_pages
+        self.namespace = {
+            'state': self.state,
+            'cpu': cpu,
+            'bus': cpu.bus,
+            'ADD': ALU.ADD,
+            'SUB': ALU.SUB,
+            'INC': ALU.INC,
+            'DEC': ALU.DEC,
+            'DAA': ALU.DAA,
+            'SZP': ALU.SZP,
+        }
+
+
+    def run_block(self, limit=None):
+        # limit: cycles left before the next interrupt or the end of the run.
+        # A block that could run past it is stepped one instruction at a time
+        # instead, so interrupts land on the same instruction as the other engines.
+        state = self.state
+        block = self.blocks.get(state.pc)
+        if block is None:
+            block = self._translate(state.pc)
+        if limit is not None and block.max_cycles > limit:
+            return self.cpu._step_table()
+        return block(state.registers, state.ram, state.set_ram)
+
+
+    def invalidate_pages(self, first_page, last_page):
+        # drop every block that was translated from bytes in these pages
+        for page in range(first_page, min(last_page, len(self.page_blocks) - 1) + 1):
+            for start in self.page_blocks[page]:
+                block = self.blocks.pop(start, None)
+                if block is not None:
+                    block.alive[0] = False
+            self.page_blocks[page].clear()
+            self.state.code_pages[page] = 0
+
+
+    def invalidate_all(self):
+        self.invalidate_pages(0, len(self.page_blocks) - 1)
+
+
+    def _translate(self, start):
+        ram = self.state.ram
+        memory_size = self.state.MEMORY_SIZE
+        lines = []
+        pages = set()
+        cycles = 0
+        pc = start
+
+        for count in range(self.max_block_instructions):
+            op = ram[pc]
+            length, op_cycles, kind, code = self._translate_instruction(op, pc)
+            if kind == 'stop' and count:
+                # halt or unknown opcode - end the block before it so it is reported on its own
+                lines += [f"state.pc = {pc}", f"return {cycles}"]
+                break
+            pages.update(((pc + offset) % memory_size) >> PAGE_BITS for offset in range(length))
+            next_pc = (pc + length) % memory_size
+            if kind in ('branch', 'stop'):
+                lines += [line.format(cycles=cycles, next_pc=next_pc) for line in code]
+                cycles += op_cycles
+                break
+            lines += code
+            cycles += op_cycles
+            pc = next_pc
+            if kind == 'store':
+                # the block may just have overwritten itself
+                lines += [
+                    "if not alive[0]:",
+                    f"    state.pc = {pc}",
+                    f"    return {cycles}",
+                ]
+        else:
+            lines += [f"state.pc = {pc}", f"return {cycles}"]
+
+        source = f"def block_{start:04x}(regs, ram, set_ram):\n" + "".join(
+            f"    {line}\n" for line in lines)
+        namespace = {'alive': [True]} | self.namespace
+        exec(compile(source, f"<block {start:04x}>", 'exec'), namespace)
+        block = namespace[f'block_{start:04x}']
+        block.alive = namespace['alive']
+        block.source = source
+        block.max_cycles = cycles
+
+        self.blocks[start] = block
+        for page in pages:
+            self.page_blocks[page].add(start)
+            self.state.code_pages[page] = 1
+        return block
+
+
+    def _translate_instruction(self, op, pc):
+        # returns (length, cycles, kind, lines of code)
+        # cycles: for branches the most the instruction can take
+        # kind: 'plain', 'store' (writes memory), 'branch' (ends the block, sets pc
+        #       and returns itself) or 'stop' (must be executed on its own)
+        ram = self.state.ram
+        memory_size = self.state.MEMORY_SIZE
+        byte1 = ram[(pc + 1) % memory_size]
+        byte2 = ram[(pc + 2) % memory_size]
+        data16 = byte1 | (byte2 << 8)
+        ddd = (op >> 3) & 0b111
+        sss = op & 0b111
+        rp = (op >> 4) & 0b11
+
+        # Machine control group
+        if op == 0x00:
+            return 1, 4, 'plain', []
+        if op == 0x76:
+            return 1, 0, 'stop', ["state.pc = {next_pc}", "return None"]
+
+        # Data transfer group
+        if op == 0x3a:
+            return 3, 13, 'plain', [f"regs[{A}] = ram[{data16}]"]
+        if op == 0x32:
+            return 3, 13, 'store', [f"set_ram({data16}, regs[{A}])"]
+        if op == 0x2a:
+            return 3, 16, 'plain', [
+                f"regs[{reg_indices['l']}] = ram[{data16}]",
+                f"regs[{reg_indices['h']}] = ram[{data16 + 1}]"]
+        if op == 0x22:
+            return 3, 16, 'store', [
+                f"set_ram({data16}, regs[{reg_indices['l']}])",
+                f"set_ram({data16 + 1}, regs[{reg_indices['h']}])"]
+        if op & 0b11111000 == 0b01110000:
+            source = reg_indices[register_codes[sss]]
+            return 1, 7, 'store', [f"set_ram({HL}, regs[{source}])"]
+        if op & 0b11000111 == 0b01000110:
+            dest = reg_indices[register_codes[ddd]]
+            return 1, 7, 'plain', [f"regs[{dest}] = ram[{HL}]"]
+        if op & 0b11000000 == 0b01000000:
+            source = reg_indices[register_codes[sss]]
+            dest = reg_indices[register_codes[ddd]]
+            return 1, 5, 'plain', [f"regs[{dest}] = regs[{source}]"]
+        if op == 0x36:
+            return 2, 10, 'store', [f"set_ram({HL}, {byte1})"]
+        if op == 0xeb:
+            d, e, h, l = (reg_indices[r] for r in 'dehl')
+            return 1, 4, 'plain', [
+                f"regs[{d}], regs[{e}], regs[{h}], regs[{l}] = regs[{h}], regs[{l}], regs[{d}], regs[{e}]"]
+        if op & 0b11001111 == 0b00000001:
+            if rp == 0b11:
+                return 3, 10, 'plain', [f"state.sp = {data16}"]
+            high, low = register_pairs[rp]
+            return 3, 10, 'plain', [f"regs[{high}] = {byte2}", f"regs[{low}] = {byte1}"]
+        if op & 0b11001111 == 0b00001010:
+            high, low = register_pairs[rp]
+            return 1, 7, 'plain', [f"regs[{A}] = ram[(regs[{high}] << 8) | regs[{low}]]"]
+        if op & 0b11001111 == 0b00000010:
+            high, low = register_pairs[rp]
+            return 1, 7, 'store', [f"set_ram((regs[{high}] << 8) | regs[{low}], regs[{A}])"]
+        if op & 0b11000111 == 0b00000110:
+            dest = reg_indices[register_codes[ddd]]
+            return 2, 7, 'plain', [f"regs[{dest}] = {byte1}"]
+
+        # Arithmetic and logical groups
+        if op == 0x27:
+            return 1, 4, 'plain', [
+                f"flags = state.flags",
+                f"entry = DAA[((flags & {FLAG_C}) << 9) | ((flags & {FLAG_A}) << 4) | regs[{A}]]",
+                f"regs[{A}] = entry & 0xff",
+                f"state.flags = (flags & ~(entry >> 16)) | ((entry >> 8) & 0xff)"]
+        if op & 0b11000111 == 0b10000110:
+            return 1, 7, 'plain', alu_lines(ddd, f"ram[{HL}]")
+        if op & 0b11000000 == 0b10000000:
+            source = reg_indices[register_codes[sss]]
+            return 1, 4, 'plain', alu_lines(ddd, f"regs[{source}]")
+        if op & 0b11000111 == 0b11000110:
+            return 2, 7, 'plain', alu_lines(ddd, byte1)
+        if op in (0x34, 0x35):
+            table = 'INC' if op == 0x34 else 'DEC'
+            return 1, 10, 'store', [
+                f"address = {HL}",
+                f"entry = {table}[ram[address]]",
+                "set_ram(address, entry & 0xff)",
+                f"state.flags = (state.flags & {KEEP_INC}) | (entry >> 8)"]
+        if op & 0b11000110 == 0b00000100:
+            table = 'DEC' if op & 1 else 'INC'
+            dest = reg_indices[register_codes[ddd]]
+            return 1, 5, 'plain', [
+                f"entry = {table}[regs[{dest}]]",
+                f"regs[{dest}] = entry & 0xff",
+                f"state.flags = (state.flags & {KEEP_INC}) | (entry >> 8)"]
+        if op & 0b11000111 == 0b00000011:
+            inc_by = -1 if op & 0b00001000 else 1
+            if rp == 0b11:
+                return 1, 5, 'plain', [f"state.sp = (state.sp + {inc_by}) & 0xffff"]
+            high, low = register_pairs[rp]
+            return 1, 5, 'plain', [
+                f"value = (((regs[{high}] << 8) | regs[{low}]) + {inc_by}) & 0xffff",
+                f"regs[{high}] = value >> 8",
+                f"regs[{low}] = value & 0xff"]
+        if op & 0b11001111 == 0b00001001:
+            return 1, 10, 'plain', [f"cpu._dad({rp})"]
+        if op == 0x07:
+            return 1, 4, 'plain', ["cpu._rlc()"]
+        if op == 0x0f:
+            return 1, 4, 'plain', ["cpu._rrc()"]
+        if op == 0x17:
+            return 1, 4, 'plain', ["cpu._ral()"]
+        if op == 0x1f:
+            return 1, 4, 'plain', ["cpu._rar()"]
+        if op == 0x2f:
+            return 1, 4, 'plain', [f"regs[{A}] = ~regs[{A}] & 0xff"]
+        if op == 0x3f:
+            return 1, 4, 'plain', [f"state.flags ^= {FLAG_C}"]
+        if op == 0x37:
+            return 1, 4, 'plain', [f"state.flags |= {FLAG_C}"]
+
+        # branch instructions
+        if op == 0xc3:
+            return 3, 10, 'branch', [
+                f"state.pc = {data16 % memory_size}",
+                "return {cycles} + 10"]
+        if op & 0b11000111 == 0b11000010:
+            return 3, 10, 'branch', [
+                f"state.pc = {data16 % memory_size} if {self._condition(ddd)} else {{next_pc}}",
+                "return {cycles} + 10"]
+
+        # call instructions
+        if op == 0xcd:
+            return 3, 17, 'branch', [
+                "state.pc = {next_pc}",
+                f"cpu._call({data16})",
+                "return {cycles} + 17"]
+        if op & 0b11000111 == 0b11000100:
+            return 3, 17, 'branch', [
+                "state.pc = {next_pc}",
+                f"if {self._condition(ddd)}:",
+                f"    cpu._call({data16})",
+                "    return {cycles} + 17",
+                "return {cycles} + 11"]
+        if op == 0xc9:
+            return 1, 10, 'branch', [
+                "cpu._ret()",
+                "return {cycles} + 10"]
+        if op & 0b11000111 == 0b11000000:
+            return 1, 11, 'branch', [
+                f"if {self._condition(ddd)}:",
+                "    cpu._ret()",
+                "    return {cycles} + 11",
+                "state.pc = {next_pc}",
+                "return {cycles} + 5"]
+        if op & 0b11000111 == 0b11000111:
+            return 1, 11, 'branch', [
+                "state.pc = {next_pc}",
+                f"cpu._call({ddd * 8})",
+                "return {cycles} + 11"]
+        if op == 0xe9:
+            return 1, 5, 'branch', [
+                f"state.set_pc({HL})",
+                "return {cycles} + 5"]
+
+        # push pop
+        if op == 0xf5:
+            return 1, 11, 'store', ["cpu._pushpsw()"]
+        if op & 0b11001111 == 0b11000101:
+            return 1, 11, 'store', [f"cpu._push({rp})"]
+        if op == 0xf1:
+            return 1, 10, 'plain', ["cpu._poppsw()"]
+        if op & 0b11001111 == 0b11000001:
+            return 1, 10, 'plain', [f"cpu._pop({rp})"]
+        if op == 0xe3:
+            return 1, 18, 'store', ["cpu._xthl()"]
+        if op == 0xf9:
+            return 1, 5, 'plain', [f"state.set_sp({HL})"]
+
+        # interrupts and I/O
+        if op in (0xfb, 0xf3): # EI, DI
+            return 1, 4, 'plain', []
+        if op == 0xdb:
+            return 2, 10, 'branch', [
+                "state.pc = {next_pc}",
+                f"regs[{A}] = bus.read({byte1}) & 0xff",
+                "return {cycles} + 10"]
+        if op == 0xd3:
+            return 2, 10, 'branch', [
+                "state.pc = {next_pc}",
+                f"bus.write({byte1}, regs[{A}])",
+                "return {cycles} + 10"]
+
+        # not implemented - let the dispatch table raise for it
+        return 1, 0, 'stop', [
+            "state.pc = {next_pc}",
+            f"return cpu.dispatch_table[{op}]()"]
+
+
+    def _condition(self, code):
+        mask, value = condition_flags[code]
+        test = f"state.flags & {mask}"
+        return test if value else f"not {test}"
@@ -0,0 +1,138 @@
+import argparse
+import hashlib
+import json
+import struct
+import sys
+import time
+from CPU import CPU
+from Machine import Machine
+
+# Input recordings: port 1 as the game saw it, one bitmask per frame from
+# power on (see Keyboard.start_recording). Replaying one into a fresh
+# Machine reproduces the game exactly, so recordings serve as regression
+# tests and benchmark workloads:
+#
+#   python Recording.py game.inp --save game.json      # record the results
+#   python Recording.py game.inp --expect game.json    # later: check them
+#
+# File: a header (magic, version, frame count), then runs of
+# (frames, port 1) - input rarely changes from one frame to the next.
+
+MAGIC = b'SIIN'
+VERSION = 1
+HEADER = struct.Struct('<4sHI')
+RUN = struct.Struct('<HB')
+
+
+def save_recording(filename, frames:bytes):
+    # frames: port 1 for each frame
+    parts = [HEADER.pack(MAGIC, VERSION, len(frames))]
+    start = 0
+    while start < len(frames):
+        value = frames[start]
+        end = start + 1
+        while end < len(frames) and frames[end] == value and end - start < 0xffff:
+            end += 1
+        parts.append(RUN.pack(end - start, value))
+        start = end
+    with open(filename, 'wb') as file:
+        file.write(b''.join(parts))
+
+def load_recording(filename) -> bytes:
+    with open(filename, 'rb') as file:
+        data = file.read()
+    if len(data) < HEADER.size:
+        raise ValueError(f"{filename} is not an input recording")
+    magic, version, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{filename} is not an input recording")
+    if version != VERSION:
+        raise ValueError(f"Unsupported input recording version: {version}")
+    frames = bytearray()
+    for length, value in RUN.iter_unpack(data[HEADER.size:]):
+        frames += bytes([value]) * length
+    if len(frames) != count:
+        raise ValueError(f"{filename} is truncated: {len(frames)} of {count} frames")
+    return bytes(frames)
+
+
+def score_bytes(machine:Machine) -> str:
+    # the BCD score bytes as hex, player 1, player 2 then high score
+    return ''.join(machine.state.get_ram(address, address + 2).hex()
+                   for address in Machine.SCORE_ADDRESSES.values())
+
+def replay(frames:bytes, rom_image:bytes, config={}) -> dict:
+    # Runs a recording headless and unthrottled, hashing VRAM every frame
+    machine = Machine(config=config)
+    machine.load_rom_image(rom_image)
+    frame_hashes = []
+    start = time.perf_counter()
+    for port1 in frames:
+        machine.set_input(port1)
+        if machine.run_frame() == CPU.STOP_HALT:
+            break
+        frame_hashes.append(hashlib.sha1(machine.vram()).hexdigest())
+    seconds = time.perf_counter() - start
+    return {
+        'frames': machine.frames,
+        'cycles': machine.cycles,
+        'seconds': seconds,
+        'fps': machine.frames / seconds if seconds else 0.0,
+        'mhz': machine.cycles / seconds / 1_000_000 if seconds else 0.0,
+        'frame_hashes': frame_hashes,
+        'score_bytes': score_bytes(machine),
+        'scores': machine.scores(),
+    }
+
+def differences(result:dict, expected:dict) -> list[str]:
+    # where a replay's result differs from an earlier one
+    problems = []
+    if result['frames'] != expected['frames']:
+        problems.append(f"ran {result['frames']} frames, expected {expected['frames']}")
+    for frame, (got, wanted) in enumerate(zip(result['frame_hashes'], expected['frame_hashes'])):
+        if got != wanted:
+            problems.append(f"VRAM differs from frame {frame}")
+            break
+    if result['score_bytes'] != expected['score_bytes']:
+        problems.append(f"score bytes {result['score_bytes']}, expected {expected['score_bytes']}")
+    return problems
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay an input recording headless.")
+    parser.add_argument('recording', help="file saved with spaceinv.py --record")
+    parser.add_argument('--roms', default=Machine.ROM_DIR,
+                        help="directory holding invaders.h/g/f/e")
+    parser.add_argument('--engine', default='table',
+                        choices=['table', 'recompiler', 'reference'],
+                        help="CPU execution engine")
+    parser.add_argument('--save', metavar='FILE',
+                        help="write the frame hashes and scores as JSON")
+    parser.add_argument('--expect', metavar='FILE',
+                        help="compare against JSON from --save, exit 1 if they differ")
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    result = replay(load_recording(args.recording), Machine.read_roms(args.roms),
+                    {'engine': args.engine})
+    print(f"{result['frames']} frames in {result['seconds']:.2f}s: "
+          f"{result['fps']:.1f} frames/sec, {result['mhz']:.3f} MHz")
+    print(f"Scores: {result['scores']}")
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump({name: result[name] for name in ['frames', 'frame_hashes', 'score_bytes']},
+                      file)
+    if args.expect:
+        with open(args.expect) as file:
+            problems = differences(result, json.load(file))
+        for problem in problems:
+            print(problem)
+        if problems:
+            return 1
+        print("Replay matches.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import re
+import struct
+import sys
+import time
+from collections import deque
+from State import State
+
+# Rewind history for the main loop. Every `every` frames record() takes a
+# State.snapshot; the newest is kept whole and each older one as a delta
+# back from the one after it: the XOR of the two, run-length encoded. Only
+# work RAM and VRAM change between frames, so most of a delta is zero runs
+# and it costs a few hundred bytes. The oldest deltas are dropped once the
+# history passes max_bytes - all of it: the deltas, the deque holding them
+# and the two whole snapshot buffers (about 16K each).
+#
+#   rewind = Rewind(state)
+#   rewind.record()      # after each frame
+#   rewind.step_back()   # while the rewind key is held, instead of a frame
+
+# A delta is a list of runs: (zero bytes skipped since the last run, length)
+# and then that many XORed bytes. Gaps of a few zeros are cheaper inside a
+# run than as a new run header.
+RUN = struct.Struct('<HH')
+CHANGED = re.compile(rb'[^\x00]+(?:\x00{1,3}[^\x00]+)*')
+
+
+def xor_bytes(first, second) -> bytes:
+    # first and second are the same length
+    return (int.from_bytes(first, 'little') ^ int.from_bytes(second, 'little')).to_bytes(
+        len(first), 'little')
+
+def encode_delta(old, new) -> bytes:
+    # applying the result to new with apply_delta gives old
+    difference = xor_bytes(old, new)
+    parts = []
+    position = 0
+    for match in CHANGED.finditer(difference):
+        start, end = match.span()
+        parts.append(RUN.pack(start - position, end - start))
+        parts.append(match.group())
+        position = end
+    return b''.join(parts)
+
+def apply_delta(snapshot:bytearray, delta:bytes):
+    # XORs an encode_delta result into snapshot, in place
+    index = 0
+    position = 0
+    while index < len(delta):
+        skip, length = RUN.unpack_from(delta, index)
+        index += RUN.size
+        start = position + skip
+        position = start + length
+        snapshot[start:position] = xor_bytes(snapshot[start:position], delta[index:index + length])
+        index += length
+
+
+class Rewind():
+
+    def __init__(self, state:State, max_bytes=4_000_000, every=1):
+        self.state = state
+        self.max_bytes = max_bytes
+        self.every = every
+        self.newest = None  # the latest snapshot, whole
+        self.spare = None   # buffer for the next one
+        self.deltas = deque() # oldest first; the last turns newest into the one before
+        self.delta_bytes = 0  # memory held by the delta objects
+        self.frame = 0
+        # measured cost of record()
+        self.record_seconds = 0.0
+        self.records = 0
+
+    def record(self):
+        # call once a frame
+        self.frame += 1
+        if self.frame % self.every:
+            return
+        start = time.perf_counter()
+        snapshot = self.state.snapshot(buffer=self.spare)
+        if self.newest is not None:
+            delta = encode_delta(self.newest, snapshot)
+            self.deltas.append(delta)
+            self.delta_bytes += sys.getsizeof(delta)
+        self.spare, self.newest = self.newest, snapshot
+        while self.deltas and self.held_bytes() > self.max_bytes:
+            self.delta_bytes -= sys.getsizeof(self.deltas.popleft())
+        self.record_seconds += time.perf_counter() - start
+        self.records += 1
+
+    def step_back(self) -> bool:
+        # Restores the snapshot before the newest, which it then becomes.
+        # False once the history is used up.
+        if not self.deltas:
+            return False
+        delta = self.deltas.pop()
+        self.delta_bytes -= sys.getsizeof(delta)
+        apply_delta(self.newest, delta)
+        self.state.restore(self.newest)
+        self.frame = 0
+        return True
+
+    def frames_held(self) -> int:
+        # frames that can be stepped back
+        return len(self.deltas) * self.every
+
+    def held_bytes(self) -> int:
+        # the memory max_bytes bounds
+        snapshot_bytes = sum(sys.getsizeof(buffer) for buffer in (self.newest, self.spare)
+                             if buffer is not None)
+        return self.delta_bytes + sys.getsizeof(self.deltas) + snapshot_bytes
+
+    def stats(self) -> dict:
+        return {
+            'frames': self.frames_held(),
+            'bytes': self.held_bytes(),
+            'record_us': self.record_seconds / self.records * 1_000_000 if self.records else 0.0,
+        }
@@ -0,0 +1,96 @@
+from CPU import CPU
+from Machine import Machine
+
+# Run-ahead: shows a frame from the future to hide the game's own input lag.
+# For each displayed frame:
+#   1. run the real frame, with sound
+#   2. snapshot the state
+#   3. run `frames` more frames with the same input, without sound
+#   4. draw the last of them
+#   5. restore the snapshot
+# Input then reaches the screen `frames` frames sooner, for frames + 1 times
+# the CPU work. The soundboard and the machine's frame and cycle counts only
+# see the real frames.
+#
+#   stop_reason = run_ahead.run_frame()   # steps 1-3
+#   display.render_screen()
+#   run_ahead.restore()                   # step 5
+
+
+class RunAhead():
+
+    def __init__(self, machine:Machine, frames=1):
+        self.machine = machine
+        self.frames = frames
+        self.snapshot = None # buffer, reused every frame
+        self.ahead = False   # state holds a look-ahead frame
+        self.ahead_dirty = 0 # VRAM rows the look-ahead frames wrote, as an int
+
+    def run_frame(self):
+        # returns the real frame's CPU stop reason
+        machine = self.machine
+        state = machine.state
+        stop_reason = machine.run_frame()
+        if not self.frames or stop_reason != CPU.STOP_CYCLES:
+            return stop_reason
+
+        self.snapshot = state.snapshot(buffer=self.snapshot)
+        frames, cycles = machine.frames, machine.cycles
+        real_dirty = bytes(state.vram_dirty)
+        state.vram_dirty[:] = bytes(len(real_dirty))
+        soundboard, machine.bus.soundboard = machine.bus.soundboard, None
+        try:
+            for _ in range(self.frames):
+                if machine.run_frame() != CPU.STOP_CYCLES:
+                    break
+        finally:
+            machine.bus.soundboard = soundboard
+            machine.frames, machine.cycles = frames, cycles
+
+        # the display draws rows changed by either
+        self.ahead_dirty = int.from_bytes(state.vram_dirty)
+        state.vram_dirty[:] = (self.ahead_dirty | int.from_bytes(real_dirty)).to_bytes(len(real_dirty))
+        self.ahead = True
+        return stop_reason
+
+    def restore(self):
+        # back to the real frame, after drawing the look-ahead one
+        if not self.ahead:
+            return
+        state = self.machine.state
+        state.restore(self.snapshot)
+        # what is on screen differs from the real frame only where the
+        # look-ahead frames wrote
+        state.vram_dirty[:] = self.ahead_dirty.to_bytes(len(state.vram_dirty))
+        self.ahead = False
+
+
+def measure_latency(machine:Machine, port1:int, frames_ahead=0, max_frames=60):
+    # Displayed frames from setting port 1 until the screen shows it: the
+    # index of the first drawn frame that differs from a run without the
+    # input, or None if none does within max_frames. Leaves the machine as
+    # it was.
+    state = machine.state
+    start = state.snapshot()
+    counts = machine.frames, machine.cycles
+
+    def shown_frames():
+        run_ahead = RunAhead(machine, frames_ahead)
+        shown = []
+        for _ in range(max_frames):
+            run_ahead.run_frame()
+            shown.append(machine.vram())
+            run_ahead.restore()
+        return shown
+
+    try:
+        without = shown_frames()
+        state.restore(start)
+        machine.set_input(port1)
+        for frame, vram in enumerate(shown_frames()):
+            if vram != without[frame]:
+                return frame
+        return None
+    finally:
+        state.restore(start)
+        machine.frames, machine.cycles = counts
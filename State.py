@@ -1,4 +1,6 @@
-from utils import bits_to_int, byte_to_bits
+import struct
+import zlib
+from utils import bits_to_int
 
 reg_indices = {
     'b':0,
@@ -10,33 +12,75 @@ reg_indices = {
     'a':6,
     }
 
-flag_indices = {
-    's':0,
-    'z':1,
-    'a':3,
-    'p':5,
-    'c':7
+# register pairs, numbered as in the 8080 rp field
+pair_indices = {
+    'bc':0,
+    'de':1,
+    'hl':2,
+    'sp':3,
+    }
+
+REG_B, REG_C, REG_D, REG_E, REG_H, REG_L, REG_A = range(7)
+PAIR_BC, PAIR_DE, PAIR_HL, PAIR_SP = range(4)
+
+# flags are packed in PSW layout: S Z 0 AC 0 P 1 C
+FLAG_S = 0b10000000
+FLAG_Z = 0b01000000
+FLAG_A = 0b00010000
+FLAG_P = 0b00000100
+FLAG_C = 0b00000001
+
+flag_masks = {
+    's':FLAG_S,
+    'z':FLAG_Z,
+    'a':FLAG_A,
+    'p':FLAG_P,
+    'c':FLAG_C,
 }
 
+# Save states (State.snapshot): a fixed little-endian header followed by the
+# RAM, raw or zlib compressed.
+#   magic, version, options, registers b c d e h l a, flags, pc, sp,
+#   shift register, read bus, write bus, RAM length (as stored)
+SNAPSHOT_MAGIC = b'8080'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<4sHH7sBHHH4s7sI')
+SNAPSHOT_COMPRESSED = 0x0001 # options bit
+
 class State():
 
     ROMSTART = 0x0000
     STACKSTART = 0x23FF
     MEMORY_SIZE = 16384
 
+    # video RAM: 224 rows of 32 bytes, one row per scanline of the unrotated screen
+    VRAM_START = 0x2400
+    VRAM_ROW_BYTES = 32
+    VRAM_ROWS = 224
+
 
     def __init__(self, romstart=None):
         self.registers = bytearray(7)
         self.pc = self.ROMSTART if romstart is None else romstart
         self.ram = bytearray(self.MEMORY_SIZE)
         self.sp = self.STACKSTART
-        self.flags = [0,0,0,0,0,0,1,0]
+        self.flags = 0b00000010 # packed, see flag_masks
 
         # bus data
         self.writebus = [0] * 7
         self.readbus = [0] * 4
         self.shift_register = 0x0000 # 16 bit register
 
+        # pages (256 bytes) holding translated code, see Recompiler
+        self.code_pages = bytearray(256)
+        self.on_code_write = None # callback(first_page, last_page)
+
+        # 0x0000 up to rom_end is ROM, see protect_rom
+        self.rom_end = 0
+
+        # VRAM rows written since the display last drew them, one byte per row
+        self.vram_dirty = bytearray(b'\x01' * self.VRAM_ROWS)
+
     def __str__(self):
         string = ""
         string += f'PC: {self.pc:4X}\n'
@@ -48,23 +92,93 @@ class State():
         return string
 
     def copy(self, new_state):
-        self.registers = new_state.registers
+        # copies into this state's buffers, which others (CPU, displays) hold
+        self.registers[:] = new_state.registers
         self.pc = new_state.pc
-        self.ram = new_state.ram
+        self.ram[:] = new_state.ram
         self.sp = new_state.sp
         self.flags = new_state.flags
+        if isinstance(self.flags, list): # saved before flags were packed
+            self.flags = bits_to_int(self.flags)
 
         # bus data
-        self.writebus = new_state.writebus
-        self.readbus = new_state.readbus
+        self.writebus[:] = new_state.writebus
+        self.readbus[:] = new_state.readbus
         self.shift_register = new_state.shift_register
 
+        self.vram_dirty[:] = b'\x01' * self.VRAM_ROWS
+        # ram was replaced wholesale, so every translation is stale
+        if self.on_code_write:
+            self.on_code_write(0, len(self.code_pages) - 1)
+
+    def snapshot(self, compress=False, buffer:bytearray=None) -> bytearray:
+        # The state in the save state format. Uncompressed snapshots are a
+        # fixed size, so a buffer from an earlier call can be passed to be
+        # filled again instead of allocating one every frame.
+        ram = zlib.compress(self.ram, 1) if compress else self.ram
+        size = SNAPSHOT_HEADER.size + len(ram)
+        if buffer is None or len(buffer) != size:
+            buffer = bytearray(size)
+        SNAPSHOT_HEADER.pack_into(buffer, 0, SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                  SNAPSHOT_COMPRESSED if compress else 0,
+                                  self.registers, self.flags, self.pc, self.sp,
+                                  self.shift_register, bytes(self.readbus),
+                                  bytes(self.writebus), len(ram))
+        memoryview(buffer)[SNAPSHOT_HEADER.size:] = ram
+        return buffer
+
+    def restore(self, snapshot):
+        # Loads a snapshot (bytes, bytearray or memoryview) into this state.
+        if len(snapshot) < SNAPSHOT_HEADER.size:
+            raise ValueError("Save state is truncated")
+        (magic, version, options, registers, flags, pc, sp, shift_register,
+         readbus, writebus, length) = SNAPSHOT_HEADER.unpack_from(snapshot)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Not a save state")
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported save state version: {version}")
+        ram = memoryview(snapshot)[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + length]
+        if options & SNAPSHOT_COMPRESSED:
+            try:
+                ram = zlib.decompress(ram)
+            except zlib.error as error:
+                raise ValueError(f"Corrupt save state: {error}")
+        if len(ram) != self.MEMORY_SIZE:
+            raise ValueError(f"Save state RAM is {len(ram)} bytes, expected {self.MEMORY_SIZE}")
+
+        self.registers[:] = registers
+        self.flags = flags
+        self.pc = pc
+        self.sp = sp
+        self.shift_register = shift_register
+        self.readbus[:] = readbus
+        self.writebus[:] = writebus
+        if self.on_code_write:
+            # translations of pages that stay the same stay valid
+            for page, translated in enumerate(self.code_pages):
+                if translated and ram[page << 8:(page + 1) << 8] != self.ram[page << 8:(page + 1) << 8]:
+                    self.on_code_write(page, page)
+        self.ram[:] = ram
+        self.vram_dirty[:] = b'\x01' * self.VRAM_ROWS
+
+    def __getstate__(self):
+        # the recompiler hook is not part of the machine state
+        state = self.__dict__.copy()
+        state['code_pages'] = bytearray(len(self.code_pages))
+        state['on_code_write'] = None
+        state.pop('get_ram', None) # counting, see start_counting
+        state.pop('set_ram', None)
+        return state
+
 
     def get_flag(self, flag:str) -> bool:
-        return bool(self.flags[flag_indices[flag]])
+        return bool(self.flags & flag_masks[flag])
     
     def set_flag(self, flag:str, value:bool):
-        self.flags[flag_indices[flag]] = int(value)
+        if value:
+            self.flags |= flag_masks[flag]
+        else:
+            self.flags &= ~flag_masks[flag]
     
     def set_flags(self, values:dict[str, bool]):
         for (flag,value) in values.items():
@@ -72,35 +186,46 @@ class State():
 
     def get_psw(self) -> int:
         # convenience function for getting PSW
-        return bits_to_int(self.flags)
+        return self.flags
     
     def set_psw(self, psw:int):
-        self.flags = byte_to_bits(psw)
+        self.flags = psw & 0xff
+
+    # fast accessors - registers by index (reg_indices), pairs by pair_indices
+    def get_reg8(self, index:int) -> int:
+        return self.registers[index]
+
+    def set_reg8(self, index:int, value:int):
+        self.registers[index] = value & 0xff
 
+    def get_pair(self, pair:int) -> int:
+        if pair == PAIR_SP:
+            return self.sp
+        return (self.registers[pair << 1] << 8) | self.registers[(pair << 1) + 1]
+
+    def set_pair(self, pair:int, value:int):
+        if pair == PAIR_SP:
+            self.sp = value & 0xffff
+        else:
+            self.registers[pair << 1] = (value >> 8) & 0xff
+            self.registers[(pair << 1) + 1] = value & 0xff
+
+    # string API, e.g. set_reg('hl', 0x2400)
     def set_reg(self, reg_code, value):
         if type(value) == bytes or type(value) == bytearray:
             value = int.from_bytes(value)
         if reg_code in reg_indices:
-            register = reg_indices[reg_code]
-            self.registers[register] = value & 0xff
-        elif reg_code in ['bc','de','hl']:
-            register1, register2 = (reg_indices[reg_code[0]], reg_indices[reg_code[1]])
-            self.registers[register1] = (value >> 8) & 0xff
-            self.registers[register2] = value & 0xff
-        elif reg_code =='sp':
-            self.sp = value & 0xffff
+            self.registers[reg_indices[reg_code]] = value & 0xff
+        elif reg_code in pair_indices:
+            self.set_pair(pair_indices[reg_code], value)
         else:
             raise ValueError(f"Attempting to set non-existent register: {reg_code}")
         
     def get_reg(self, reg_code):
         if reg_code in reg_indices:
-            register = reg_indices[reg_code]
-            return self.registers[register]
-        elif reg_code in ['bc','de','hl']:
-            register1, register2 = (reg_indices[reg_code[0]], reg_indices[reg_code[1]])
-            return (self.registers[register1] << 8) | self.registers[register2]
-        elif reg_code == 'sp':
-            return self.sp
+            return self.registers[reg_indices[reg_code]]
+        elif reg_code in pair_indices:
+            return self.get_pair(pair_indices[reg_code])
         else:
             raise ValueError(f"Attempting to read non-existent register: {reg_code}")
     
@@ -132,17 +257,97 @@ class State():
         else:
             return self.ram[address]
 
-    def set_ram(self, address, data):
+    def ram_address(self, address):
+        # where set_ram stores address
         if address > self.MEMORY_SIZE:
             address = address - 0x2000 # RAM mirror
             # raise IndexError(f"Out of memory range at instruction {self.pc}. Attempt to write to {address}")
+        return address
+
+    def set_ram(self, address, data):
+        address = self.ram_address(address)
         if type(data) == int:
             data = data.to_bytes(1)
         elif type(data) == list:
             data = bytes(data)
         if type(data) != bytearray and type(data) != bytes:
             raise ValueError(f"Attempting to set RAM with wrong data type: {type(data)}")
+        if address < self.rom_end:
+            # the board ignores writes to ROM
+            data = data[self.rom_end - address:]
+            address = self.rom_end
+            if not data:
+                return
+        if self.on_code_write:
+            first_page, last_page = address >> 8, (address + len(data) - 1) >> 8
+            if (self.code_pages[first_page] if first_page == last_page
+                    else any(self.code_pages[first_page:last_page+1])):
+                # self-modifying code
+                self.on_code_write(first_page, last_page)
         self.ram[address:address+len(data)] = data
+        end = address + len(data)
+        if end > self.VRAM_START:
+            first_row = max(address - self.VRAM_START, 0) // self.VRAM_ROW_BYTES
+            last_row = min((end - 1 - self.VRAM_START) // self.VRAM_ROW_BYTES, self.VRAM_ROWS - 1)
+            if first_row == last_row:
+                self.vram_dirty[first_row] = 1
+            else:
+                self.vram_dirty[first_row:last_row+1] = b'\x01' * (last_row + 1 - first_row)
+
+    def start_counting(self, reads, writes):
+        # Opt-in access counts, see Coverage: until stop_counting, each byte
+        # read with get_ram adds one to reads[address] and each byte written
+        # with set_ram to writes[address] (MEMORY_SIZE long, e.g. array('Q')).
+        # Counting versions are swapped in over the methods, so the plain
+        # ones carry no checks.
+        self.stop_counting()
+        get_ram, set_ram, get_reg = self.get_ram, self.set_ram, self.get_reg
+        ram_address = self.ram_address
+        size = self.MEMORY_SIZE
+
+        def counted_get_ram(address_or_reg, end_address=None):
+            address = get_reg(address_or_reg) if isinstance(address_or_reg, str) else address_or_reg
+            data = get_ram(address, end_address)
+            if not end_address:
+                reads[address] += 1
+            else:
+                for counted in range(address, min(end_address, size)):
+                    reads[counted] += 1
+            return data
+
+        def counted_set_ram(address, data):
+            set_ram(address, data)
+            address = ram_address(address)
+            if type(data) == int:
+                if address < size:
+                    writes[address] += 1
+            else:
+                for counted in range(address, min(address + len(data), size)):
+                    writes[counted] += 1
+
+        self.get_ram = counted_get_ram
+        self.set_ram = counted_set_ram
+
+    def stop_counting(self):
+        self.__dict__.pop('get_ram', None)
+        self.__dict__.pop('set_ram', None)
+
+    def vram_dirty_spans(self) -> list[tuple[int, int]]:
+        # (first, end) runs of VRAM rows marked in vram_dirty
+        dirty = self.vram_dirty
+        spans = []
+        first = dirty.find(1)
+        while first != -1:
+            end = dirty.find(0, first)
+            if end == -1:
+                end = len(dirty)
+            spans.append((first, end))
+            first = dirty.find(1, end)
+        return spans
+
+    def protect_rom(self, end):
+        # from now on 0x0000 up to end is read only
+        self.rom_end = end
 
     def set_writebus(self, port, value):
         self.writebus[port] = value
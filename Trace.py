@@ -0,0 +1,228 @@
+import argparse
+import queue
+import struct
+import sys
+import threading
+from CPU import instruction_lengths
+from opcodebytes import Opcodebytes
+
+# Binary instruction traces (CPU.start_trace) and an offline tool to read
+# them:
+#
+#   python Trace.py show run.trace --pc 0x0ada --limit 20
+#   python Trace.py diff good.trace bad.trace
+#
+# File: a header (magic, version, options, record size) and then one fixed
+# record per instruction, the machine as it is before the instruction runs:
+#   cycle (since tracing started), PC, opcode, A, flags, BC, DE, HL, SP
+# Interrupts are recorded at the PC they arrive at, with the RST opcode.
+#
+# With branches_only, instructions are only recorded where control flow
+# arrives other than by falling through: after a taken jump, call, return,
+# RST or interrupt. Fewer records, and still enough to follow the path.
+
+MAGIC = b'SITR'
+VERSION = 1
+HEADER = struct.Struct('<4sHHH')
+RECORD = struct.Struct('<QHBBBHHHH')
+BRANCHES_ONLY = 0x0001 # options bit
+
+FIELDS = ['cycle', 'pc', 'opcode', 'a', 'flags', 'bc', 'de', 'hl', 'sp']
+
+opcode_names = {value: name for name, value in vars(Opcodebytes).items() if name.isupper()}
+
+
+class Tracer():
+    # Fills preallocated buffers of records; full ones go to a writer thread
+    # while the CPU carries on in the next.
+
+    def __init__(self, filename, branches_only=False, buffer_records=1 << 16, buffers=3):
+        self.branches_only = branches_only
+        self.file = open(filename, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, BRANCHES_ONLY if branches_only else 0,
+                                    RECORD.size))
+        self.free = queue.Queue()
+        for _ in range(buffers - 1):
+            self.free.put(bytearray(RECORD.size * buffer_records))
+        self.full = queue.Queue()
+        self.buffer = bytearray(RECORD.size * buffer_records)
+        self.offset = 0
+        self.cycles = 0
+        self.records = 0
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def record(self, state, opcode:int):
+        registers = state.registers
+        RECORD.pack_into(self.buffer, self.offset, self.cycles, state.pc, opcode,
+                         registers[6], state.flags,
+                         registers[0] << 8 | registers[1], registers[2] << 8 | registers[3],
+                         registers[4] << 8 | registers[5], state.sp)
+        self.offset += RECORD.size
+        self.records += 1
+        if self.offset == len(self.buffer):
+            self._flush()
+
+    def wrap(self, cpu, step):
+        # the CPU's step function and one for interrupts, recording as they run
+        state = cpu.state
+        execute = cpu._execute
+        ram = state.ram
+        record = self.record
+        memory_size = state.MEMORY_SIZE
+
+        def counted(used):
+            if used:
+                self.cycles += abs(used)
+            return used
+
+        if not self.branches_only:
+            def traced_step(limit=None):
+                record(state, ram[state.pc])
+                return counted(step())
+            def traced_execute(op):
+                record(state, op)
+                return counted(execute(op))
+        else:
+            def traced_step(limit=None):
+                pc = state.pc
+                next_pc = (pc + instruction_lengths[ram[pc]]) % memory_size
+                used = counted(step())
+                if state.pc != next_pc and used is not None:
+                    record(state, ram[state.pc])
+                return used
+            def traced_execute(op):
+                used = counted(execute(op))
+                record(state, ram[state.pc])
+                return used
+        return traced_step, traced_execute
+
+    def close(self):
+        self._flush()
+        self.full.put(None)
+        self.writer.join()
+        self.file.close()
+
+
+    def _flush(self):
+        self.full.put((self.buffer, self.offset))
+        self.buffer = self.free.get()
+        self.offset = 0
+
+    def _write(self):
+        while True:
+            item = self.full.get()
+            if item is None:
+                break
+            buffer, length = item
+            self.file.write(memoryview(buffer)[:length])
+            self.free.put(buffer)
+
+
+# Offline, with numpy
+
+def record_dtype():
+    import numpy as np
+    types = ['<u8', '<u2', 'u1', 'u1', 'u1', '<u2', '<u2', '<u2', '<u2']
+    return np.dtype(list(zip(FIELDS, types)))
+
+def load_trace(filename):
+    # (records as a numpy structured array, branches_only)
+    import numpy as np
+    with open(filename, 'rb') as file:
+        data = file.read()
+    if len(data) < HEADER.size:
+        raise ValueError(f"{filename} is not a trace")
+    magic, version, options, record_size = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{filename} is not a trace")
+    if version != VERSION or record_size != RECORD.size:
+        raise ValueError(f"Unsupported trace version: {version}")
+    body = memoryview(data)[HEADER.size:]
+    count = len(body) // RECORD.size
+    records = np.frombuffer(body, record_dtype(), count)
+    return records, bool(options & BRANCHES_ONLY)
+
+def select(records, pc=None, opcode=None, start_cycle=None, end_cycle=None):
+    # the records matching every filter given
+    import numpy as np
+    mask = np.ones(len(records), dtype=bool)
+    if pc is not None:
+        mask &= records['pc'] == pc
+    if opcode is not None:
+        mask &= records['opcode'] == opcode
+    if start_cycle is not None:
+        mask &= records['cycle'] >= start_cycle
+    if end_cycle is not None:
+        mask &= records['cycle'] < end_cycle
+    return records[mask]
+
+def format_record(record) -> str:
+    name = opcode_names.get(int(record['opcode']), f"{int(record['opcode']):02X}")
+    return (f"{int(record['cycle']):>10} {int(record['pc']):04X} {name:<8} "
+            f"A={int(record['a']):02X} F={int(record['flags']):02X} BC={int(record['bc']):04X} "
+            f"DE={int(record['de']):04X} HL={int(record['hl']):04X} SP={int(record['sp']):04X}")
+
+def disassemble(records) -> list[str]:
+    return [format_record(record) for record in records]
+
+def first_difference(first, second):
+    # index of the first record that differs, the shorter length if one
+    # trace is a prefix of the other, None if they are the same
+    import numpy as np
+    length = min(len(first), len(second))
+    differ = np.flatnonzero(first[:length] != second[:length])
+    if len(differ):
+        return int(differ[0])
+    return None if len(first) == len(second) else length
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Query binary instruction traces.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    show = commands.add_parser('show', help="print records")
+    show.add_argument('trace')
+    show.add_argument('--pc', type=lambda value: int(value, 0))
+    show.add_argument('--opcode', help="name, e.g. CALL, or number")
+    show.add_argument('--start-cycle', type=int)
+    show.add_argument('--end-cycle', type=int)
+    show.add_argument('--limit', type=int, default=50, help="records to print (default 50)")
+    diff = commands.add_parser('diff', help="find where two traces part")
+    diff.add_argument('first')
+    diff.add_argument('second')
+    diff.add_argument('--context', type=int, default=5, help="records shown before (default 5)")
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.command == 'show':
+        records, branches_only = load_trace(args.trace)
+        opcode = args.opcode
+        if opcode is not None:
+            opcode = getattr(Opcodebytes, opcode.upper(), None)
+            if opcode is None:
+                opcode = int(args.opcode, 0)
+        matches = select(records, args.pc, opcode, args.start_cycle, args.end_cycle)
+        print(f"{len(matches)} of {len(records)} records"
+              + (" (branches only)" if branches_only else ""))
+        for line in disassemble(matches[:args.limit]):
+            print(line)
+        return 0
+
+    first, _ = load_trace(args.first)
+    second, _ = load_trace(args.second)
+    index = first_difference(first, second)
+    if index is None:
+        print(f"Traces match ({len(first)} records).")
+        return 0
+    print(f"Traces differ at record {index}:")
+    start = max(index - args.context, 0)
+    for line in disassemble(first[start:index]):
+        print(f"  {line}")
+    for name, records in [(args.first, first), (args.second, second)]:
+        print(f"{name}: " + (format_record(records[index]) if index < len(records) else "ends"))
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from CPU import CPU
+from Machine import Machine
+from State import State
+
+# Gym-style environment over many machines, stepped together for agent
+# training:
+#
+#   env = VectorEnv(16, frames_per_step=4, stack=4, observation='pixels')
+#   observations = env.reset()
+#   observations, rewards, dones, info = env.step(actions)
+#
+# An action is an index into ACTIONS. The reward is the change in player 1's
+# score; an instance is done when its last ship is lost (or the CPU halts),
+# and is then reset straight away, so its observation is the first of the
+# next game.
+#
+# Observations, one row per instance, with the stack of the last frames
+# oldest first:
+#   'packed' - (instances, stack, 224, 32) uint8, VRAM as is, 8 pixels a byte
+#   'pixels' - (instances, stack, 224, 256) uint8, 1 for a lit pixel
+# Rows are VRAM rows, i.e. the unrotated screen. The returned arrays are
+# reused - step overwrites them.
+#
+# With workers, the machines are split between that many processes, which
+# write their frames straight into a shared memory buffer.
+
+# action -> port 1 bitmask (see Keyboard)
+ACTIONS = [
+    0x00, # nothing
+    0x20, # left
+    0x40, # right
+    0x10, # fire
+    0x30, # left and fire
+    0x50, # right and fire
+    0x01, # coin
+    0x04, # 1P start
+]
+
+ROWS = State.VRAM_ROWS
+ROW_BYTES = State.VRAM_ROW_BYTES
+FRAME_BYTES = ROWS * ROW_BYTES
+
+# byte -> its 8 pixels, bit 0 (the leftmost pixel) first
+BYTE_PIXELS = np.array([[value >> bit & 1 for bit in range(8)] for value in range(256)],
+                       dtype=np.uint8)
+
+
+def shared_arrays(buffer, count:int):
+    # the frames, rewards, dones and lives of count instances, laid out in buffer
+    sizes = [count * FRAME_BYTES, count * 4, count, count]
+    if buffer is None:
+        return sum(sizes)
+    frames = np.frombuffer(buffer, np.uint8, sizes[0], 0).reshape(count, ROWS, ROW_BYTES)
+    rewards = np.frombuffer(buffer, np.int32, count, sizes[0])
+    dones = np.frombuffer(buffer, np.bool_, count, sizes[0] + sizes[1])
+    lives = np.frombuffer(buffer, np.uint8, count, sizes[0] + sizes[1] + sizes[2])
+    return frames, rewards, dones, lives
+
+
+class MachineBatch():
+    # Machines stepped one after another in this process, writing their
+    # results into the given arrays (rows of the env's, or of shared memory).
+
+    def __init__(self, rom_image:bytes, config:dict, reset_script:dict, frames, rewards, dones, lives):
+        self.rom_image = rom_image
+        self.config = config
+        self.reset_script = reset_script or {}
+        self.frames = frames
+        self.rewards = rewards
+        self.dones = dones
+        self.lives = lives
+        self.machines = [None] * len(frames)
+        self.scores = [0] * len(frames)
+        self.had_lives = [False] * len(frames)
+
+    def reset(self, index:int):
+        machine = Machine(config=self.config)
+        machine.load_rom_image(self.rom_image)
+        script = self.reset_script
+        for frame in range(max(script, default=-1) + 1):
+            if frame in script:
+                machine.set_input(script[frame])
+            machine.run_frame()
+        self.machines[index] = machine
+        self.scores[index] = machine.scores()['player1']
+        self.had_lives[index] = machine.lives() > 0
+        self.lives[index] = machine.lives()
+        self._copy_frame(index)
+
+    def reset_all(self):
+        for index in range(len(self.machines)):
+            self.reset(index)
+        self.rewards[:] = 0
+        self.dones[:] = False
+
+    def step(self, actions, frames_per_step:int):
+        for index, machine in enumerate(self.machines):
+            machine.set_input(ACTIONS[actions[index]])
+            halted = False
+            for _ in range(frames_per_step):
+                if machine.run_frame() == CPU.STOP_HALT:
+                    halted = True
+                    break
+
+            score = machine.scores()['player1']
+            self.rewards[index] = score - self.scores[index]
+            self.scores[index] = score
+            lives = machine.lives()
+            done = halted or (lives == 0 and self.had_lives[index])
+            self.had_lives[index] = self.had_lives[index] or lives > 0
+            self.dones[index] = done
+            self.lives[index] = lives
+            if done:
+                self.reset(index)
+            else:
+                self._copy_frame(index)
+
+    def _copy_frame(self, index:int):
+        ram = self.machines[index].state.ram
+        self.frames[index] = np.frombuffer(ram, np.uint8, FRAME_BYTES, State.VRAM_START).reshape(ROWS, ROW_BYTES)
+
+
+def run_worker(rom_image:bytes, config:dict, reset_script:dict, frames_per_step:int,
+               memory_name:str, count:int, start:int, end:int, connection):
+    # Worker process body: steps instances start to end. Messages from the
+    # env: ('reset', None), ('step', actions) or None to stop; each answered
+    # with True once the results are in shared memory.
+    memory = shared_memory.SharedMemory(name=memory_name)
+    batch = MachineBatch(rom_image, config, reset_script,
+                         *(array[start:end] for array in shared_arrays(memory.buf, count)))
+    try:
+        while True:
+            message = connection.recv()
+            if message is None:
+                break
+            command, actions = message
+            if command == 'reset':
+                batch.reset_all()
+            else:
+                batch.step(actions, frames_per_step)
+            connection.send(True)
+    finally:
+        del batch # the arrays hold the shared buffer open
+        memory.close()
+        connection.close()
+
+
+class VectorEnv():
+
+    OBSERVATIONS = ['packed', 'pixels']
+
+    def __init__(self, num_envs:int, rom_image:bytes=None, rom_dir=Machine.ROM_DIR, config={},
+                 frames_per_step=1, stack=1, observation='packed', workers=0, reset_script=None):
+        # reset_script: {frame: port 1 bitmask} played on every reset, e.g. to
+        # insert a coin and start a game, so episodes are games
+        if observation not in self.OBSERVATIONS:
+            raise ValueError(f"Unknown observation: {observation}")
+        rom_image = rom_image if rom_image is not None else Machine.read_roms(rom_dir)
+        self.num_envs = num_envs
+        self.frames_per_step = frames_per_step
+        self.observation = observation
+        self.action_count = len(ACTIONS)
+
+        self.history = np.zeros((num_envs, stack, ROWS, ROW_BYTES), dtype=np.uint8)
+        if observation == 'pixels':
+            self.pixels = np.zeros((num_envs, stack, ROWS, ROW_BYTES * 8), dtype=np.uint8)
+            self.pixel_bytes = self.pixels.reshape(num_envs, stack, ROWS, ROW_BYTES, 8) # take() output
+        self.frames = np.zeros((num_envs, ROWS, ROW_BYTES), dtype=np.uint8)
+        self.rewards = np.zeros(num_envs, dtype=np.int32)
+        self.dones = np.zeros(num_envs, dtype=np.bool_)
+        self.lives = np.zeros(num_envs, dtype=np.uint8)
+        self.workers = []
+        self.memory = None
+        if workers:
+            # workers write into shared memory, copied out after each call so
+            # no array handed back to the caller keeps it open
+            self.memory = shared_memory.SharedMemory(create=True, size=shared_arrays(None, num_envs))
+            self.shared = shared_arrays(self.memory.buf, num_envs)
+            context = multiprocessing.get_context('spawn') # see CoreProcess
+            bounds = np.linspace(0, num_envs, min(workers, num_envs) + 1).astype(int)
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                connection, worker_connection = context.Pipe()
+                process = context.Process(target=run_worker, daemon=True, args=(
+                    rom_image, config, reset_script, frames_per_step,
+                    self.memory.name, num_envs, start, end, worker_connection))
+                process.start()
+                self.workers.append((process, connection, start, end))
+        else:
+            self.batch = MachineBatch(rom_image, config, reset_script,
+                                      self.frames, self.rewards, self.dones, self.lives)
+
+
+    def reset(self) -> np.ndarray:
+        self._run('reset', None)
+        self.history[:] = self.frames[:, None]
+        return self._observations()
+
+    def step(self, actions):
+        # actions: one ACTIONS index per instance
+        self._run('step', [int(action) for action in actions])
+        history = self.history
+        history[:, :-1] = history[:, 1:]
+        history[:, -1] = self.frames
+        # a new game starts with a stack of its first frame
+        history[self.dones] = self.frames[self.dones, None]
+        return self._observations(), self.rewards, self.dones, {'lives': self.lives}
+
+    def close(self):
+        for process, connection, start, end in self.workers:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process, connection, start, end in self.workers:
+            process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+            connection.close()
+        self.workers = []
+        if self.memory is not None:
+            del self.shared
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+
+    def _run(self, command, actions):
+        if not self.workers:
+            if command == 'reset':
+                self.batch.reset_all()
+            else:
+                self.batch.step(actions, self.frames_per_step)
+            return
+        # every worker gets its share first, so they all run at once
+        for process, connection, start, end in self.workers:
+            connection.send((command, actions and actions[start:end]))
+        for process, connection, start, end in self.workers:
+            connection.recv()
+        for local, shared in zip((self.frames, self.rewards, self.dones, self.lives), self.shared):
+            local[:] = shared
+
+    def _observations(self) -> np.ndarray:
+        if self.observation == 'packed':
+            return self.history
+        np.take(BYTE_PIXELS, self.history, axis=0, out=self.pixel_bytes)
+        return self.pixels
@@ -0,0 +1,68 @@
+import argparse
+import os
+import sys
+from benchmarks.workloads import WORKLOADS, DEFAULT_OPTIONS
+from benchmarks.runner import (run_benchmarks, save_results, load_results,
+                               compare, format_comparison)
+
+# python -m benchmarks [workload ...] from the repository root
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description="Time the emulator on fixed workloads.")
+    parser.add_argument('workloads', nargs='*', choices=[[]] + list(WORKLOADS),
+                        metavar='WORKLOAD', help=f"any of {', '.join(WORKLOADS)} (default all)")
+    parser.add_argument('--engine', default=DEFAULT_OPTIONS['engine'],
+                        choices=['table', 'recompiler', 'reference'])
+    parser.add_argument('--warmup', type=int, default=1, help="untimed runs first (default 1)")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs (default 5)")
+    parser.add_argument('--cycles', type=int, default=DEFAULT_OPTIONS['cycles'],
+                        help="cycle budget for the CP/M ROMs")
+    parser.add_argument('--frames', type=int, default=DEFAULT_OPTIONS['frames'],
+                        help="attract mode frames")
+    parser.add_argument('--roms', default=DEFAULT_OPTIONS['rom_dir'],
+                        help="directory holding invaders.h/g/f/e")
+    parser.add_argument('--replay', metavar='FILE',
+                        help="input recording for the replay workload (see Recording.py)")
+    parser.add_argument('--output', metavar='FILE', help="write JSON results")
+    parser.add_argument('--baseline', metavar='FILE', nargs='?', const=BASELINE,
+                        help=f"compare against stored results (default {BASELINE})")
+    parser.add_argument('--save-baseline', metavar='FILE', nargs='?', const=BASELINE,
+                        help="store these results as the baseline")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="slowdown counted as a regression (default 0.1 = 10%%)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.baseline and not os.path.exists(args.baseline):
+        # checked before the run, which can take a while
+        print(f"No baseline at {args.baseline} - run with --save-baseline first.",
+              file=sys.stderr)
+        return 2
+    options = {
+        'engine': args.engine,
+        'cycles': args.cycles,
+        'frames': args.frames,
+        'rom_dir': args.roms,
+        'replay': args.replay,
+    }
+    results = run_benchmarks(args.workloads, options, args.warmup, args.repeat)
+    if args.output:
+        save_results(results, args.output)
+    if args.save_baseline:
+        save_results(results, args.save_baseline)
+    if args.baseline:
+        rows = compare(results, load_results(args.baseline), args.threshold)
+        print(format_comparison(rows))
+        if any(row['regression'] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
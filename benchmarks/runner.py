@@ -0,0 +1,108 @@
+import json
+import platform
+import statistics
+import time
+from datetime import datetime, timezone
+from benchmarks.workloads import WORKLOADS, DEFAULT_OPTIONS, Skip
+
+# Times workloads and compares results against a stored baseline.
+# Results are JSON:
+# {"meta": {...}, "results": {name: {"seconds": [...], "median": s,
+#  "counts": {...}, "rates": {"instructions/sec": ..., ...}}}}
+
+RATE_NAMES = {
+    'instructions': 'instructions/sec',
+    'cycles': 'cycles/sec',
+    'frames': 'frames/sec',
+    'calls': 'calls/sec',
+}
+
+
+def time_workload(make_run, options, warmup=1, repeat=5) -> dict:
+    # Each repetition gets a fresh run function, so setup is never timed and
+    # every run starts from the same machine. Rates use the median time.
+    seconds = []
+    counts = None
+    for index in range(warmup + repeat):
+        run = make_run(options)
+        start = time.perf_counter()
+        counts = run()
+        elapsed = time.perf_counter() - start
+        if index >= warmup:
+            seconds.append(elapsed)
+    median = statistics.median(seconds)
+    return {
+        'seconds': seconds,
+        'median': median,
+        'counts': counts,
+        'rates': {RATE_NAMES[name]: count / median for name, count in counts.items()},
+    }
+
+
+def run_benchmarks(names=None, options={}, warmup=1, repeat=5, report=print) -> dict:
+    options = DEFAULT_OPTIONS | options
+    results = {}
+    skipped = {}
+    for name in names or WORKLOADS:
+        try:
+            results[name] = time_workload(WORKLOADS[name], options, warmup, repeat)
+        except Skip as reason:
+            skipped[name] = str(reason)
+            report(f"{name:14} skipped: {reason}")
+            continue
+        rates = ", ".join(f"{rate:,.0f} {rate_name}"
+                          for rate_name, rate in results[name]['rates'].items())
+        report(f"{name:14} {results[name]['median']:8.4f}s  {rates}")
+    return {
+        'meta': {
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'options': options,
+            'warmup': warmup,
+            'repeat': repeat,
+            'skipped': skipped,
+        },
+        'results': results,
+    }
+
+
+def save_results(results:dict, filename):
+    with open(filename, 'w') as file:
+        json.dump(results, file, indent=2)
+
+def load_results(filename) -> dict:
+    with open(filename) as file:
+        return json.load(file)
+
+
+def compare(current:dict, baseline:dict, threshold=0.1) -> list[dict]:
+    # One row per rate found in both result sets. A rate more than threshold
+    # (a fraction) below the baseline is a regression.
+    rows = []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        baseline_rates = baseline['results'][name]['rates']
+        for rate_name, rate in result['rates'].items():
+            if rate_name not in baseline_rates:
+                continue
+            change = rate / baseline_rates[rate_name] - 1
+            rows.append({
+                'workload': name,
+                'rate': rate_name,
+                'baseline': baseline_rates[rate_name],
+                'current': rate,
+                'change': change,
+                'regression': change < -threshold,
+            })
+    return rows
+
+def format_comparison(rows:list[dict]) -> str:
+    lines = []
+    for row in rows:
+        flag = "  REGRESSION" if row['regression'] else ""
+        lines.append(f"{row['workload']:14} {row['rate']:17} {row['baseline']:>16,.0f} "
+                     f"-> {row['current']:>16,.0f} {row['change']:+7.1%}{flag}")
+    return "\n".join(lines)
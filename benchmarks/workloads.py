@@ -0,0 +1,236 @@
+import os
+from State import State
+from Bus import Bus
+from CPU import CPU
+from Machine import Machine
+from opcodebytes import Opcodebytes
+from Recording import load_recording
+from Rewind import Rewind
+
+# Benchmark workloads.
+# A workload is a factory taking the benchmark options and returning a run
+# function. Setup happens in the factory, outside the timed region; the run
+# function does the timed work and returns counts of what it did:
+# 'instructions', 'cycles', 'frames' and/or 'calls'.
+
+TESTROMS = os.path.join(os.path.dirname(__file__), '..', 'testroms')
+CPM_START = 0x0100
+
+DEFAULT_OPTIONS = {
+    'engine': 'table',
+    'cycles': 2_000_000,    # cycle budget for the CP/M ROM workloads
+    'frames': 120,          # attract mode frames
+    'rom_dir': Machine.ROM_DIR,
+    'calls': 100_000,       # Bus.read/write calls per run
+    'renders': 100,         # render_screen calls per run
+    'replay': None,         # input recording for the replay workload
+}
+
+
+class Skip(Exception):
+    # raised by a workload factory when the workload cannot run here
+    pass
+
+
+def count_instructions(cpu:CPU, run):
+    # Run once on the dispatch table engine, counting instructions - the
+    # recompiler runs whole blocks and cannot count them itself. Interrupts
+    # are not counted.
+    count = 0
+    step_table = cpu._step_table
+    def counting_step(limit=None):
+        nonlocal count
+        count += 1
+        return step_table()
+    cpu._step = counting_step
+    run()
+    return count
+
+# instruction counts of (workload, options) - they do not depend on the engine
+instruction_counts = {}
+
+def cached_instruction_count(key, make_cpu, run_cpu):
+    if key not in instruction_counts:
+        cpu = make_cpu({'engine': 'table'})
+        instruction_counts[key] = count_instructions(cpu, lambda: run_cpu(cpu))
+    return instruction_counts[key]
+
+
+def cpm_rom(filename):
+    # a CP/M diagnostic ROM, run for a cycle budget
+    def make_run(options):
+        with open(os.path.join(TESTROMS, filename), 'rb') as file:
+            program = file.read()
+
+        def make_cpu(config):
+            state = State(romstart=CPM_START)
+            cpu = CPU(state, Bus(state), config)
+            state.set_ram(CPM_START, program)
+            state.set_ram(0x0000, Opcodebytes.HLT) # warm boot ends the run
+            state.set_ram(0x0005, Opcodebytes.RET) # BDOS calls print nothing
+            return cpu
+
+        def run_cpu(cpu):
+            # short ROMs are restarted until the budget is used up
+            state = cpu.state
+            cycles = 0
+            while cycles < options['cycles']:
+                used, stop_reason = cpu.run_until(options['cycles'] - cycles)
+                cycles += used
+                if stop_reason == CPU.STOP_HALT:
+                    # put back the pages the program wrote to, keeping the
+                    # recompiler's translations of the others
+                    for offset in range(0, len(program), 0x100):
+                        page = program[offset:offset + 0x100]
+                        address = CPM_START + offset
+                        if state.ram[address:address + len(page)] != page:
+                            state.set_ram(address, page)
+                    state.set_pc(CPM_START)
+            return cycles
+
+        instructions = cached_instruction_count((filename, options['cycles']),
+                                                make_cpu, run_cpu)
+        cpu = make_cpu({'engine': options['engine']})
+        def run():
+            return {'instructions': instructions, 'cycles': run_cpu(cpu)}
+        return run
+    return make_run
+
+
+def attract_mode(options):
+    # Space Invaders with no input, headless
+    try:
+        image = Machine.read_roms(options['rom_dir'])
+    except FileNotFoundError:
+        raise Skip(f"Space Invaders ROMs not found in {options['rom_dir']}")
+
+    def make_cpu(config):
+        machine = Machine(config=config)
+        machine.load_rom_image(image)
+        return machine.cpu
+
+    def run_cpu(cpu):
+        cycles = 0
+        for _ in range(options['frames']):
+            cycles += cpu.run_frame(Machine.CPF)[0]
+        return cycles
+
+    instructions = cached_instruction_count(('attract', options['frames'], options['rom_dir']),
+                                            make_cpu, run_cpu)
+    cpu = make_cpu({'engine': options['engine']})
+    def run():
+        return {'instructions': instructions, 'cycles': run_cpu(cpu),
+                'frames': options['frames']}
+    return run
+
+
+def replay_recording(options):
+    # Space Invaders played from an input recording (see Recording)
+    if not options['replay']:
+        raise Skip("no input recording given (--replay)")
+    try:
+        image = Machine.read_roms(options['rom_dir'])
+    except FileNotFoundError:
+        raise Skip(f"Space Invaders ROMs not found in {options['rom_dir']}")
+    frames = load_recording(options['replay'])
+
+    def make_cpu(config):
+        machine = Machine(config=config)
+        machine.load_rom_image(image)
+        return machine.cpu
+
+    def run_cpu(cpu):
+        cycles = 0
+        for port1 in frames:
+            cpu.state.set_readbus(1, port1)
+            cycles += cpu.run_frame(Machine.CPF)[0]
+        return cycles
+
+    instructions = cached_instruction_count(('replay', options['replay'], options['rom_dir']),
+                                            make_cpu, run_cpu)
+    cpu = make_cpu({'engine': options['engine']})
+    def run():
+        return {'instructions': instructions, 'cycles': run_cpu(cpu), 'frames': len(frames)}
+    return run
+
+
+def rewind_record(options):
+    # Rewind.record on attract mode frames, played back from snapshots so
+    # only the recording is timed
+    try:
+        image = Machine.read_roms(options['rom_dir'])
+    except FileNotFoundError:
+        raise Skip(f"Space Invaders ROMs not found in {options['rom_dir']}")
+    machine = Machine()
+    machine.load_rom_image(image)
+    snapshots = []
+    for _ in range(options['frames']):
+        machine.run_frame()
+        snapshots.append(machine.state.snapshot())
+
+    state = State()
+    rewind = Rewind(state, max_bytes=1 << 40)
+    def run():
+        for snapshot in snapshots:
+            state.restore(snapshot)
+            rewind.record()
+        return {'frames': len(snapshots)}
+    return run
+
+
+def render_screen(options):
+    # NumpyDisplay.Display.render_screen on a busy screen
+    if 'SDL_VIDEODRIVER' not in os.environ:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    from NumpyDisplay import Display
+    state = State()
+    state.set_ram(Machine.VRAM_START, bytes(range(256)) * 28) # 7K of VRAM
+    display = Display(state)
+    all_rows = b'\x01' * State.VRAM_ROWS
+    def run():
+        for _ in range(options['renders']):
+            state.vram_dirty[:] = all_rows # a full redraw, not a skipped frame
+            display.render_screen()
+        return {'frames': options['renders']}
+    return run
+
+
+def bus_write(options):
+    # shift register writes, the busiest ports in the game
+    state = State()
+    bus = Bus(state)
+    def run():
+        write = bus.write
+        for value in range(options['calls'] // 2):
+            write(4, value & 0xff)
+            write(2, value & 0x07)
+        return {'calls': options['calls'] // 2 * 2}
+    return run
+
+
+def bus_read(options):
+    # shift register and input port reads
+    state = State()
+    bus = Bus(state)
+    bus.write(4, 0x5a)
+    bus.write(4, 0xa5)
+    def run():
+        read = bus.read
+        for _ in range(options['calls'] // 2):
+            read(3)
+            read(1)
+        return {'calls': options['calls'] // 2 * 2}
+    return run
+
+
+WORKLOADS = {
+    'tst8080': cpm_rom('TST8080.COM'),
+    'cputest': cpm_rom('CPUTEST.COM'),
+    '8080pre': cpm_rom('8080PRE.COM'),
+    'attract': attract_mode,
+    'replay': replay_recording,
+    'rewind': rewind_record,
+    'render_screen': render_screen,
+    'bus_write': bus_write,
+    'bus_read': bus_read,
+}
@@ -4,6 +4,9 @@ class Opcodebytes():
     # NOP - no operation
     NOP     = 0x00
 
+    # HLT - halt
+    HLT     = 0x76
+
     # Data transfer group
     #   Move operations (MOV)
     MOV_B_B = 0x40
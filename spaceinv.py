@@ -1,21 +1,27 @@
-import pickle
+import argparse
+import time
 import pygame
-from NumpyDisplay import Display
-from State import State
 from Bus import Bus
+from CoreProcess import CoreProcess
+from CallProfiler import CallProfiler, load_labels
+from Coverage import Coverage
 from CPU import CPU
 from Keyboard import Keyboard
+from Machine import Machine, load_input_script
 from opcodebytes import Opcodebytes
+from Profiler import Profiler
+from Recording import save_recording
+from Rewind import Rewind
+from RunAhead import RunAhead, measure_latency
 from Soundboard import Soundboard
+from Trace import Tracer
+from State import State
 
 
-rom_filenames = [r'roms\invaders.h',r'roms\invaders.g',r'roms\invaders.f',r'roms\invaders.e']
-
-
-FPS = 60 # Frames per second
-CPF = 2_000_000 // FPS # cycles per frame on a 2MHz 8080
-ROMSTART = 0x0000
+FPS = Machine.FPS # Frames per second
+CPF = Machine.CPF # cycles per frame on a 2MHz 8080
 show_fps = True
+SAVE_FILE = 'state.sav' # see State.snapshot
 
 # Create a value-to-name mapping - for debugging
 # vars(MyClass) returns a dictionary of class attributes
@@ -32,14 +38,17 @@ def wait_for_key(state):
                     waiting = False
                 elif event.key == pygame.K_s:
                     # save state
-                    with open('state.pkl', 'wb') as file:
-                        pickle.dump(state, file)
+                    with open(SAVE_FILE, 'wb') as file:
+                        file.write(state.snapshot(compress=True))
                     print("Saved state.")
                 elif event.key == pygame.K_l:
-                    with open('state.pkl', 'rb') as file:
-                        new_state = pickle.load(file)
-                        state.copy(new_state)
-                    print("Loaded state.")
+                    try:
+                        with open(SAVE_FILE, 'rb') as file:
+                            state.restore(file.read())
+                    except (OSError, ValueError) as error:
+                        print(f"Could not load state: {error}")
+                    else:
+                        print("Loaded state.")
                 elif event.key == pygame.K_d:
                     print("Debug mode enabled.")
                     return True # go into step mode
@@ -53,37 +62,143 @@ def print_debug_data(state):
     print(state)
     print()
 
-def main():
-    pygame.init()
+def debug_frame(cpu, state):
+    # one frame, an instruction at a time, printing the machine after each
+    current_cycles = 0
+    screen_bottom = False  # for interrupts
+    while (current_cycles < CPF):
+        cycles = cpu.run_cycle()
+        if (cycles is None):
+            print("Halt code executed.")
+            quit()
+        current_cycles += abs(cycles)
+        print_debug_data(state)
 
-    state = State(romstart=ROMSTART)
-    display = Display(state)
-    soundboard = Soundboard()
-    bus = Bus(state, soundboard)
-    cpu = CPU(state, bus)
-    keyboard = Keyboard(bus)
+        # Interrupts here
+        # RST 1 opcode at middle of frame
+        if not screen_bottom and current_cycles >= (CPF // 2):
+            current_cycles += cpu.run_cycle(CPU.RST_MIDSCREEN)
+            screen_bottom = True
+        # RST 2 opcode at end of frame
+        elif screen_bottom and current_cycles >= CPF:
+            current_cycles += cpu.run_cycle(CPU.RST_VBLANK)
+            screen_bottom = False
+
+def run_headless(frames:int, script:dict[int, int]=None, rom_dir=Machine.ROM_DIR,
+                 config={}, latency_ahead=None, trace=None, trace_branches=False,
+                 profiler=None) -> dict:
+    # No window, mixer or frame throttle - run the machine as fast as it goes
+    # for a number of frames. script maps frame numbers to port 1 bitmasks.
+    # With latency_ahead (run-ahead frames), then measures input latency.
+    # trace: file for a binary instruction trace (see Trace)
+    # profiler: a Profiler, CallProfiler or Coverage to run the frames under
+    script = script or {}
+    machine = Machine(config=config)
+    machine.load_roms(rom_dir)
+    tracer = Tracer(trace, trace_branches) if trace else None
+    if tracer:
+        machine.cpu.start_trace(tracer)
+    elif profiler:
+        machine.cpu.start_profile(profiler)
+
+    end_frame = getattr(profiler, 'end_frame', None) # see Coverage
+
+    start = time.perf_counter()
+    try:
+        for frame in range(frames):
+            if frame in script:
+                machine.set_input(script[frame])
+            stop_reason = machine.run_frame()
+            if end_frame:
+                end_frame()
+            if stop_reason == CPU.STOP_HALT:
+                print("Halt code executed.")
+                break
+    finally:
+        if tracer:
+            machine.cpu.stop_trace()
+            tracer.close()
+        elif profiler:
+            machine.cpu.stop_profile()
+    seconds = time.perf_counter() - start
+
+    stats = {
+        'frames': machine.frames,
+        'cycles': machine.cycles,
+        'seconds': seconds,
+        'fps': machine.frames / seconds,
+        'mhz': machine.cycles / seconds / 1_000_000,
+        'vram_hash': machine.vram_hash(),
+    }
+    if tracer:
+        stats['trace_records'] = tracer.records
+    if latency_ahead is not None:
+        coin = machine.state.get_readbus(1) | 0x01
+        stats['latency'] = measure_latency(machine, coin, latency_ahead)
+    return stats
+
+
+def write_coverage(coverage:Coverage, prefix:str):
+    # prefix.asm (the ROM, annotated) and prefix.png (traffic per frame)
+    coverage.write_disassembly(prefix + '.asm')
+    coverage.write_heatmap(prefix + '.png')
+    summary = coverage.summary()
+    rom = summary['rom']['executed_addresses']
+    print(f"Coverage: {rom} ROM addresses executed; accesses "
+          f"{summary['vram']['access_percent']:.1f}% VRAM, "
+          f"{summary['work_ram']['access_percent']:.1f}% work RAM, "
+          f"{summary['rom']['access_percent']:.1f}% ROM. "
+          f"Written to {prefix}.asm and {prefix}.png")
+
+
+def select_display(backend='auto'):
+    # NumpyDisplay when numpy is installed, the plain pygame one otherwise
+    if backend in ('auto', 'numpy'):
+        try:
+            from NumpyDisplay import Display
+            return Display
+        except ImportError:
+            if backend == 'numpy':
+                raise
+    from PygameDisplay import Display
+    return Display
+
+
+def main(rom_dir=Machine.ROM_DIR, config={}, glow='full', backend='auto',
+         rewind_bytes=4_000_000, rewind_every=1, run_ahead_frames=0, record=None,
+         coverage=None):
+    # rewind_bytes: memory for the rewind history, 0 for none (see Rewind)
+    # run_ahead_frames: frames of input lag to hide (see RunAhead)
+    # record: file to save the input to (see Recording); turns rewind off,
+    # which would break the replay
+    # coverage: file name prefix for the coverage reports (see Coverage);
+    # turns rewind off, whose replayed frames would be counted again
+    pygame.init()
 
+    machine = Machine(Soundboard(), config)
+    state, cpu = machine.state, machine.cpu
+    display = select_display(backend)(state, glow=glow)
+    keyboard = Keyboard(machine.bus)
+    rewind = (Rewind(state, rewind_bytes, rewind_every)
+              if rewind_bytes and not record and not coverage else None)
+    if record:
+        keyboard.start_recording()
+    run_ahead = RunAhead(machine, run_ahead_frames) if run_ahead_frames else None
+    counts = Coverage() if coverage else None
 
     #####################################################
     ### load the program roms
-    # invaders.h 0000-07FF
-    # invaders.g 0800-0FFF
-    # invaders.f 1000-17FF
-    # invaders.e 1800-1FFF
-    for r in range(4):
-        with open(rom_filenames[r],'rb') as file:
-            full_rom = file.read()
-            state.set_ram(ROMSTART+(r*0x800), full_rom)
+    machine.load_roms(rom_dir)
+    if counts:
+        cpu.start_profile(counts)
 
     clock = pygame.time.Clock()
     running = True
     step = False
-    print("Space to pause.")
+    print("Space to pause." + (" Backspace to rewind." if rewind else ""))
 
     ### MAIN FRAME LOOP
     while(running):
-        screen_bottom = False  # for interrupts
-
         # 1. Event handling loop
         # wait_for_input = True
         # while (wait_for_input):
@@ -96,50 +211,189 @@ def main():
 
 
         # 2. cpu frame
-        current_cycles = 0
-
         next_step = False
+        frame_ran = False
         if step:
             keys = pygame.key.get_pressed()
             if keys[pygame.K_d]:
                 next_step = True
-        if (next_step and step) or not step:
-            while (current_cycles < CPF):
-
-                cycles = cpu.run_cycle()
-                if (cycles is None):
-                    print("Halt code executed.")
-                    quit()
-                elif cycles < 0:  # breakpoint
-                    step = True
-                    current_cycles -= cycles
-                else:
-                    current_cycles += cycles
-                
-                if step:
-                    print_debug_data(state)
-
-                # Interrupts here
-                # RST 1 opcode at middle of frame
-                if not screen_bottom and current_cycles >= (CPF // 2):
-                    current_cycles += cpu.run_cycle(0xcf)
-                    screen_bottom = True
-                # RST 2 opcode at end of frame
-                elif screen_bottom and current_cycles >= CPF:
-                    current_cycles += cpu.run_cycle(0xd7)
-                    screen_bottom = False
+        if next_step and step:
+            debug_frame(cpu, state)
+            keyboard.record_frame()
+        elif rewind and keyboard.rewinding:
+            rewind.step_back()
+        elif not step:
+            stop_reason = run_ahead.run_frame() if run_ahead else machine.run_frame()
+            if stop_reason == CPU.STOP_HALT:
+                print("Halt code executed.")
+                quit()
+            elif stop_reason == CPU.STOP_BREAKPOINT:
+                step = True
+            frame_ran = True
+            keyboard.record_frame()
+            if counts:
+                counts.end_frame()
 
 
         # 4. Update display
         if show_fps:
             display.add_fps(clock.get_fps())
+        display.add_frame_time(clock.get_rawtime())
         display.render_screen()
+        if frame_ran:
+            if run_ahead:
+                run_ahead.restore() # the look-ahead frame was only for show
+            if rewind:
+                rewind.record()
 
         # 5. sleep until FPS met
         clock.tick(FPS)
-        
 
+    if counts:
+        cpu.stop_profile()
+        write_coverage(counts, coverage)
+    if record:
+        save_recording(record, keyboard.recording)
+        print(f"Recorded {len(keyboard.recording)} frames of input to {record}.")
+    if rewind:
+        stats = rewind.stats()
+        print(f"Rewind: {stats['frames'] / FPS:.1f}s held in {stats['bytes'] / 1_000_000:.2f} MB, "
+              f"{stats['record_us']:.0f}us a snapshot")
+
+
+def main_core_process(rom_dir=Machine.ROM_DIR, config={}, glow='full', backend='auto'):
+    # The emulator runs in a worker process (see CoreProcess); this process
+    # only polls the keyboard, renders the published frames and plays sounds.
+    # No pause or step debugging in this mode.
+    pygame.init()
+
+    core = CoreProcess(Machine.read_roms(rom_dir), config)
+    core.start()
+
+    # a local board with no CPU: the keyboard sets its port 1, the display
+    # draws its VRAM and its bus plays the sounds the core reports
+    state = State(romstart=Machine.ROMSTART)
+    bus = Bus(state, Soundboard())
+    display = select_display(backend)(state, glow=glow)
+    keyboard = Keyboard(bus)
+
+    clock = pygame.time.Clock()
+    try:
+        while core.is_alive():
+            keyboard.get_state()
+            if keyboard.request_quit:
+                break
+            keyboard.clear_pause_request()
+            core.set_input(state.get_readbus(1))
+
+            for sound_index in core.poll_sounds():
+                bus.soundboard.play(sound_index)
+            core.read_frame(state)
+
+            if show_fps:
+                display.add_fps(clock.get_fps())
+            display.add_frame_time(clock.get_rawtime())
+            display.render_screen()
+            clock.tick(FPS)
+    finally:
+        core.stop()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Space Invaders on an emulated 8080.")
+    parser.add_argument('--headless', action='store_true',
+                        help="no window or sound, run unthrottled and print stats")
+    parser.add_argument('--frames', type=int, default=600,
+                        help="frames to run in headless mode (default 600)")
+    parser.add_argument('--input', metavar='FILE',
+                        help="scripted input for headless mode, lines of 'frame port1'")
+    parser.add_argument('--roms', default=Machine.ROM_DIR,
+                        help="directory holding invaders.h/g/f/e")
+    parser.add_argument('--engine', default='table',
+                        choices=['table', 'recompiler', 'reference'],
+                        help="CPU execution engine")
+    parser.add_argument('--glow', default='full', choices=['off', 'cheap', 'full'],
+                        help="CRT glow quality, lowered automatically when frames run late "
+                             "(numpy display only)")
+    parser.add_argument('--core-process', action='store_true',
+                        help="run the emulator in a separate process from the window")
+    parser.add_argument('--display', default='auto', choices=['auto', 'numpy', 'pygame'],
+                        help="display backend, by default numpy if it is installed")
+    parser.add_argument('--run-ahead', type=int, default=0, metavar='FRAMES',
+                        help="frames to run ahead of the shown frame, hiding that much input lag")
+    parser.add_argument('--latency', action='store_true',
+                        help="in headless mode, after the frames also measure the frames a coin "
+                             "takes to show on screen, with --run-ahead")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="in headless mode, write a binary instruction trace (see Trace.py)")
+    parser.add_argument('--trace-branches', action='store_true',
+                        help="trace only where a branch, call, return or interrupt lands")
+    parser.add_argument('--profile', metavar='FILE', nargs='?', const='',
+                        help="in headless mode, profile the CPU per opcode and print the "
+                             "hottest; FILE (.json or .csv) gets the full report")
+    parser.add_argument('--profile-by', default='opcode', choices=['opcode', 'handler'],
+                        help="profile rows: opcodes or the CPU handlers they share")
+    parser.add_argument('--flamegraph', metavar='FILE',
+                        help="in headless mode, follow the emulated call stack and write "
+                             "collapsed stacks of cycles for flame graph tools")
+    parser.add_argument('--labels', metavar='FILE',
+                        help="routine names for --flamegraph, lines of 'address name' in hex")
+    parser.add_argument('--coverage', metavar='PREFIX',
+                        help="count executions, reads and writes per address and write "
+                             "PREFIX.asm, the annotated ROM, and PREFIX.png, a traffic heatmap "
+                             "(turns rewind off)")
+    parser.add_argument('--record', metavar='FILE',
+                        help="save the input to FILE on quitting, for Recording.py to replay "
+                             "(turns rewind off)")
+    parser.add_argument('--rewind-memory', type=float, default=4, metavar='MB',
+                        help="memory for the rewind history, its two whole snapshots included, "
+                             "0 to turn rewind off (default 4)")
+    parser.add_argument('--rewind-every', type=int, default=1, metavar='N',
+                        help="frames between rewind snapshots (default 1)")
+    args = parser.parse_args(argv)
+    # each takes over the CPU's step function, see CPU._instrument
+    if sum([bool(args.trace), args.profile is not None, bool(args.flamegraph),
+            bool(args.coverage)]) > 1:
+        parser.error("only one of --trace, --profile, --flamegraph and --coverage at a time")
+    if args.coverage and args.run_ahead and not args.headless:
+        # the look-ahead frames would be counted as well
+        parser.error("--coverage cannot be used with --run-ahead")
+    return args
 
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    config = {'engine': args.engine}
+    if args.headless:
+        script = load_input_script(args.input) if args.input else None
+        profiler = Profiler() if args.profile is not None else None
+        if args.flamegraph:
+            profiler = CallProfiler(load_labels(args.labels) if args.labels else None)
+        elif args.coverage:
+            profiler = Coverage()
+        stats = run_headless(args.frames, script, args.roms, config,
+                             args.run_ahead if args.latency else None,
+                             args.trace, args.trace_branches, profiler)
+        print(f"{stats['frames']} frames in {stats['seconds']:.2f}s: "
+              f"{stats['fps']:.1f} frames/sec, {stats['mhz']:.3f} MHz")
+        print(f"VRAM hash: {stats['vram_hash']}")
+        if args.trace:
+            print(f"Traced {stats['trace_records']} records to {args.trace}")
+        if args.flamegraph:
+            print(profiler.report())
+            profiler.write_collapsed(args.flamegraph)
+        elif args.coverage:
+            write_coverage(profiler, args.coverage)
+        elif profiler:
+            print(profiler.report(args.profile_by))
+            if args.profile:
+                profiler.save(args.profile, args.profile_by)
+        if args.latency:
+            print(f"Input latency with {args.run_ahead} frames run-ahead: "
+                  f"{stats['latency']} frames")
+    elif args.core_process:
+        main_core_process(args.roms, config, args.glow, args.display)
+    else:
+        main(args.roms, config, args.glow, args.display,
+             int(args.rewind_memory * 1_000_000), args.rewind_every, args.run_ahead, args.record,
+             args.coverage)
@@ -0,0 +1,19 @@
+import pytest
+from Machine import Machine
+from opcodebytes import Opcodebytes
+
+
+@pytest.fixture
+def demo_rom():
+    # A ROM image for Machine tests: at every vblank (RST 2) it copies port 1
+    # into VRAM at DE, bumps DE and plays sound 1 (OUT 3, bit 1). The main
+    # program sets up and idles past the interrupt vectors.
+    image = bytearray(Machine.ROM_SIZE)
+    image[0x00:0x03] = [Opcodebytes.JMP, 0x20, 0x00]
+    image[0x08:0x0a] = [Opcodebytes.EI, Opcodebytes.RET]
+    image[0x10:0x1a] = [Opcodebytes.IN, 0x01, Opcodebytes.STAX_D, Opcodebytes.INX_D,
+                        Opcodebytes.MVI_A, 0x02, Opcodebytes.OUT, 0x03,
+                        Opcodebytes.EI, Opcodebytes.RET]
+    image[0x20:0x2a] = [Opcodebytes.LXI_SP, 0x00, 0x24, Opcodebytes.LXI_D, 0x00, 0x24,
+                        Opcodebytes.EI, Opcodebytes.JMP, 0x27, 0x00]
+    return bytes(image)
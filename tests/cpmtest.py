@@ -25,7 +25,7 @@ def main():
     pygame.init()
 
     state = State(romstart=ROMSTART)
-    bus = Bus()
+    bus = Bus(state)
     cpu = CPU(state, bus)
 
 
@@ -48,44 +48,58 @@ def main():
     
         # 3. cpu cycle
         CPF = 26000
-        current_cycles = 0
-
-        while (current_cycles < CPF):
-            # output handler
-            curr_address = state.get_pc()
-            next_ram = state.get_ram(curr_address, curr_address+3)
-            next_instruction = state.get_byte_at_pc()
-            if curr_address == 0x0005:
-                c_register = state.get_reg('c')
-                if c_register == 9:
-                    start = state.get_reg('de')
-                    end = state.find(b'$', start)
-                    bytestring = state.get_ram(start, end)
-                    print(bytestring.decode('ascii'))
-                elif c_register == 2:
-                    char = state.get_reg('e')
-                    print(chr(char), end='')
-                else:
-                    raise ValueError(f"Unrecognized output code in C register: {c_register}")
-
-
-            cycles = cpu.run_cycle()
-            if (cycles is None):
+
+        if DEBUG:
+            run_debug_frame(cpu, state, CPF)
+        else:
+            # stop in front of the BDOS entry point to print its output
+            cycles, stop_reason = cpu.run_until(CPF, breakpoints={0x0005})
+            if stop_reason == CPU.STOP_HALT:
                 print("Halt code executed.")
                 quit()
-            else:
-                current_cycles += cycles
-            
-            if DEBUG:
-                opcode = opcode_names[next_instruction]
-                print(f"Instruction: {opcode}")
-                print(f"RAM slice: {next_ram.hex(' ')}")
-                print(state)
-                input("Enter to continue")
+        bdos_output(state)
 
 
         # 5. sleep until FPS met
         clock.tick(FPS)
+
+
+def bdos_output(state):
+    # output handler
+    if state.get_pc() == 0x0005:
+        c_register = state.get_reg('c')
+        if c_register == 9:
+            start = state.get_reg('de')
+            end = state.find(b'$', start)
+            bytestring = state.get_ram(start, end)
+            print(bytestring.decode('ascii'))
+        elif c_register == 2:
+            char = state.get_reg('e')
+            print(chr(char), end='')
+        else:
+            raise ValueError(f"Unrecognized output code in C register: {c_register}")
+
+
+def run_debug_frame(cpu, state, CPF):
+    current_cycles = 0
+    while (current_cycles < CPF):
+        curr_address = state.get_pc()
+        next_ram = state.get_ram(curr_address, curr_address+3)
+        next_instruction = state.get_byte_at_pc()
+        bdos_output(state)
+
+        cycles = cpu.run_cycle()
+        if (cycles is None):
+            print("Halt code executed.")
+            quit()
+        else:
+            current_cycles += cycles
+
+        opcode = opcode_names[next_instruction]
+        print(f"Instruction: {opcode}")
+        print(f"RAM slice: {next_ram.hex(' ')}")
+        print(state)
+        input("Enter to continue")
         
 
 
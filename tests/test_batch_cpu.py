@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from State import State
+from Bus import Bus
+from CPU import CPU, instruction_cycles
+from Machine import Machine
+from BatchCPU import BatchCPU
+
+LANES = 16
+# opcodes CPU does not implement, and HLT
+SKIPPED = {0x08, 0x10, 0x18, 0x20, 0x28, 0x30, 0x38, 0xcb, 0xd9, 0xdd, 0xed, 0xfd, 0x76}
+PORTS = {0xdb: 4, 0xd3: 7} # IN, OUT: number of ports
+
+
+def random_state(rng, op):
+    # random registers and memory, with every address the instruction can
+    # use inside memory, as CPU raises past its end
+    state = State()
+    state.ram[:] = rng.bytes(State.MEMORY_SIZE)
+    state.registers[:] = rng.bytes(7)
+    for pair in range(3):
+        state.set_pair(pair, int(rng.integers(0x2000, 0x3ff0)))
+    state.sp = int(rng.integers(0x2000, 0x3ff0))
+    state.flags = int(rng.integers(256))
+    state.pc = int(rng.integers(0x2000, 0x3ff0))
+    state.ram[state.pc:state.pc + 3] = bytes([op, int(rng.integers(256)), int(rng.integers(0x20, 0x3f))])
+    if op in PORTS: # CPU raises on ports with no bus entry
+        state.ram[state.pc + 1] = int(rng.integers(PORTS[op]))
+    state.writebus = [int(value) for value in rng.integers(256, size=7)]
+    state.readbus = [int(value) for value in rng.integers(256, size=4)]
+    state.shift_register = int(rng.integers(65535))
+    return state
+
+def machine_state(state):
+    return (bytes(state.registers), state.flags, state.pc, state.sp, bytes(state.ram),
+            list(state.writebus), state.shift_register)
+
+def step_both(states):
+    # one instruction on CPU for each state, and across the lanes of a BatchCPU
+    batch = BatchCPU(len(states))
+    for lane, state in enumerate(states):
+        batch.from_state(lane, state)
+    cycles = batch.step()
+    expected = []
+    for lane, state in enumerate(states):
+        expected.append(CPU(state, Bus(state)).run_cycle())
+        lane_state = State()
+        batch.to_state(lane, lane_state)
+        assert machine_state(lane_state) == machine_state(state), f"lane {lane}"
+    assert list(cycles) == expected
+
+@pytest.mark.parametrize('op', [op for op in range(256) if op not in SKIPPED])
+def test_opcode_matches_cpu(op):
+    rng = np.random.default_rng(op)
+    step_both([random_state(rng, op) for _ in range(LANES)])
+
+def test_lanes_grouped_by_opcode():
+    rng = np.random.default_rng(1)
+    ops = [op for op in range(256) if op not in SKIPPED]
+    step_both([random_state(rng, ops[int(rng.integers(len(ops)))]) for _ in range(64)])
+
+def test_halted_lane_stops():
+    batch = BatchCPU(2)
+    batch.ram[:, 0] = [0x76, 0x00]
+    assert list(batch.step()) == [0, 4]
+    assert list(batch.halted) == [True, False]
+    assert list(batch.run_until(100)) == [0, 100]
+
+def test_frames_match_machine(demo_rom):
+    # lanes with different input against one Machine each
+    inputs = [0x00, 0x10, 0x20, 0x45]
+    batch = BatchCPU(len(inputs))
+    batch.load_rom_image(demo_rom)
+    batch.set_input(inputs)
+    for _ in range(4):
+        cycles = batch.run_frame()
+    for lane, port1 in enumerate(inputs):
+        machine = Machine()
+        machine.load_rom_image(demo_rom)
+        machine.set_input(port1)
+        for _ in range(4):
+            machine_cycles, _ = machine.cpu.run_frame(Machine.CPF)
+        assert batch.vram(lane) == machine.vram()
+        assert cycles[lane] == machine_cycles
+        assert batch.pc[lane] == machine.state.pc
+
+def test_rom_is_read_only(demo_rom):
+    batch = BatchCPU(1)
+    batch.load_rom_image(demo_rom)
+    batch.registers[:, 0] = [0, 0, 0, 0, 0x00, 0x10, 0x55] # HL = 0x0010
+    batch.ram[0, 0x3000] = 0x77 # MOV M,A
+    batch.pc[0] = 0x3000
+    batch.step()
+    assert batch.ram[0, 0x0010] == demo_rom[0x0010]
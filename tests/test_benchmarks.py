@@ -0,0 +1,36 @@
+from benchmarks.runner import run_benchmarks, compare
+
+
+def small_run(names, engine='table'):
+    options = {'engine': engine, 'cycles': 20_000, 'calls': 100}
+    return run_benchmarks(names, options, warmup=0, repeat=2, report=lambda line: None)
+
+def test_results_have_rates():
+    results = small_run(['tst8080', 'bus_read'])
+    tst = results['results']['tst8080']
+    assert len(tst['seconds']) == 2
+    assert tst['counts']['cycles'] >= 20_000
+    assert set(tst['rates']) == {'instructions/sec', 'cycles/sec'}
+    assert results['results']['bus_read']['counts'] == {'calls': 100}
+
+def test_instruction_count_same_on_every_engine():
+    counts = [small_run(['8080pre'], engine)['results']['8080pre']['counts']
+              for engine in ['table', 'recompiler']]
+    assert counts[0] == counts[1]
+
+def test_missing_roms_skip_attract_mode(tmp_path):
+    results = run_benchmarks(['attract'], {'rom_dir': str(tmp_path)}, report=lambda line: None)
+    assert 'attract' in results['meta']['skipped']
+    assert results['results'] == {}
+
+def test_compare_flags_regressions():
+    def results(rate):
+        return {'results': {'cputest': {'rates': {'cycles/sec': rate}}}}
+    assert not compare(results(95), results(100), threshold=0.1)[0]['regression']
+    assert compare(results(85), results(100), threshold=0.1)[0]['regression']
+    assert compare(results(85), {'results': {}}) == []
+
+def test_missing_baseline_is_reported(tmp_path, capsys):
+    from benchmarks.__main__ import main
+    assert main(['cputest', '--baseline', str(tmp_path / 'baseline.json')]) == 2
+    assert '--save-baseline' in capsys.readouterr().err
@@ -0,0 +1,68 @@
+import pytest
+from CallProfiler import CallProfiler, load_labels
+from Machine import Machine
+from opcodebytes import Opcodebytes as O
+
+
+@pytest.fixture
+def call_rom():
+    # main loop calls 0030, which calls 0038; 0038 has a conditional call
+    # and return that are never taken. The vblank handler calls 0040.
+    image = bytearray(Machine.ROM_SIZE)
+    image[0x00:0x03] = [O.JMP, 0x20, 0x00]
+    image[0x08:0x0a] = [O.EI, O.RET]
+    image[0x10:0x15] = [O.CALL, 0x40, 0x00, O.EI, O.RET]
+    image[0x20:0x2a] = [O.LXI_SP, 0x00, 0x24, O.EI, O.CALL, 0x30, 0x00, O.JMP, 0x24, 0x00]
+    image[0x30:0x34] = [O.CALL, 0x38, 0x00, O.RET]
+    image[0x38:0x3e] = [O.XRA_A, O.CNZ, 0x40, 0x00, O.RNZ, O.RET]
+    image[0x40:0x42] = [O.NOP, O.RET]
+    return bytes(image)
+
+def profiled_run(rom, frames=3, **options):
+    machine = Machine()
+    machine.load_rom_image(rom)
+    profiler = CallProfiler(**options)
+    machine.cpu.start_profile(profiler)
+    for _ in range(frames):
+        machine.run_frame()
+    machine.cpu.stop_profile()
+    return machine, profiler
+
+def test_stacks_follow_calls(call_rom):
+    machine, profiler = profiled_run(call_rom, labels={0x30: 'outer'})
+    stacks = dict(profiler.collapsed())
+    assert sum(stacks.values()) == machine.cycles
+    assert stacks['reset;outer;0038'] > stacks['reset;outer'] > 0
+    assert all(stack.startswith('reset') for stack in stacks)
+    # 0040 is only called from the vblank handler
+    assert {stack for stack in stacks if stack.endswith('0040')} <= {
+        stack for stack in stacks if '0010 (interrupt);0040' in stack}
+    assert any(stack.endswith('0008 (interrupt)') for stack in stacks)
+
+def test_routines(call_rom):
+    machine, profiler = profiled_run(call_rom, labels={0x30: 'outer'})
+    routines = {routine['name']: routine for routine in profiler.routines()}
+    assert routines['reset']['total'] == machine.cycles
+    assert routines['outer']['total'] > routines['0038']['total'] >= routines['0038']['self']
+    assert profiler.report().splitlines()[1].startswith('reset')
+
+def test_unwinds_dropped_returns():
+    profiler = CallProfiler(max_depth=4)
+    profiler._enter((0x100, False), 0x23fe)
+    profiler._enter((0x200, False), 0x23fc) # never returns
+    profiler._leave(0x2400) # the return from 0x100
+    assert profiler._key() == ((None, False),)
+    for depth in range(6):
+        profiler._enter((depth, False), 0x2000 - 2 * depth)
+    assert len(profiler.frames) == 4
+    assert profiler.frames[0][0] == (None, False)
+
+def test_write_collapsed_and_labels(call_rom, tmp_path):
+    (tmp_path / 'labels').write_text("# routines\n0030 outer  \n38 inner # nested\n")
+    labels = load_labels(tmp_path / 'labels')
+    assert labels == {0x30: 'outer', 0x38: 'inner'}
+    _, profiler = profiled_run(call_rom, labels=labels)
+    profiler.write_collapsed(tmp_path / 'out.folded')
+    lines = (tmp_path / 'out.folded').read_text().splitlines()
+    assert 'reset;outer;inner' in [line.rsplit(' ', 1)[0] for line in lines]
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
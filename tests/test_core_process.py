@@ -0,0 +1,56 @@
+import time
+import pytest
+from State import State
+from Machine import Machine
+from CoreProcess import CoreProcess, Framebuffer, VRAM_SIZE
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        time.sleep(0.01)
+
+def test_framebuffer_double_buffer():
+    writer = Framebuffer()
+    reader = Framebuffer(writer.name)
+    vram = bytearray(VRAM_SIZE)
+    for frame in (1, 2, 3):
+        writer.publish(bytes([frame]) * VRAM_SIZE, frame)
+        assert reader.read(vram) == frame
+        assert vram == bytes([frame]) * VRAM_SIZE
+    reader.close()
+    writer.close()
+
+def test_core_runs_frames_and_takes_input(core):
+    state = State()
+    wait_for(lambda: core.read_frame(state) and core.frame >= 5)
+    core.set_input(0x15)
+    wait_for(lambda: core.read_frame(state) and 0x15 in state.ram[0x2400:0x2500])
+    assert core.poll_sounds() == [1]
+    assert state.vram_dirty[0] # rows copied in are marked for the display
+
+def test_frames_match_in_process_machine(core, demo_rom):
+    # with no input the published VRAM is that of a local machine after
+    # the same number of frames
+    state = State()
+    wait_for(lambda: core.read_frame(state) and core.frame >= 3)
+    machine = Machine()
+    machine.load_rom_image(demo_rom)
+    for _ in range(core.frame):
+        machine.run_frame()
+    assert state.ram[0x2400:0x4000] == machine.vram()
+
+def test_stop(core):
+    core.stop()
+    assert not core.is_alive()
+
+
+@pytest.fixture
+def core(demo_rom):
+    core = CoreProcess(demo_rom, throttle=False)
+    core.start()
+    yield core
+    if core.framebuffer.buffer is not None:
+        core.stop()
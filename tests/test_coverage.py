@@ -0,0 +1,121 @@
+import pickle
+from array import array
+import pygame
+import pytest
+from Bus import Bus
+from Coverage import Coverage, BLOCK
+from CPU import CPU
+from Machine import Machine
+from State import State
+from opcodebytes import Opcodebytes as O
+
+
+def covered_run(rom, frames=3, engine='table'):
+    machine = Machine(config={'engine': engine})
+    machine.load_rom_image(rom)
+    coverage = Coverage()
+    machine.cpu.start_profile(coverage)
+    for frame in range(frames):
+        machine.set_input(frame + 1)
+        machine.run_frame()
+        coverage.end_frame()
+    machine.cpu.stop_profile()
+    return machine, coverage
+
+def test_counts(demo_rom):
+    # see conftest: the vblank handler stores port 1 at DE, from 0x2400 on
+    machine, coverage = covered_run(demo_rom)
+    assert coverage.executed[0x0000] == 1
+    assert coverage.executed[0x0010] == 2 # the third vblank's runs next frame
+    assert coverage.executed[0x0003] == 0
+    assert coverage.writes[0x2400] == coverage.writes[0x2401] == 1
+    assert coverage.writes[0x2402] == 0
+    # return addresses pushed by the interrupts and popped by the RETs
+    pushes = sum(coverage.writes[0x23f0:0x2400])
+    assert pushes == 2 * 6
+    assert sum(coverage.reads[0x23f0:0x2400]) == 2 * 5
+
+def test_every_engine_counts_the_same(demo_rom):
+    counts = [covered_run(demo_rom, engine=engine)[1] for engine in ['table', 'recompiler', 'reference']]
+    for other in counts[1:]:
+        assert (other.executed, other.reads, other.writes) == (counts[0].executed, counts[0].reads, counts[0].writes)
+
+def test_memory_operands():
+    state = State()
+    cpu = CPU(state, Bus(state))
+    program = [O.LXI_H, 0x00, 0x21, O.MOV_A_M, O.INR_M, O.LHLD, 0x10, 0x22,
+               O.LXI_D, 0x00, 0x30, O.STAX_D, O.LXI_SP, 0x00, 0x24, O.PUSH_B, O.XTHL, O.POP_B,
+               O.HLT]
+    state.set_ram(0, program)
+    coverage = Coverage()
+    cpu.start_profile(coverage)
+    cpu.run_until(1000)
+    assert coverage.reads[0x2100] == 2 and coverage.writes[0x2100] == 1 # MOV A,M then INR M
+    assert coverage.reads[0x2210] == coverage.reads[0x2211] == 1
+    assert coverage.writes[0x3000] == 1
+    assert coverage.writes[0x23fe] == 2 and coverage.reads[0x23fe] == 2 # PUSH, XTHL, POP
+    assert sum(coverage.executed) == 11 # HLT included
+
+def test_summary_and_heatmap(demo_rom, tmp_path):
+    _, coverage = covered_run(demo_rom)
+    summary = coverage.summary()
+    assert summary['vram']['writes'] == 2
+    assert summary['rom']['executed_addresses'] > 5
+    assert sum(region['access_percent'] for region in summary.values()) == pytest.approx(100)
+    image = coverage.heatmap()
+    assert image.shape == (3, 16384 // BLOCK, 3)
+    assert image[0, 0x2400 // BLOCK, 0] == 0 # nothing written there in the first frame...
+    assert image[1, 0x2400 // BLOCK, 0] > 0  # ...then the first vblank store
+    coverage.write_heatmap(tmp_path / 'heat.png')
+    assert pygame.image.load(str(tmp_path / 'heat.png')).get_size() == (16384 // BLOCK, 3)
+
+def test_disassembly(demo_rom, tmp_path):
+    _, coverage = covered_run(demo_rom)
+    lines = coverage.disassembly()
+    assert lines[0].split() == ['1', '0000', 'c3', '20', '00', 'JMP', '0020']
+    assert lines[1].split()[0] == '-' # never run
+    assert len(lines) < Machine.ROM_SIZE
+    coverage.write_disassembly(tmp_path / 'rom.asm')
+    assert (tmp_path / 'rom.asm').read_text().count('\n') == len(lines) + 1
+
+def test_state_counting():
+    state = State()
+    reads, writes = array('Q', bytes(8 * State.MEMORY_SIZE)), array('Q', bytes(8 * State.MEMORY_SIZE))
+    state.start_counting(reads, writes)
+    state.set_ram(0x4100, 7) # the RAM mirror
+    state.set_ram(0x2200, b'\x01\x02\x03')
+    state.set_reg('hl', 0x2100)
+    assert state.get_ram('hl') == 7
+    assert state.get_ram(0x2200, 0x2202) == b'\x01\x02'
+    assert writes[0x2100] == 1 and writes[0x4100 % State.MEMORY_SIZE] == 0
+    assert list(writes[0x2200:0x2204]) == [1, 1, 1, 0]
+    assert reads[0x2100] == 1 and list(reads[0x2200:0x2203]) == [1, 1, 0]
+    assert pickle.loads(pickle.dumps(state)).get_ram(0x2100) == 7
+    state.stop_counting()
+    state.set_ram(0x2100, 8)
+    assert writes[0x2100] == 1
+    assert 'set_ram' not in vars(state) and 'get_ram' not in vars(state)
+
+def test_stop_profile_stops_counting(demo_rom):
+    machine, coverage = covered_run(demo_rom, 1)
+    assert 'set_ram' not in vars(machine.state)
+    counts = [list(coverage.executed), list(coverage.reads), list(coverage.writes)]
+    for _ in range(3): # the vblank handler stores into VRAM
+        machine.run_frame()
+    assert [list(coverage.executed), list(coverage.reads), list(coverage.writes)] == counts
+
+def test_heatmap_rows_are_bounded(demo_rom):
+    machine = Machine()
+    machine.load_rom_image(demo_rom)
+    coverage = Coverage(max_rows=4)
+    machine.cpu.start_profile(coverage)
+    for frame in range(10):
+        machine.set_input(frame + 1)
+        machine.run_frame()
+        coverage.end_frame()
+    machine.cpu.stop_profile()
+    # rows merge in pairs as they fill: 4 frames a row, and a partial row of 2
+    assert (coverage.rows, coverage.frames_per_row, coverage.row_frames) == (2, 4, 2)
+    assert len(coverage.traffic) == 4
+    assert coverage.heatmap().shape == (3, 16384 // BLOCK, 3)
+    assert coverage.traffic.sum(axis=(0, 2)).tolist() == [sum(coverage.reads), sum(coverage.writes)]
@@ -1,18 +1,98 @@
 import pytest
-from CPU import CPU
-from State import State, reg_indices
+from CPU import CPU, instruction_lengths, instruction_cycles
+from State import State, reg_indices, REG_A, PAIR_HL, PAIR_SP
 from Bus import Bus
 from opcodebytes import Opcodebytes
+import ALU
 
 # state tests
 def test_set_ram_bad_location(state):
     with pytest.raises(IndexError):
         state.set_ram(0xffff, 0xff)
 
+def test_rom_writes_ignored(state):
+    state.protect_rom(0x2000)
+    state.set_ram(0x1fff, [0x11, 0x22])
+    assert state.get_ram(0x1fff) == 0
+    assert state.get_ram(0x2000) == 0x22
+
 def test_set_reg(state):
     state.set_reg('c', 0xff)
     assert state.get_reg('c') == 0xff
 
+def test_reg_index_access(state):
+    state.set_reg8(REG_A, 0x1ff)
+    assert state.get_reg('a') == 0xff
+    state.set_pair(PAIR_HL, 0x2345)
+    assert state.get_reg('h') == 0x23
+    assert state.get_reg('l') == 0x45
+    state.set_pair(PAIR_SP, -1)
+    assert state.get_reg('sp') == 0xffff
+
+def test_packed_flags(state):
+    assert state.get_psw() == 0b00000010
+    state.set_flags({'z':True, 'c':True})
+    assert state.flags == 0b01000011
+    state.set_flag('c', False)
+    assert state.get_flag('c') == False
+    assert state.get_flag('z') == True
+    state.set_psw(0x1ff)
+    assert state.get_psw() == 0xff
+
+def fill_state(state):
+    state.set_reg('bc', 0x1234)
+    state.set_reg('hl', 0x2402)
+    state.set_reg('a', 0x56)
+    state.set_psw(0xd7)
+    state.set_pc(0x1abc)
+    state.set_sp(0x23f0)
+    state.set_shift_register(0xbeef)
+    state.set_readbus(1, 0x14)
+    state.set_writebus(2, 3)
+    state.set_ram(0x2400, [1, 2, 3])
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_snapshot_restore(state, compress):
+    fill_state(state)
+    snapshot = state.snapshot(compress=compress)
+    assert snapshot[:4] == b'8080'
+    restored = State()
+    restored.vram_dirty[:] = bytes(State.VRAM_ROWS)
+    restored.restore(memoryview(snapshot))
+    assert str(restored) == str(state)
+    assert restored.ram == state.ram
+    assert (restored.sp, restored.readbus, restored.writebus) == (state.sp, state.readbus, state.writebus)
+    assert restored.vram_dirty[0] == 1
+
+def test_snapshot_reuses_buffer(state):
+    first = state.snapshot()
+    state.set_ram(0x2000, 0x99)
+    assert state.snapshot(buffer=first) is first
+    assert first[-len(state.ram):] == state.ram
+
+def test_restore_rejects_bad_snapshots(state):
+    snapshot = state.snapshot()
+    with pytest.raises(ValueError):
+        state.restore(snapshot[:10])
+    with pytest.raises(ValueError):
+        state.restore(b'XXXX' + snapshot[4:])
+    snapshot[4] = 99 # version
+    with pytest.raises(ValueError):
+        state.restore(snapshot)
+
+def test_copy_does_not_alias(state):
+    fill_state(state)
+    other = State()
+    other.copy(state)
+    ram = other.ram
+    state.set_ram(0x2000, 0x42)
+    state.set_reg('a', 0x11)
+    state.set_writebus(2, 5)
+    assert other.ram is ram
+    assert other.get_ram(0x2000) == 0
+    assert other.get_reg('a') == 0x56
+    assert other.get_writebus(2) == 3
+
 # instruction tests
 def test_nop(cpu, state):
     state.ram[0] = Opcodebytes.NOP
@@ -531,14 +611,143 @@ def test_daa_cnc(cpu, state):
     assert state.get_flag('a') == True
 
 
+# ALU tables, checked entry by entry against the reference methods
+@pytest.mark.parametrize('table,use_negative', [(ALU.ADD, False), (ALU.SUB, True)])
+def test_alu_add_sub_tables(reference_cpu, state, table, use_negative):
+    for carry in (0, 1):
+        for acc_value in range(256):
+            for operand in range(256):
+                state.set_reg('a', acc_value)
+                state.set_psw(carry)
+                reference_cpu._add(operand, add_carry=True, use_negative=use_negative)
+                entry = table[(carry << 16) | (acc_value << 8) | operand]
+                assert entry & 0xff == state.get_reg('a')
+                assert entry >> 8 == state.get_psw() & ALU.ALU_FLAGS
+
+@pytest.mark.parametrize('table,negative', [(ALU.INC, False), (ALU.DEC, True)])
+def test_alu_inc_dec_tables(reference_cpu, state, table, negative):
+    for value in range(256):
+        state.set_reg('b', value)
+        state.set_psw(0)
+        reference_cpu._inc(register='b', negative=negative)
+        assert table[value] & 0xff == state.get_reg('b')
+        assert table[value] >> 8 == state.get_psw()
+
+def test_alu_szp_table(reference_cpu, state):
+    for value in range(256):
+        state.set_psw(0)
+        reference_cpu._set_nc_flags(value)
+        assert ALU.SZP[value] == state.get_psw()
+
+def test_alu_daa_table(reference_cpu, state):
+    for carry in (0, 1):
+        for aux_carry in (0, 1):
+            for acc_value in range(256):
+                for other_flags in (0b00000010, 0b11100110):
+                    state.set_reg('a', acc_value)
+                    state.set_psw(other_flags)
+                    state.set_flags({'a':aux_carry, 'c':carry})
+                    flags = state.get_psw()
+                    reference_cpu._daa()
+                    entry = ALU.DAA[(carry << 9) | (aux_carry << 8) | acc_value]
+                    assert entry & 0xff == state.get_reg('a')
+                    assert (flags & ~(entry >> 16)) | ((entry >> 8) & 0xff) == state.get_psw()
+
+
+# run_until
+def test_run_until_cycles(cpu, state):
+    # all NOPs
+    cycles, reason = cpu.run_until(100)
+    assert cycles == 100
+    assert reason == CPU.STOP_CYCLES
+    assert state.get_pc() == 25
+
+def test_run_until_halt(cpu, state):
+    state.ram[0:3] = [Opcodebytes.NOP, Opcodebytes.NOP, Opcodebytes.HLT]
+    cycles, reason = cpu.run_until(100)
+    assert cycles == 8
+    assert reason == CPU.STOP_HALT
+
+def test_run_until_breakpoint(cpu, state):
+    cycles, reason = cpu.run_until(100, breakpoints={0x0003})
+    assert (cycles, reason) == (12, CPU.STOP_BREAKPOINT)
+    # resuming runs the instruction at the breakpoint
+    cycles, reason = cpu.run_until(100, breakpoints={0x0003})
+    assert reason == CPU.STOP_CYCLES
+
+def test_run_until_events(cpu, state):
+    state.ram[0x0008] = Opcodebytes.HLT
+    cycles, reason = cpu.run_until(100, [(20, Opcodebytes.RST_1)])
+    assert reason == CPU.STOP_HALT
+    assert cycles == 20 + 11
+    assert state.get_ram(state.get_sp()) == 5 # return address
+
+def test_run_frame(cpu, state):
+    state.ram[0x0008] = Opcodebytes.RET
+    state.set_pc(0x0100)
+    cycles, reason = cpu.run_frame(1000)
+    assert reason == CPU.STOP_CYCLES
+    # RST 1 at 500 and its RET, NOPs up to 1001, then RST 2
+    assert cycles == 500 + 11 + 10 + 480 + 11
+    assert state.get_pc() == 0x0010
+    assert state.get_sp() == State.STACKSTART - 2
+
+
+# predecoded ROM
+def test_instruction_cycles_match_handlers(state, bus):
+    cpu = CPU(state, bus)
+    for op in range(256):
+        if op == Opcodebytes.HLT or op & 0b11000011 == 0b11000000: # conditional CALL/RET
+            continue
+        state.ram[0x2000:0x2003] = bytes([op, 0x00, 0x21])
+        state.set_pc(0x2000)
+        state.set_reg('hl', 0x2100)
+        state.set_sp(0x2300)
+        try:
+            cycles = cpu._step()
+        except NotImplementedError:
+            cycles = 0
+        assert cycles == instruction_cycles[op], f"{op:02x}"
+        jumps = op in (0xc3, 0xcd, 0xc9, 0xe9) or op & 0b11000111 in (0b11000010, 0b11000111)
+        if not jumps:
+            assert state.get_pc() == 0x2000 + instruction_lengths[op], f"{op:02x}"
+
+def test_predecoded_entries(state, bus):
+    cpu = CPU(state, bus)
+    state.ram[0:7] = [Opcodebytes.MVI_B, 0x12, Opcodebytes.NOP,
+                      Opcodebytes.JMP, 0x34, 0x12, Opcodebytes.LXI_H]
+    cpu.predecode_rom(7)
+    assert cpu.rom[0][1:] == (2, 0x12, 7)
+    assert cpu.rom[2][1:] == (1, None, 4)
+    assert cpu.rom[3][1:] == (3, 0x1234, 10)
+    # operand past the end of ROM is fetched at run time
+    assert cpu.rom[6][1] == 1
+
+def test_predecoded_rom_runs(state, bus):
+    cpu = CPU(state, bus)
+    state.ram[0:7] = [Opcodebytes.MVI_B, 0x12, Opcodebytes.LXI_H, 0x00, 0x21,
+                      Opcodebytes.JMP, 0x00]
+    state.ram[7] = 0x20
+    state.ram[0x2000:0x2002] = [Opcodebytes.MOV_M_B, Opcodebytes.HLT]
+    cpu.predecode_rom(7)
+    cycles, reason = cpu.run_until(1000)
+    assert reason == CPU.STOP_HALT
+    assert cycles == 7 + 10 + 10 + 7
+    assert state.get_ram(0x2100) == 0x12
+
+
 @pytest.fixture
 def state():
     return State()
 
 @pytest.fixture
-def bus():
-    return Bus()
+def bus(state):
+    return Bus(state)
 
 @pytest.fixture
-def cpu(state, bus):
-    return CPU(state, bus)
\ No newline at end of file
+def reference_cpu(state, bus):
+    return CPU(state, bus, {'engine': 'reference'})
+
+@pytest.fixture(params=['table', 'reference'])
+def cpu(state, bus, request):
+    return CPU(state, bus, {'engine': request.param})
\ No newline at end of file
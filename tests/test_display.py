@@ -0,0 +1,111 @@
+import os
+import pytest
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+from State import State
+from NumpyDisplay import Display
+
+
+def test_vram_writes_mark_rows(state):
+    state.vram_dirty[:] = bytes(State.VRAM_ROWS)
+    state.set_ram(0x2400 + 5*32 + 31, 0xff)
+    state.set_ram(0x2400 + 7*32 + 31, bytes(34)) # rows 7 to 9
+    state.set_ram(0x2300, 0xff)
+    assert [row for row, dirty in enumerate(state.vram_dirty) if dirty] == [5, 7, 8, 9]
+
+def test_first_frame_draws_everything(display):
+    rects = display.render_screen()
+    assert rects[0].width >= Display.HEIGHT*2
+
+def test_nothing_changed_skips_frame(display):
+    display.render_screen()
+    assert display.render_screen() == []
+
+def test_only_changed_rows_update(display, state):
+    display.render_screen()
+    state.set_ram(0x2400 + 100*32, 0xff)
+    state.set_ram(0x2400 + 150*32, 0xff)
+    rects = display.render_screen()
+    assert len(rects) == 2
+    assert rects[0].collidepoint(200, 0)
+    assert rects[1].collidepoint(300, 0)
+    assert not any(rect.collidepoint(250, 0) for rect in rects)
+
+def test_dirty_spans(state):
+    state.vram_dirty[:] = bytes(State.VRAM_ROWS)
+    state.vram_dirty[3:6] = b'\x01\x01\x01'
+    state.vram_dirty[223] = 1
+    assert state.vram_dirty_spans() == [(3, 6), (223, 224)]
+
+def test_rotation(display, state):
+    # bit 0 of a row's first byte is the bottom pixel of its column
+    state.set_ram(0x2400 + 100*32, 0b00000001) # outside the cellophane
+    display.render_screen()
+    assert display.native_surface.get_at((100, 255))[:3] == Display.PIXEL_ON
+    assert display.native_surface.get_at((100, 254))[:3] == Display.PIXEL_OFF
+
+def test_frames_reuse_surfaces(display, state):
+    surfaces = (display.native_surface, display.screen_surface, display.glow_surface)
+    for value in (0xff, 0x00):
+        state.set_ram(0x2400, value)
+        display.render_screen()
+    assert (display.native_surface, display.screen_surface, display.glow_surface) == surfaces
+
+def test_cellophane_colors_lit_pixels(display, state):
+    state.set_ram(0x2400 + 100*32 + 3, 0xff) # x 24-31: under the green gel
+    state.set_ram(0x2400 + 100*32 + 4, 0x0f) # x 32-35 green, 36-39 dark
+    display.render_screen()
+    green = display.native_surface.get_at((100, 255 - 24))[:3]
+    assert green[1] > green[0] and green[1] > green[2]
+    assert display.native_surface.get_at((100, 255 - 35))[:3] == green
+    assert display.native_surface.get_at((100, 255 - 36))[:3] == Display.PIXEL_OFF
+
+def test_overlay_layout_is_data(state):
+    display = Display(state, overlay=[((0, 0, 256, 10), (0, 0, 255, 255))])
+    state.set_ram(0x2400 + 5*32 + 16, 0xff)
+    state.set_ram(0x2400 + 50*32 + 16, 0xff)
+    display.render_screen()
+    assert display.native_surface.get_at((5, 255 - 128))[:3] == (0, 0, 255)
+    assert display.native_surface.get_at((50, 255 - 128))[:3] == Display.PIXEL_ON
+
+@pytest.mark.parametrize('glow', Display.GLOW_LEVELS)
+def test_glow_levels_render(state, glow):
+    display = Display(state, glow=glow)
+    state.set_ram(0x2400 + 100*32, 0xff)
+    display.render_screen()
+    assert min(display.screen_surface.get_at((201, 767))[:3]) > 150
+    glowing = display.screen_surface.get_at((202, 767))[:3] != Display.PIXEL_OFF
+    assert glowing == (glow != 'off')
+
+def test_unknown_glow(state):
+    with pytest.raises(ValueError):
+        Display(state, glow='bloom')
+
+def test_glow_degrades_and_recovers(display):
+    for _ in range(Display.DEGRADE_AFTER):
+        display.add_frame_time(30)
+    assert display.glow == 'cheap'
+    assert all(display.state.vram_dirty) # redrawn at the new level
+    for _ in range(Display.DEGRADE_AFTER):
+        display.add_frame_time(30)
+    assert display.glow == 'off'
+    for _ in range(Display.RECOVER_AFTER):
+        display.add_frame_time(5)
+    assert display.glow == 'cheap'
+    for _ in range(Display.RECOVER_AFTER * 2):
+        display.add_frame_time(5)
+    assert display.glow == 'full' # never above the chosen level
+
+def test_glow_not_adaptive(state):
+    display = Display(state, glow='cheap', adaptive=False)
+    for _ in range(Display.DEGRADE_AFTER):
+        display.add_frame_time(30)
+    assert display.glow == 'cheap'
+
+
+@pytest.fixture
+def state():
+    return State()
+
+@pytest.fixture
+def display(state):
+    return Display(state)
@@ -0,0 +1,36 @@
+from Machine import Machine
+from Farm import run_farm, init_worker, run_instance
+
+
+def jobs():
+    return [
+        {'name': 'idle', 'frames': 6},
+        {'name': 'fire', 'frames': 6, 'script': {2: 0x10}, 'hash_every': 2},
+        {'name': 'short', 'frames': 3, 'script': {0: 0x01}},
+    ]
+
+def test_results_match_a_single_run(demo_rom):
+    results = {result['name']: result for result in run_farm(jobs(), demo_rom, workers=2)}
+    assert set(results) == {'idle', 'fire', 'short'}
+    init_worker(demo_rom)
+    for index, job in enumerate(jobs()):
+        result = results[job['name']]
+        assert result['job'] == index
+        expected = run_instance(job)
+        assert result['vram_hash'] == expected['vram_hash']
+        assert result['frame_hashes'] == expected['frame_hashes']
+        assert result['frames'] == job['frames']
+    assert len(results['fire']['frame_hashes']) == 3
+    assert results['idle']['frame_hashes'][-1] == results['idle']['vram_hash']
+
+def test_failed_job_reported(demo_rom):
+    results = list(run_farm([{'frames': 2}, {'name': 'broken'}], demo_rom, workers=2))
+    broken = next(result for result in results if result['name'] == 'broken')
+    assert 'KeyError' in broken['error']
+    assert 'error' not in next(result for result in results if result['name'] == '0')
+
+def test_scores_are_bcd():
+    machine = Machine()
+    machine.state.set_ram(0x20F8, bytes([0x50, 0x12])) # player 1: 1250
+    machine.state.set_ram(0x20F4, bytes([0x90, 0x09])) # high: 990
+    assert machine.scores() == {'player1': 1250, 'player2': 0, 'high': 990}
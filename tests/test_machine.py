@@ -0,0 +1,31 @@
+import pytest
+from Machine import Machine
+
+
+def run(machine, rom, frames, script):
+    machine.load_rom_image(rom)
+    for frame in range(frames):
+        if frame in script:
+            machine.set_input(script[frame])
+        machine.run_frame()
+
+def test_counts_frames_and_cycles(demo_rom):
+    machine = Machine()
+    run(machine, demo_rom, 3, {})
+    assert machine.frames == 3
+    assert machine.cycles >= 3 * Machine.CPF
+
+def test_input_reaches_vram(demo_rom):
+    machine = Machine()
+    run(machine, demo_rom, 4, {2: 0x15})
+    # the vblank handler runs at the start of the next frame
+    assert machine.vram()[:4] == bytes([0x00, 0x15, 0x15, 0x00])
+
+@pytest.mark.parametrize('engine', ['recompiler', 'reference'])
+def test_vram_hash_same_on_every_engine(engine, demo_rom):
+    hashes = []
+    for config in [{'engine': 'table'}, {'engine': engine}]:
+        machine = Machine(config=config)
+        run(machine, demo_rom, 5, {1: 0x04, 3: 0x01})
+        hashes.append(machine.vram_hash())
+    assert hashes[0] == hashes[1]
@@ -0,0 +1,56 @@
+import csv
+import json
+from Machine import Machine
+from opcodebytes import Opcodebytes
+from Profiler import Profiler
+
+
+def profiled_run(rom, frames=3, engine='table', **options):
+    machine = Machine(config={'engine': engine})
+    machine.load_rom_image(rom)
+    profiler = Profiler(**options)
+    machine.cpu.start_profile(profiler)
+    for _ in range(frames):
+        machine.run_frame()
+    machine.cpu.stop_profile()
+    return machine, profiler
+
+def test_counts_match_the_run(demo_rom):
+    machine, profiler = profiled_run(demo_rom)
+    totals = profiler.totals()
+    assert totals['cycles'] == machine.cycles
+    assert profiler.counts[Opcodebytes.RST_2] == 3 # the vblanks
+    assert max(profiler.rows(), key=lambda row: row['count'])['name'] == 'JMP' # the idle loop
+    assert totals['wall_ms'] > 0
+
+def test_every_engine_counts_the_same(demo_rom):
+    counts = [profiled_run(demo_rom, engine=engine)[1].counts
+              for engine in ['table', 'recompiler', 'reference']]
+    assert counts[0] == counts[1] == counts[2]
+
+def test_rows_by_handler(demo_rom):
+    _, profiler = profiled_run(demo_rom, sample_every=1)
+    rows = {row['name']: row for row in profiler.rows('handler')}
+    assert rows['_op_rst']['count'] == 6 # RST 1 and RST 2, three frames
+    assert all(row['host_ms'] > 0 for row in rows.values())
+    by_time = [row['host_ms'] for row in profiler.rows()]
+    assert by_time == sorted(by_time, reverse=True)
+    assert 'host ns per emulated cycle' in profiler.report()
+
+def test_stopped_cpu_is_plain(demo_rom):
+    machine, profiler = profiled_run(demo_rom)
+    counts = list(profiler.counts)
+    machine.run_frame()
+    assert profiler.counts == counts
+    assert machine.cpu._interrupt == machine.cpu._execute
+
+def test_save(demo_rom, tmp_path):
+    _, profiler = profiled_run(demo_rom)
+    profiler.save(tmp_path / 'profile.csv')
+    profiler.save(tmp_path / 'profile.json', by='handler')
+    with open(tmp_path / 'profile.csv') as file:
+        rows = list(csv.DictReader(file))
+    assert rows[0]['name'] == profiler.rows()[0]['name']
+    saved = json.loads((tmp_path / 'profile.json').read_text())
+    assert saved['by'] == 'handler'
+    assert saved['totals']['cycles'] == profiler.totals()['cycles']
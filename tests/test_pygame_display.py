@@ -0,0 +1,36 @@
+import os
+import random
+import pytest
+import pygame
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+from State import State
+from PygameDisplay import Display
+
+
+def test_matches_numpy_display(state, display):
+    # without cellophane and glow both backends draw the same screen
+    numpy_display = pytest.importorskip('NumpyDisplay')
+    state.set_ram(State.VRAM_START, random.Random(1).randbytes(7168))
+    display.render_screen()
+    expected = numpy_display.Display(state, overlay=[], glow='off')
+    state.vram_dirty[:] = b'\x01' * State.VRAM_ROWS
+    expected.render_screen()
+    assert pygame.image.tobytes(display.screen_surface, 'RGB') == \
+        pygame.image.tobytes(expected.screen_surface, 'RGB')
+
+def test_only_changed_rows_update(display, state):
+    display.render_screen()
+    assert display.render_screen() == []
+    state.set_ram(0x2400 + 100*32, 0xff)
+    rects = display.render_screen()
+    assert rects == [pygame.Rect(200, 0, 2, 768)]
+    assert display.screen_surface.get_at((200, 767))[:3] == Display.PIXEL_ON
+
+
+@pytest.fixture
+def state():
+    return State()
+
+@pytest.fixture
+def display(state):
+    return Display(state)
@@ -0,0 +1,107 @@
+import os
+import pytest
+from CPU import CPU
+from State import State
+from Bus import Bus
+from opcodebytes import Opcodebytes
+
+TESTROMS = os.path.join(os.path.dirname(__file__), '..', 'testroms')
+
+
+def run_until_halt(cpu, limit=100_000):
+    for _ in range(limit):
+        if cpu.run_cycle() is None:
+            return
+    raise RuntimeError("Program did not halt.")
+
+def test_block_runs_to_branch(cpu, state):
+    state.ram[0:6] = [Opcodebytes.MVI_B, 0x12, Opcodebytes.INR_B,
+                      Opcodebytes.JMP, 0x20, 0x21]
+    cycles = cpu.run_cycle()
+    assert cycles == 7 + 5 + 10
+    assert state.get_reg('b') == 0x13
+    assert state.get_pc() == 0x2120
+
+def test_halt_ends_block(cpu, state):
+    state.ram[0:3] = [Opcodebytes.NOP, Opcodebytes.NOP, Opcodebytes.HLT]
+    assert cpu.run_cycle() == 8
+    assert cpu.run_cycle() is None
+
+def test_store_into_running_block(cpu, state):
+    # the STA turns the NOP at 0x0006 into INR A before it runs
+    state.ram[0:8] = [Opcodebytes.MVI_A, Opcodebytes.INR_A,
+                      Opcodebytes.STA, 0x06, 0x00,
+                      Opcodebytes.NOP, Opcodebytes.NOP, Opcodebytes.HLT]
+    run_until_halt(cpu)
+    assert state.get_reg('a') == Opcodebytes.INR_A + 1
+
+def test_write_invalidates_translated_block(cpu, state):
+    state.ram[0:2] = [Opcodebytes.INR_C, Opcodebytes.HLT]
+    run_until_halt(cpu)
+    assert 0 in cpu.recompiler.blocks
+    state.set_ram(0x0000, Opcodebytes.DCR_C)
+    assert 0 not in cpu.recompiler.blocks
+    state.set_pc(0)
+    run_until_halt(cpu)
+    assert state.get_reg('c') == 0
+
+def test_write_elsewhere_keeps_block(cpu, state):
+    state.ram[0:2] = [Opcodebytes.INR_C, Opcodebytes.HLT]
+    run_until_halt(cpu)
+    state.set_ram(0x2400, 0xff)
+    assert 0 in cpu.recompiler.blocks
+
+@pytest.mark.parametrize('rom', ['TST8080.COM', '8080PRE.COM'])
+def test_cpm_rom_matches_reference(rom):
+    # run a diagnostic ROM on both engines and compare the final machines
+    machines = []
+    for engine in ['reference', 'recompiler']:
+        state = State(romstart=0x0100)
+        cpu = CPU(state, Bus(state), {'engine': engine})
+        with open(os.path.join(TESTROMS, rom), 'rb') as file:
+            state.set_ram(0x0100, file.read())
+        state.set_ram(0x0000, Opcodebytes.HLT) # warm boot
+        state.set_ram(0x0005, Opcodebytes.RET) # BDOS calls
+        run_until_halt(cpu)
+        machines.append((bytes(state.registers), state.get_psw(), state.pc,
+                         state.sp, bytes(state.ram)))
+    assert machines[0] == machines[1]
+
+
+def test_interrupts_match_reference():
+    # blocks must not run past an interrupt: both engines take RST 1 and
+    # RST 2 after the same instruction
+    machines = []
+    for engine in ['reference', 'recompiler']:
+        state = State()
+        cpu = CPU(state, Bus(state), {'engine': engine})
+        state.ram[0:8] = [Opcodebytes.EI, Opcodebytes.INR_B, Opcodebytes.INX_D,
+                          Opcodebytes.INR_B, Opcodebytes.INX_D,
+                          Opcodebytes.JMP, 0x01, 0x00]
+        for rst in (0x08, 0x10): # store B at DE, then go back to the loop
+            state.ram[rst:rst + 4] = [Opcodebytes.MOV_A_B, Opcodebytes.STAX_D,
+                                      Opcodebytes.EI, Opcodebytes.RET]
+        state.set_sp(0x3000)
+        for _ in range(3):
+            cpu.run_frame(1000)
+        machines.append((bytes(state.registers), state.pc, state.sp, bytes(state.ram)))
+    assert machines[0] == machines[1]
+
+
+def test_breakpoint_inside_block(cpu, state):
+    # all NOPs, so the whole of memory is straight-line code
+    assert cpu.run_until(10000, breakpoints={3}) == (12, CPU.STOP_BREAKPOINT)
+    assert state.pc == 3
+
+
+@pytest.fixture
+def state():
+    return State()
+
+@pytest.fixture
+def bus(state):
+    return Bus(state)
+
+@pytest.fixture
+def cpu(state, bus):
+    return CPU(state, bus, {'engine': 'recompiler'})
@@ -0,0 +1,60 @@
+import json
+import pytest
+from Keyboard import Keyboard
+from Recording import save_recording, load_recording, replay, differences, main
+from Machine import Machine
+
+
+def test_recording_round_trip(tmp_path):
+    frames = bytes([0] * 70_000 + [0x10, 0x10, 0x20] + [0] * 5)
+    filename = tmp_path / 'game.inp'
+    save_recording(filename, frames)
+    assert filename.stat().st_size < 30
+    assert load_recording(filename) == frames
+
+def test_load_rejects_other_files(tmp_path):
+    filename = tmp_path / 'game.inp'
+    filename.write_bytes(b'not a recording')
+    with pytest.raises(ValueError):
+        load_recording(filename)
+    save_recording(filename, bytes(10))
+    filename.write_bytes(filename.read_bytes()[:-3])
+    with pytest.raises(ValueError):
+        load_recording(filename)
+
+def test_replay_is_deterministic(demo_rom):
+    frames = bytes([0, 0, 1, 1, 1, 0x10, 0x30, 0, 4, 4])
+    first = replay(frames, demo_rom)
+    second = replay(frames, demo_rom, {'engine': 'recompiler'})
+    assert first['frames'] == 10 and len(first['frame_hashes']) == 10
+    assert differences(second, first) == []
+    other = replay(frames[:5] + b'\x40' + frames[6:], demo_rom)
+    assert differences(other, first) == ["VRAM differs from frame 5"]
+
+def test_replay_matches_keyboard_play(demo_rom):
+    # input recorded as the main loop does, then replayed
+    machine = Machine()
+    machine.load_rom_image(demo_rom)
+    keyboard = Keyboard(machine.bus)
+    keyboard.start_recording()
+    for frame in range(12):
+        machine.set_input(frame * 3)
+        machine.run_frame()
+        keyboard.record_frame()
+    result = replay(bytes(keyboard.recording), demo_rom)
+    assert result['frame_hashes'][-1] == machine.vram_hash()
+
+def test_main_checks_results(demo_rom, tmp_path, capsys):
+    roms = tmp_path / 'roms'
+    roms.mkdir()
+    for index, filename in enumerate(Machine.ROM_FILES):
+        (roms / filename).write_bytes(demo_rom[index * 0x800:(index + 1) * 0x800])
+    save_recording(tmp_path / 'game.inp', bytes([0, 1, 2, 3]))
+    arguments = [str(tmp_path / 'game.inp'), '--roms', str(roms)]
+    assert main(arguments + ['--save', str(tmp_path / 'game.json')]) == 0
+    assert main(arguments + ['--expect', str(tmp_path / 'game.json')]) == 0
+    expected = json.loads((tmp_path / 'game.json').read_text())
+    expected['frame_hashes'][2] = 'x'
+    (tmp_path / 'game.json').write_text(json.dumps(expected))
+    assert main(arguments + ['--expect', str(tmp_path / 'game.json')]) == 1
+    assert "VRAM differs from frame 2" in capsys.readouterr().out
@@ -0,0 +1,80 @@
+import random
+import sys
+from collections import deque
+import pytest
+from Machine import Machine
+from Rewind import Rewind, encode_delta, apply_delta
+
+
+def test_delta_round_trip():
+    generator = random.Random(19)
+    old = bytes(generator.randrange(256) for _ in range(1000))
+    new = bytearray(old)
+    for index in [0, 1, 5, 6, 7, 500, 999] + generator.sample(range(1000), 20):
+        new[index] ^= generator.randrange(1, 256)
+    delta = encode_delta(old, new)
+    assert len(delta) < 200
+    apply_delta(new, delta)
+    assert new == old
+
+def test_unchanged_delta_is_empty():
+    assert encode_delta(bytes(100), bytes(100)) == b''
+
+@pytest.fixture
+def machine(demo_rom):
+    machine = Machine()
+    machine.load_rom_image(demo_rom)
+    return machine
+
+def play(machine, rewind, frames):
+    snapshots = []
+    for frame in range(frames):
+        machine.set_input(frame + 1)
+        machine.run_frame()
+        rewind.record()
+        snapshots.append(bytes(machine.state.snapshot()))
+    return snapshots
+
+def test_step_back_restores_each_frame(machine):
+    rewind = Rewind(machine.state)
+    snapshots = play(machine, rewind, 10)
+    assert rewind.frames_held() == 9
+    for snapshot in reversed(snapshots[:-1]):
+        assert rewind.step_back()
+        assert machine.state.snapshot() == snapshot
+    assert not rewind.step_back()
+
+def test_play_on_after_rewinding(machine):
+    rewind = Rewind(machine.state)
+    snapshots = play(machine, rewind, 6)
+    rewind.step_back()
+    rewind.step_back()
+    play(machine, rewind, 3)
+    for _ in range(3):
+        rewind.step_back()
+    assert machine.state.snapshot() == snapshots[3]
+
+def test_every_n_frames(machine):
+    rewind = Rewind(machine.state, every=3)
+    snapshots = play(machine, rewind, 9)
+    assert rewind.frames_held() == 6
+    rewind.step_back()
+    assert machine.state.snapshot() == snapshots[5]
+
+def test_memory_bound_drops_oldest(machine):
+    # the bound covers the two whole snapshots and the deque, not just the deltas
+    whole = 2 * sys.getsizeof(machine.state.snapshot()) + sys.getsizeof(deque())
+    rewind = Rewind(machine.state, max_bytes=whole + 500)
+    snapshots = play(machine, rewind, 30)
+    assert rewind.held_bytes() <= whole + 500
+    held = rewind.frames_held()
+    assert 0 < held < 29
+    while rewind.step_back():
+        pass
+    assert machine.state.snapshot() == snapshots[29 - held]
+    stats = rewind.stats()
+    assert stats['bytes'] == rewind.held_bytes() and stats['record_us'] > 0
+
+    rewind = Rewind(machine.state, max_bytes=whole - 1) # no room for any delta
+    play(machine, rewind, 5)
+    assert rewind.frames_held() == 0
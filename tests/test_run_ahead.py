@@ -0,0 +1,91 @@
+import pytest
+from Machine import Machine
+from RunAhead import RunAhead, measure_latency
+from State import State
+from opcodebytes import Opcodebytes
+
+
+@pytest.fixture
+def lag_rom():
+    # At every vblank, shows the input read at the one before: VRAM row 0
+    # gets port 1 a frame late.
+    image = bytearray(Machine.ROM_SIZE)
+    image[0x00:0x03] = [Opcodebytes.JMP, 0x20, 0x00]
+    image[0x08:0x0a] = [Opcodebytes.EI, Opcodebytes.RET]
+    image[0x10:0x1d] = [Opcodebytes.LDA, 0x00, 0x20, Opcodebytes.STA, 0x00, 0x24,
+                        Opcodebytes.IN, 0x01, Opcodebytes.STA, 0x00, 0x20,
+                        Opcodebytes.EI, Opcodebytes.RET]
+    image[0x20:0x27] = [Opcodebytes.LXI_SP, 0x00, 0x24, Opcodebytes.EI,
+                        Opcodebytes.JMP, 0x24, 0x00]
+    return bytes(image)
+
+class Sounds():
+    def __init__(self):
+        self.played = []
+    def play(self, index):
+        self.played.append(index)
+
+def make_machine(rom, soundboard=None):
+    machine = Machine(soundboard)
+    machine.load_rom_image(rom)
+    return machine
+
+
+@pytest.mark.parametrize('frames_ahead, latency', [(0, 1), (1, 0), (2, 0)])
+def test_run_ahead_hides_lag(lag_rom, frames_ahead, latency):
+    machine = make_machine(lag_rom)
+    machine.run_frame()
+    before = machine.state.snapshot()
+    assert measure_latency(machine, 0x10, frames_ahead, max_frames=5) == latency
+    assert machine.state.snapshot() == before
+    assert machine.frames == 1
+
+def test_real_frames_unchanged(demo_rom):
+    plain = make_machine(demo_rom, Sounds())
+    machine = make_machine(demo_rom, Sounds())
+    run_ahead = RunAhead(machine, 2)
+    for frame in range(8):
+        plain.set_input(frame)
+        machine.set_input(frame)
+        plain.run_frame()
+        run_ahead.run_frame()
+        run_ahead.restore()
+        assert machine.state.snapshot() == plain.state.snapshot()
+    assert (machine.frames, machine.cycles) == (plain.frames, plain.cycles)
+    assert machine.bus.soundboard.played == plain.bus.soundboard.played
+
+def test_shows_frame_ahead(demo_rom):
+    future = make_machine(demo_rom)
+    machine = make_machine(demo_rom)
+    run_ahead = RunAhead(machine, 2)
+    for _ in range(3):
+        future.run_frame()
+    run_ahead.run_frame()
+    assert machine.vram() == future.vram()
+
+def test_dirty_rows_track_shown_frames(demo_rom):
+    # a screen updated from the dirty rows only, as the displays do, keeps
+    # up with the look-ahead frames
+    machine = make_machine(demo_rom)
+    state = machine.state
+    run_ahead = RunAhead(machine, 1)
+    screen = bytearray(Machine.VRAM_END - Machine.VRAM_START)
+    row = State.VRAM_ROW_BYTES
+    for frame in range(40):
+        # input changing mid-game rewrites rows the last look-ahead drew
+        machine.set_input(0xff if frame % 7 == 3 else frame)
+        run_ahead.run_frame()
+        for first, end in state.vram_dirty_spans():
+            screen[first * row:end * row] = machine.vram()[first * row:end * row]
+        state.vram_dirty[:] = bytes(State.VRAM_ROWS)
+        assert screen == machine.vram()
+        run_ahead.restore()
+
+def test_restore_keeps_translations(demo_rom):
+    machine = Machine(config={'engine': 'recompiler'})
+    machine.load_rom_image(demo_rom)
+    run_ahead = RunAhead(machine, 1)
+    run_ahead.run_frame()
+    blocks = dict(machine.cpu.recompiler.blocks)
+    run_ahead.restore()
+    assert blocks and machine.cpu.recompiler.blocks == blocks
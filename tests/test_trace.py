@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from CPU import CPU, instruction_lengths
+from Machine import Machine
+from opcodebytes import Opcodebytes
+from Trace import Tracer, load_trace, select, disassemble, first_difference, main
+
+
+def traced_run(rom, filename, frames=3, engine='table', **options):
+    machine = Machine(config={'engine': engine})
+    machine.load_rom_image(rom)
+    tracer = Tracer(filename, **options)
+    machine.cpu.start_trace(tracer)
+    for frame in range(frames):
+        machine.set_input(frame + 1)
+        machine.run_frame()
+    machine.cpu.stop_trace()
+    tracer.close()
+    return machine
+
+def test_records_every_instruction(demo_rom, tmp_path):
+    machine = traced_run(demo_rom, tmp_path / 'run.trace', buffer_records=100)
+    records, branches_only = load_trace(tmp_path / 'run.trace')
+    assert not branches_only
+    assert len(records) > 300 # over several buffers
+    first = records[0]
+    assert (first['cycle'], first['pc'], first['opcode']) == (0, 0x0000, Opcodebytes.JMP)
+    assert records[1]['pc'] == 0x0020
+    assert records[2]['sp'] == 0x2400 # after LXI SP
+    # interrupts at the PC they arrive at
+    vblanks = select(records, opcode=CPU.RST_VBLANK)
+    assert len(vblanks) == 3
+    assert records['cycle'][-1] < machine.cycles
+
+def test_untraced_after_stop(demo_rom, tmp_path):
+    plain = Machine()
+    plain.load_rom_image(demo_rom)
+    machine = traced_run(demo_rom, tmp_path / 'run.trace')
+    for _ in range(3):
+        plain.run_frame()
+    assert machine.cpu._interrupt == machine.cpu._execute
+    machine.run_frame()
+    plain.run_frame()
+    assert machine.cycles == plain.cycles
+
+def test_engines_trace_the_same(demo_rom, tmp_path):
+    traced_run(demo_rom, tmp_path / 'table.trace')
+    traced_run(demo_rom, tmp_path / 'recompiler.trace', engine='recompiler')
+    table, _ = load_trace(tmp_path / 'table.trace')
+    recompiler, _ = load_trace(tmp_path / 'recompiler.trace')
+    traced_run(demo_rom, tmp_path / 'reference.trace', engine='reference')
+    reference, _ = load_trace(tmp_path / 'reference.trace')
+    assert first_difference(table, recompiler) is None
+    assert first_difference(table, reference) is None
+    assert first_difference(table, recompiler[:-1]) == len(table) - 1
+
+def test_branches_only(demo_rom, tmp_path):
+    traced_run(demo_rom, tmp_path / 'full.trace')
+    traced_run(demo_rom, tmp_path / 'branches.trace', branches_only=True)
+    full, _ = load_trace(tmp_path / 'full.trace')
+    branches, branches_only = load_trace(tmp_path / 'branches.trace')
+    assert branches_only
+    assert 0 < len(branches) < len(full)
+    # the full trace where control did not fall through
+    lengths = np.array(instruction_lengths)[full['opcode']]
+    landed = full[1:][full['pc'][1:] != full['pc'][:-1] + lengths[:-1]]
+    # and where the last interrupt landed, which never ran
+    assert np.array_equal(branches[:-1][['cycle', 'pc']], landed[['cycle', 'pc']])
+    assert branches[-1]['pc'] == 0x0010
+
+def test_query_tool(demo_rom, tmp_path, capsys):
+    traced_run(demo_rom, tmp_path / 'a.trace')
+    traced_run(demo_rom, tmp_path / 'b.trace', frames=2)
+    records, _ = load_trace(tmp_path / 'a.trace')
+    assert disassemble(records[:1])[0].split()[:3] == ['0', '0000', 'JMP']
+    assert main(['show', str(tmp_path / 'a.trace'), '--opcode', 'stax_d', '--limit', '1']) == 0
+    output = capsys.readouterr().out
+    assert output.startswith('2 of ') and 'STAX_D' in output # the third vblank's runs next frame
+    assert main(['diff', str(tmp_path / 'a.trace'), str(tmp_path / 'a.trace')]) == 0
+    assert main(['diff', str(tmp_path / 'a.trace'), str(tmp_path / 'b.trace')]) == 1
+
+def test_load_rejects_other_files(tmp_path):
+    (tmp_path / 'x.trace').write_bytes(b'nothing here')
+    with pytest.raises(ValueError):
+        load_trace(tmp_path / 'x.trace')
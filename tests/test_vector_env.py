@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from Machine import Machine
+from VectorEnv import VectorEnv, ACTIONS
+
+
+def test_actions_reach_port1(demo_rom):
+    # the demo ROM stores port 1 in VRAM at every vblank
+    env = VectorEnv(2, demo_rom, stack=2)
+    observations = env.reset()
+    assert observations.shape == (2, 2, 224, 32)
+    for _ in range(3):
+        observations, rewards, dones, info = env.step([1, 3])
+    assert ACTIONS[1] in observations[0, -1, 0] and ACTIONS[3] not in observations[0, -1, 0]
+    assert ACTIONS[3] in observations[1, -1, 0]
+    assert not dones.any()
+
+def test_stack_is_oldest_first(demo_rom):
+    env = VectorEnv(1, demo_rom, stack=3)
+    env.reset()
+    frames = []
+    for _ in range(4):
+        env.step([2])
+        frames.append(env.frames[0].copy())
+    assert (env.history[0] == np.stack(frames[-3:])).all()
+
+def test_pixels(demo_rom):
+    env = VectorEnv(1, demo_rom, observation='pixels')
+    env.reset()
+    env.batch.machines[0].state.set_ram(0x2400 + 5*32 + 1, 0b00000101)
+    pixels = env.step([0])[0]
+    assert pixels.shape == (1, 1, 224, 256)
+    assert list(pixels[0, 0, 5, 8:11]) == [1, 0, 1]
+
+def test_rewards_and_dones(demo_rom):
+    env = VectorEnv(2, demo_rom)
+    env.reset()
+    machine = env.batch.machines[0]
+    machine.state.set_ram(Machine.LIVES_ADDRESS, 3)
+    machine.state.set_ram(0x20F8, bytes([0x50, 0x01])) # 150 points
+    observations, rewards, dones, info = env.step([0, 0])
+    assert list(rewards) == [150, 0]
+    assert list(info['lives']) == [3, 0]
+    assert not dones.any() # no lives yet is not a lost game
+    machine.state.set_ram(Machine.LIVES_ADDRESS, 0)
+    observations, rewards, dones, info = env.step([0, 0])
+    assert list(dones) == [True, False]
+    assert env.batch.machines[0] is not machine # reset for the next game
+
+def test_workers_match_in_process(demo_rom):
+    results = []
+    for workers in [0, 2]:
+        env = VectorEnv(3, demo_rom, frames_per_step=2, stack=2, workers=workers)
+        try:
+            env.reset()
+            for actions in [[1, 2, 3], [4, 5, 0], [3, 3, 3]]:
+                observations, rewards, dones, info = env.step(actions)
+            results.append(observations.copy())
+        finally:
+            env.close()
+    assert (results[0] == results[1]).all()
+
+def test_unknown_observation(demo_rom):
+    with pytest.raises(ValueError):
+        VectorEnv(1, demo_rom, observation='rgb')
@@ -1,6 +1,3 @@
-import numpy as np
-
-
 def bits_to_int(bits:list) -> int:
     # convert a list of 1s and 0s into an int
     binary_string = "".join(map(str, bits))